@@ -0,0 +1,132 @@
+import torch
+import torch.nn.functional as F
+
+
+def kintree_levels(parents):
+    """
+    Group joints by depth in the kinematic tree.
+    Args:
+        parents: parent index of every joint, the root (index 0) parent is ignored
+    Returns:
+        list of (joints, parents of joints) for every depth > 0
+    """
+    num_joints = len(parents)
+    depth = [0] * num_joints
+    for i in range(1, num_joints):
+        depth[i] = depth[int(parents[i])] + 1
+    levels = []
+    for level in range(1, max(depth) + 1):
+        joints = [i for i in range(num_joints) if depth[i] == level]
+        levels.append((joints, [int(parents[i]) for i in joints]))
+    return levels
+
+
+def th_global_transforms(th_rotmats, th_j, parents, levels=None):
+    """
+    Compose the local joint transforms along the kinematic tree, one batched matmul per tree level.
+    Args:
+        th_rotmats (Tensor (batch_size x num_joints x 3 x 3)): local joint rotations, root rotation first
+        th_j (Tensor (batch_size x num_joints x 3)): rest pose joint locations
+        parents: parent index of every joint
+        levels: kintree_levels(parents), pass it to avoid recomputing it every call
+    Returns:
+        th_results (Tensor (batch_size x num_joints x 4 x 4)): global joint transforms
+        th_results_rest (Tensor (batch_size x num_joints x 4 x 4)): global transforms with the rest pose joint location removed (used for skinning)
+    """
+    if levels is None:
+        levels = kintree_levels(parents)
+    batch_size, num_joints = th_rotmats.shape[:2]
+
+    # Relative transforms, root is relative to the origin
+    child_parents = [int(p) for p in parents[1:]]
+    th_rel_j = torch.cat([th_j[:, :1], th_j[:, 1:] - th_j[:, child_parents]], 1)
+    th_rel_transforms = torch.cat([th_rotmats, th_rel_j.unsqueeze(3)], 3)
+    th_rel_transforms = torch.cat([
+        th_rel_transforms,
+        th_rel_transforms.new_tensor([0.0, 0.0, 0.0, 1.0]).expand(batch_size, num_joints, 1, 4)], 2)
+
+    th_results = th_rel_transforms
+    for joints, joint_parents in levels:
+        th_results = th_results.index_copy(1, th_results.new_tensor(joints, dtype=torch.long),
+            torch.matmul(th_results[:, joint_parents], th_rel_transforms[:, joints]))
+
+    # Remove the rest pose joint location: T - pack(T * [j, 0])
+    th_results_rest = torch.cat([
+        th_results[..., :3],
+        th_results[..., 3:] - torch.matmul(th_results[..., :3], th_j.unsqueeze(3))], 3)
+    return th_results, th_results_rest
+
+
+def th_skinning(th_results_rest, th_weights, th_v_posed):
+    """
+    Linear blend skinning.
+    Args:
+        th_results_rest (Tensor (batch_size x num_joints x 4 x 4)): second output of th_global_transforms
+        th_weights (Tensor (num_verts x num_joints)): skinning weights
+        th_v_posed (Tensor (batch_size or 1 x num_verts x 3)): rest pose vertices
+    Returns:
+        vertices (Tensor (batch_size x num_verts x 3))
+    """
+    batch_size, num_joints = th_results_rest.shape[:2]
+    # Per vertex transform, only the top 3 rows are needed
+    th_T = torch.matmul(th_weights, th_results_rest[:, :, :3].reshape(batch_size, num_joints, 12))
+    th_T = th_T.view(batch_size, -1, 3, 4)
+    th_v_posed_h = torch.cat([th_v_posed, th_v_posed.new_ones(th_v_posed.shape[:2] + (1,))], 2)
+    return torch.einsum('bvij,bvj->bvi', th_T, th_v_posed_h.expand(batch_size, -1, -1))
+
+
+
+def topk_skinning_weights(th_weights, k=None, tol=1e-3):
+    """
+    Sparse skinning weights, the k most influential joints of every vertex, built once at model load.
+    The kept weights of every vertex are rescaled to the original sum.
+    Args:
+        th_weights (Tensor (num_verts x num_joints)): dense skinning weights
+        k: number of joints per vertex, by default the smallest k dropping at most tol weight of any vertex
+            (exact if no vertex has more than k non zero weights)
+        tol: largest dropped weight of a vertex used to choose k
+    Returns:
+        th_skin_index (LongTensor (num_verts x k)): joint indices
+        th_skin_weights (Tensor (num_verts x k)): weights
+    """
+    if k is None:
+        th_sorted = th_weights.sort(dim=1, descending=True).values
+        th_dropped = th_weights.sum(1, keepdim=True) - th_sorted.cumsum(1)
+        k = int((th_dropped.max(0).values > tol).sum()) + 1
+    k = min(k, th_weights.shape[1])
+    th_skin_weights, th_skin_index = th_weights.topk(k, dim=1)
+    kept = th_skin_weights.sum(1, keepdim=True)
+    th_skin_weights = th_skin_weights * torch.where(kept != 0, th_weights.sum(1, keepdim=True) / kept, torch.ones_like(kept))
+    return th_skin_index, th_skin_weights
+
+
+def th_skinning_topk(th_results_rest, th_skin_index, th_skin_weights, th_v_posed):
+    """
+    Linear blend skinning with sparse weights (see topk_skinning_weights).
+    Every output coordinate is a sparse sum over (joint, homogeneous coordinate) entries of the transforms,
+    computed with one embedding_bag: 4k terms per vertex instead of the dense (num_verts x 12) transforms.
+    Much faster than th_skinning when th_v_posed is shared by the batch (eg. a fixed RaBit shape) and no gradient is needed,
+    per batch element vertices or autograd are faster with th_skinning.
+    Args:
+        th_results_rest (Tensor (batch_size x num_joints x 4 x 4)): second output of th_global_transforms
+        th_skin_index (LongTensor (num_verts x k)), th_skin_weights (Tensor (num_verts x k))
+        th_v_posed (Tensor (batch_size or 1 x num_verts x 3)): rest pose vertices
+    Returns:
+        vertices (Tensor (batch_size x num_verts x 3))
+    """
+    batch_size, num_joints = th_results_rest.shape[:2]
+    num_verts, k = th_skin_index.shape
+    th_v_posed_h = torch.cat([th_v_posed, th_v_posed.new_ones(th_v_posed.shape[:2] + (1,))], 2)
+    # Entry (joint, c) of a vertex is weighted by w_joint * v_c
+    th_index = (th_skin_index.unsqueeze(2) * 4 + torch.arange(4, device=th_skin_index.device)).view(num_verts, 4 * k)
+    th_entry_weights = th_skin_weights.unsqueeze(2) * th_v_posed_h.unsqueeze(2)
+    if th_v_posed.shape[0] == 1:
+        # One bag per vertex, the batch is in the columns of the table
+        th_table = th_results_rest[:, :, :3].permute(1, 3, 0, 2).reshape(num_joints * 4, batch_size * 3)
+        th_verts = F.embedding_bag(th_index, th_table, per_sample_weights=th_entry_weights.view(num_verts, 4 * k), mode='sum')
+        return th_verts.view(num_verts, batch_size, 3).transpose(0, 1)
+    # One bag per (batch element, vertex)
+    th_table = th_results_rest[:, :, :3].permute(0, 1, 3, 2).reshape(batch_size * num_joints * 4, 3)
+    th_index = th_index.unsqueeze(0) + (torch.arange(batch_size, device=th_index.device) * num_joints * 4).view(-1, 1, 1)
+    th_verts = F.embedding_bag(th_index.view(-1, 4 * k), th_table, per_sample_weights=th_entry_weights.view(-1, 4 * k), mode='sum')
+    return th_verts.view(batch_size, num_verts, 3)
@@ -6,7 +6,17 @@ from torch.nn import Module
 
 from smplpytorch.native.webuser.serialization import ready_arguments
 from smplpytorch.pytorch import rodrigues_layer
-from smplpytorch.pytorch.tensutils import (th_posemap_axisang, th_with_zeros, th_pack, make_list, subtract_flat_id)
+from smplpytorch.pytorch.tensutils import (th_posemap_axisang, make_list, subtract_flat_id)
+from smplpytorch.pytorch.kinematics import kintree_levels, th_global_transforms, th_skinning
+
+
+def _to_numpy(x):
+    # chumpy arrays (.r), scipy sparse matrices (.toarray()) or numpy arrays
+    if hasattr(x, 'r'):
+        return np.array(x.r)
+    if hasattr(x, 'toarray'):
+        return np.array(x.toarray())
+    return np.array(x)
 
 
 class SMPL_Layer(Module):
@@ -15,42 +25,48 @@ class SMPL_Layer(Module):
     def __init__(self,
                  center_idx=None,
                  gender='neutral',
-                 model_root='smpl/native/models'):
+                 model_root='smpl/native/models',
+                 smpl_data=None):
         """
         Args:
             center_idx: index of center joint in our computations,
             model_root: path to pkl files for the model
             gender: 'neutral' (default) or 'female' or 'male'
+            smpl_data: already loaded model (dict with the keys of ready_arguments, chumpy or numpy values),
+                model_root is not read if provided (eg. synthetic models for benchmarks)
         """
         super().__init__()
 
         self.center_idx = center_idx
         self.gender = gender
 
-        if gender == 'neutral':
-            self.model_path = os.path.join(model_root, 'basicModel_neutral_lbs_10_207_0_v1.0.0.pkl')
-        elif gender == 'female':
-            self.model_path = os.path.join(model_root, 'basicModel_f_lbs_10_207_0_v1.0.0.pkl')
-        elif gender == 'male':
-            self.model_path = os.path.join(model_root, 'basicModel_m_lbs_10_207_0_v1.0.0.pkl')
+        self.model_path = SMPL_Layer.get_model_path(model_root, gender)
 
-        smpl_data = ready_arguments(self.model_path)
+        if smpl_data is None:
+            smpl_data = ready_arguments(self.model_path)
         self.smpl_data = smpl_data
 
         self.register_buffer('th_betas',
-                             torch.Tensor(smpl_data['betas'].r).unsqueeze(0))
+                             torch.Tensor(_to_numpy(smpl_data['betas'])).unsqueeze(0))
         self.register_buffer('th_shapedirs',
-                             torch.Tensor(smpl_data['shapedirs'].r))
+                             torch.Tensor(_to_numpy(smpl_data['shapedirs'])))
         self.register_buffer('th_posedirs',
-                             torch.Tensor(smpl_data['posedirs'].r))
+                             torch.Tensor(_to_numpy(smpl_data['posedirs'])))
         self.register_buffer(
             'th_v_template',
-            torch.Tensor(smpl_data['v_template'].r).unsqueeze(0))
+            torch.Tensor(_to_numpy(smpl_data['v_template'])).unsqueeze(0))
         self.register_buffer(
             'th_J_regressor',
-            torch.Tensor(np.array(smpl_data['J_regressor'].toarray())))
+            torch.Tensor(_to_numpy(smpl_data['J_regressor'])))
         self.register_buffer('th_weights',
-                             torch.Tensor(smpl_data['weights'].r))
+                             torch.Tensor(_to_numpy(smpl_data['weights'])))
+        # Joints are linear in the shape parameters, regress them without building the mesh (joints_only)
+        self.register_buffer('th_J_template',
+                             torch.matmul(self.th_J_regressor, self.th_v_template[0]).unsqueeze(0),
+                             persistent=False)
+        self.register_buffer('th_J_shapedirs',
+                             torch.einsum('jv,vcb->jcb', self.th_J_regressor, self.th_shapedirs),
+                             persistent=False)
         self.register_buffer('th_faces',
                              torch.Tensor(smpl_data['f'].astype(np.int32)).long())
 
@@ -60,16 +76,32 @@ class SMPL_Layer(Module):
         self.kintree_parents = parents
         self.num_joints = len(parents)  # 24
 
+        # Joints grouped by depth in the kinematic tree, transforms of a level are composed in one batched matmul
+        self.kintree_levels = kintree_levels(parents)
+
+    @staticmethod
+    def get_model_path(model_root, gender='neutral'):
+        if gender == 'neutral':
+            return os.path.join(model_root, 'basicModel_neutral_lbs_10_207_0_v1.0.0.pkl')
+        elif gender == 'female':
+            return os.path.join(model_root, 'basicModel_f_lbs_10_207_0_v1.0.0.pkl')
+        elif gender == 'male':
+            return os.path.join(model_root, 'basicModel_m_lbs_10_207_0_v1.0.0.pkl')
+        raise ValueError('Unknown gender: {}'.format(gender))
+
     def forward(self,
                 th_pose_axisang,
                 th_betas=torch.zeros(10),
                 th_trans=torch.zeros(3),
-                th_offset=torch.zeros((24,3)),requires_grad=False):
+                th_offset=torch.zeros((24,3)),requires_grad=False,
+                joints_only=False):
         """
         Args:
         th_pose_axisang (Tensor (batch_size x 72)): pose parameters in axis-angle representation
         th_betas (Tensor (batch_size x 10)): if provided, uses given shape parameters
         th_trans (Tensor (batch_size x 3)): if provided, applies trans to joints and vertices
+        th_offset (Tensor (24 x 3) or (batch_size x 24 x 3)): per joint offsets, used for the third output
+        joints_only (bool): skip pose blend shapes and skinning, returned vertices are None
         """
 
         batch_size = th_pose_axisang.shape[0]
@@ -83,7 +115,11 @@ class SMPL_Layer(Module):
 
         # Below does: v_shaped = v_template + shapedirs * betas
         # If shape parameters are not provided
-        if th_betas is None:
+        if joints_only:
+            th_betas = self.th_betas.repeat(batch_size, 1) if th_betas is None else th_betas
+            th_j = self.th_J_template + torch.matmul(
+                self.th_J_shapedirs, th_betas.transpose(1, 0)).permute(2, 0, 1)
+        elif th_betas is None:
             th_v_shaped = self.th_v_template + torch.matmul(
                 self.th_shapedirs, self.th_betas.transpose(1, 0)).permute(2, 0, 1)
             th_j = torch.matmul(self.th_J_regressor, th_v_shaped).repeat(
@@ -94,64 +130,27 @@ class SMPL_Layer(Module):
             th_j = torch.matmul(self.th_J_regressor, th_v_shaped)
 
         # Below does: v_posed = v_shaped + posedirs * pose_map
-        th_v_posed = th_v_shaped + torch.matmul(
-            self.th_posedirs, th_pose_map.transpose(0, 1)).permute(2, 0, 1)
+        if not joints_only:
+            th_v_posed = th_v_shaped + torch.matmul(
+                self.th_posedirs, th_pose_map.transpose(0, 1)).permute(2, 0, 1)
         # Final T pose with transformation done!
 
         # Global rigid transformation
-        th_results = []
-
-        root_j = th_j[:, 0, :].contiguous().view(batch_size, 3, 1)
-        th_results.append(th_with_zeros(torch.cat([root_rot, root_j], 2)))
-
-        # Rotate each part
-        for i in range(self.num_joints - 1):
-            i_val = int(i + 1)
-            joint_rot = th_pose_rotmat[:, (i_val - 1) * 9:i_val *
-                                   9].contiguous().view(batch_size, 3, 3)
-            joint_j = th_j[:, i_val, :].contiguous().view(batch_size, 3, 1)
-            parent = make_list(self.kintree_parents)[i_val]
-            parent_j = th_j[:, parent, :].contiguous().view(batch_size, 3, 1)
-            joint_rel_transform = th_with_zeros(
-                torch.cat([joint_rot, joint_j - parent_j], 2))
-            th_results.append(
-                torch.matmul(th_results[parent], joint_rel_transform))
-        th_results_global = th_results
-
-        th_results2 = torch.zeros((batch_size, 4, 4, self.num_joints),
-                                  dtype=root_j.dtype,
-                                  device=root_j.device)
-
-        for i in range(self.num_joints):
-            padd_zero = torch.zeros(1, dtype=th_j.dtype, device=th_j.device)
-            joint_j = torch.cat(
-                [th_j[:, i],
-                 padd_zero.view(1, 1).repeat(batch_size, 1)], 1)
-            tmp = torch.bmm(th_results[i], joint_j.unsqueeze(2))
-            th_results2[:, :, :, i] = th_results[i] - th_pack(tmp)
-
-        th_T = torch.matmul(th_results2, self.th_weights.transpose(0, 1))
-
-        th_rest_shape_h = torch.cat([
-            th_v_posed.transpose(2, 1),
-            torch.ones((batch_size, 1, th_v_posed.shape[1]),
-                       dtype=th_T.dtype,
-                       device=th_T.device),
-        ], 1)
-
-        th_verts = (th_T * th_rest_shape_h.unsqueeze(1)).sum(2).transpose(2, 1)
-        th_verts = th_verts[:, :, :3]
-
-        th_jtr = torch.stack(th_results_global, dim=1)[:, :, :3, 3]
-
-
-        th_j_offset = th_j + th_offset.unsqueeze(0)
-        
-        th_j_offset_h = torch.cat([th_j_offset.transpose(2,1),torch.ones((batch_size,1,th_j_offset.shape[1]),dtype=th_j_offset.dtype,device=th_j_offset.device)],1)
+        th_results_global, th_results_rest = th_global_transforms(
+            torch.cat([root_rot.unsqueeze(1), th_pose_rotmat.view(batch_size, -1, 3, 3)], 1),
+            th_j, make_list(self.kintree_parents), self.kintree_levels)
+
+        if joints_only:
+            th_verts = None
+        else:
+            th_verts = th_skinning(th_results_rest, self.th_weights, th_v_posed)
+
+        th_jtr = th_results_global[:, :, :3, 3]
 
-        th_jtr_offset = (th_results2*th_j_offset_h.unsqueeze(1)).sum(2).transpose(2,1)
+        # th_offset: (24 x 3) shared or (batch_size x 24 x 3) per frame
+        th_j_offset = th_j + (th_offset.unsqueeze(0) if th_offset.dim() == 2 else th_offset)
         
-        th_jtr_offset = th_jtr_offset[:,:,:3]
+        th_jtr_offset = torch.matmul(th_results_rest[:, :, :3, :3], th_j_offset.unsqueeze(3)).squeeze(3) + th_results_rest[:, :, :3, 3]
 
         # print("Diff:",(torch.abs(th_jtr - th_jtr_offset).sum()))
         # assert not bool(), f"Transformation not correct:{th_jtr} doesn't match {torch.stack(th_results_global, dim=1)[:, :, :3, 3]} Diff:{(th_jtr - torch.stack(th_results_global, dim=1)[:, :, :3, 3]).sum()}"
@@ -164,10 +163,12 @@ class SMPL_Layer(Module):
                 center_joint = th_jtr[:, self.center_idx].unsqueeze(1)
                 th_jtr = th_jtr - center_joint
                 th_jtr_offset = th_jtr_offset - center_joint
-                th_verts = th_verts - center_joint
+                if th_verts is not None:
+                    th_verts = th_verts - center_joint
         else:
             th_jtr = th_jtr + th_trans.unsqueeze(1)
-            th_verts = th_verts + th_trans.unsqueeze(1)
+            if th_verts is not None:
+                th_verts = th_verts + th_trans.unsqueeze(1)
             th_jtr_offset = th_jtr_offset + th_trans.unsqueeze(1)
         # Vertices and joints in meters
         return th_verts, th_jtr,th_jtr_offset
@@ -8,15 +8,10 @@ def th_posemap_axisang(pose_vectors):
     Converts axis-angle to rotmat
     pose_vectors (Tensor (batch_size x 72)): pose parameters in axis-angle representation
     '''
-    rot_nb = int(pose_vectors.shape[1] / 3)
-    rot_mats = []
-    for joint_idx in range(rot_nb):
-        axis_ang = pose_vectors[:, joint_idx * 3:(joint_idx + 1) * 3]
-        rot_mat = rodrigues_layer.batch_rodrigues(axis_ang)
-        rot_mats.append(rot_mat)
-
-    rot_mats = torch.cat(rot_mats, 1)
-    return rot_mats
+    # Single fused call for all joints, same layout as concatenating the joints (batch_size x rot_nb*9)
+    batch_size = pose_vectors.shape[0]
+    rot_mats = rodrigues_layer.batch_rodrigues(pose_vectors.reshape(-1, 3))
+    return rot_mats.view(batch_size, -1)
 
 
 def th_with_zeros(tensor):
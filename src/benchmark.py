@@ -0,0 +1,411 @@
+import os
+import sys
+import time
+import json
+import resource
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+# DL Modules
+import torch
+
+# Modules
+from utils import * # Paths and config
+from smplpytorch.pytorch.smpl_layer import SMPL_Layer
+from retarget2smpl import SMPLRetarget, fit_smpl
+from dataloader import OpenCapDataLoader
+from rotations import rotation_angle_error
+
+BENCHMARK_DIR = os.path.join(LOG_DIR,'benchmark')
+
+
+# Synthetic benchmarks for SMPL_Layer and the retargetting loop.
+# The SMPL model pickles are not part of the repo, so the benchmark builds a random model with the same
+# tensor shapes (6890 verts, 24 joints, 10 betas, 207 pose blend shapes) and fits TRC like targets
+# generated from known poses. Results are written as json, compare runs with --compare.
+# --rotation-reps compares the convergence of the pose parameterizations (ROTATION_REP) on exercise like motions.
+
+NUM_VERTS = 6890
+NUM_FACES = 13776
+SMPL_PARENTS = [-1,0,0,0,1,2,3,4,5,6,7,8,9,9,9,12,13,14,16,17,18,19,20,21]
+
+# Approximate rest pose joint locations of the neutral SMPL model (meters, y-up)
+SMPL_REST_JOINTS = np.array([
+	[ 0.00,-0.22, 0.03], [ 0.06,-0.31, 0.01], [-0.06,-0.31, 0.02], [ 0.00,-0.11, 0.00], # pelvis, hips, spine1
+	[ 0.10,-0.69, 0.02], [-0.11,-0.69, 0.01], [ 0.00, 0.02, 0.03], # knees, spine2
+	[ 0.09,-1.09,-0.02], [-0.09,-1.09,-0.02], [ 0.00, 0.08, 0.03], # ankles, spine3
+	[ 0.12,-1.14, 0.10], [-0.12,-1.14, 0.10], [ 0.00, 0.29, 0.00], # feet, neck
+	[ 0.08, 0.19, 0.00], [-0.08, 0.19, 0.00], [ 0.01, 0.38, 0.05], # collars, head
+	[ 0.17, 0.23,-0.01], [-0.17, 0.23,-0.01], [ 0.43, 0.21,-0.04], [-0.43, 0.21,-0.04], # shoulders, elbows
+	[ 0.68, 0.22,-0.04], [-0.68, 0.22,-0.04], [ 0.77, 0.21,-0.05], [-0.77, 0.21,-0.05], # wrists, hands
+])
+
+
+def synthetic_smpl_data(seed=0):
+	"""
+		Random model with the keys and shapes of the SMPL pickle (see SMPL_Layer, smpl_data).
+		Vertices are clustered around the rest joints so the kinematic chain has human like bone lengths.
+	"""
+	rng = np.random.RandomState(seed)
+	num_joints = len(SMPL_PARENTS)
+
+	vert_joint = np.arange(NUM_VERTS) % num_joints
+	v_template = SMPL_REST_JOINTS[vert_joint] + 0.03*rng.randn(NUM_VERTS,3)
+
+	# Joint = mean of its vertex cluster
+	J_regressor = np.zeros((num_joints,NUM_VERTS))
+	J_regressor[vert_joint,np.arange(NUM_VERTS)] = 1
+	J_regressor /= J_regressor.sum(axis=1,keepdims=True)
+
+	# Skinning weights shared with the parent joint
+	weights = np.zeros((NUM_VERTS,num_joints))
+	weights[np.arange(NUM_VERTS),vert_joint] = 0.7
+	parents = np.array([max(p,0) for p in SMPL_PARENTS])
+	weights[np.arange(NUM_VERTS),parents[vert_joint]] += 0.3
+
+	# Triangles within a cluster
+	face_joint = rng.randint(0,num_joints,NUM_FACES)
+	cluster_size = NUM_VERTS // num_joints
+	faces = face_joint[:,None] + num_joints*rng.randint(0,cluster_size,(NUM_FACES,3))
+
+	kintree_table = np.array([[2**32-1] + SMPL_PARENTS[1:],list(range(num_joints))])
+
+	return {"betas": np.zeros(10),
+			"shapedirs": 0.01*rng.randn(NUM_VERTS,3,10),
+			"posedirs": 0.001*rng.randn(NUM_VERTS,3,9*(num_joints-1)),
+			"v_template": v_template,
+			"J_regressor": J_regressor,
+			"weights": weights,
+			"f": faces.astype(np.uint32),
+			"kintree_table": kintree_table}
+
+
+def synthetic_layer(seed=0):
+	return SMPL_Layer(center_idx=0,gender='neutral',model_root=SMPL_MODEL_DIR,smpl_data=synthetic_smpl_data(seed))
+
+
+def synthetic_motion(num_frames,seed=0,amplitude=0.4):
+	"""
+		Smooth ground truth poses (T x 72) and trans (T x 3), root initialized like SMPLRetarget
+	"""
+	rng = np.random.RandomState(seed)
+	t = np.linspace(0,2*np.pi,num_frames)[:,None]
+	pose = np.zeros((num_frames,72))
+	pose[:,3:] = amplitude*rng.rand(1,69)*np.sin(t*rng.uniform(0.5,2,(1,69)) + rng.uniform(0,2*np.pi,(1,69)))
+	pose[:,:3] = ROOT_INIT_ROTVEC[None] + 0.1*np.sin(t + rng.uniform(0,2*np.pi,(1,3)))
+	trans = np.cumsum(0.005*rng.randn(num_frames,3),axis=0) + np.array([0,1,0])
+	return torch.from_numpy(pose).float(), torch.from_numpy(trans).float()
+
+
+EXERCISES = ['SQT','CMJ']
+
+def synthetic_exercise(label,num_frames,seed=0):
+	"""
+		Exercise like motion with large rotations on top of synthetic_motion
+		SQT: two deep squats, hip and knee flexion up to 2.0/2.3 rad
+		CMJ: countermovement jump with an overhead arm swing (shoulders ~2.7 rad range) and a half turn of the root
+	"""
+	pose,trans = synthetic_motion(num_frames,seed=seed,amplitude=0.1)
+	u = torch.linspace(0,1,num_frames)
+	if label == 'SQT':
+		s = 0.5*(1 - torch.cos(4*np.pi*u))
+		pose[:,[3,6]] = -2.0*s[:,None]		# hips
+		pose[:,[12,15]] = 2.3*s[:,None]		# knees
+		pose[:,[21,24]] = -0.6*s[:,None]	# ankles
+		trans[:,1] -= 0.5*s
+	elif label == 'CMJ':
+		dip = torch.where(u < 0.5,torch.sin(2*np.pi*u)**2,torch.zeros_like(u))
+		flight = torch.where((u > 0.5) & (u < 0.8),torch.sin(np.pi*(u-0.5)/0.3),torch.zeros_like(u))
+		turn = torch.clamp((u-0.5)/0.3,0,1)
+		pose[:,[3,6]] = -1.2*dip[:,None]
+		pose[:,[12,15]] = 1.5*dip[:,None]
+		swing = -1.3 + 2.7*torch.clamp(u/0.6,0,1)
+		pose[:,50] = swing					# left shoulder, z
+		pose[:,53] = -swing					# right shoulder, z
+		pose[:,1] = float(ROOT_INIT_ROTVEC[1]) + np.pi*turn
+		trans[:,1] += -0.3*dip + 0.4*flight
+	else:
+		raise KeyError(f"Unknown exercise:{label}, use one of {EXERCISES}")
+	return pose,trans
+
+
+@torch.no_grad()
+def synthetic_target(smpl_layer,pose,trans,cfg,noise=0.0,seed=0):
+	"""
+		OpenCap like joints (T x 20 x 3) of the ground truth motion using DATA_MAP.
+		noise: std of gaussian marker noise in meters
+	"""
+	_,Jtr,_ = smpl_layer(pose,th_betas=torch.zeros(pose.shape[0],10,device=pose.device),joints_only=True)
+	Jtr = Jtr + trans.unsqueeze(1)
+
+	# Dataset joints without a SMPL correspondence (neck, heels) are placed at the closest SMPL joints
+	target = Jtr[:,:1].repeat(1,len(JOINT_NAMES),1)
+	target[:,JOINT_NAMES.index('Neck')] = Jtr[:,12]
+	target[:,JOINT_NAMES.index('LHeel')] = Jtr[:,7]
+	target[:,JOINT_NAMES.index('RHeel')] = Jtr[:,8]
+	for smpl_index,dataset_index in cfg.DATASET.DATA_MAP:
+		target[:,dataset_index] = Jtr[:,smpl_index]
+
+	if noise > 0:
+		generator = torch.Generator().manual_seed(seed)
+		target = target + noise*torch.randn(target.shape,generator=generator).to(target.device)
+	return target
+
+
+def synchronize(device):
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+
+
+def reset_peak_memory(device):
+	if device.type == 'cuda':
+		torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device):
+	"""
+		Peak memory in MB. cuda: allocated since the last reset. cpu: process peak RSS (never decreases)
+	"""
+	if device.type == 'cuda':
+		return torch.cuda.max_memory_allocated(device)/2**20
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+
+def timeit(fn,device,repeats=10,warmup=2):
+	"""
+		Median and min wall time of fn in milliseconds
+	"""
+	for _ in range(warmup):
+		fn()
+	times = []
+	for _ in range(repeats):
+		synchronize(device)
+		start = time.perf_counter()
+		fn()
+		synchronize(device)
+		times.append(1e3*(time.perf_counter() - start))
+	return float(np.median(times)), float(np.min(times))
+
+
+def bench_layer(smpl_layer,batch_size,device,repeats=10,seed=0):
+	"""
+		Latency of the SMPL layer forward (mesh and joints only) and forward+backward
+	"""
+	pose,_ = synthetic_motion(batch_size,seed=seed)
+	pose = pose.to(device)
+	betas = torch.zeros(batch_size,10,device=device)
+	res = {"kind":"layer","batch_size":batch_size}
+
+	reset_peak_memory(device)
+	with torch.no_grad():
+		res['forward_ms'],res['forward_min_ms'] = timeit(lambda: smpl_layer(pose,th_betas=betas),device,repeats)
+		res['forward_joints_ms'],res['forward_joints_min_ms'] = timeit(lambda: smpl_layer(pose,th_betas=betas,joints_only=True),device,repeats)
+
+	pose = pose.clone().requires_grad_(True)
+	def forward_backward():
+		verts,Jtr,Jtr_offset = smpl_layer(pose,th_betas=betas)
+		(verts.sum() + Jtr.sum() + Jtr_offset.sum()).backward()
+		pose.grad = None
+	res['forward_backward_ms'],res['forward_backward_min_ms'] = timeit(forward_backward,device,repeats)
+	res['frames_per_s'] = 1e3*batch_size/res['forward_ms']
+	res['peak_memory_mb'] = peak_memory(device)
+	return res
+
+
+def run_fit(smplRetargetter,target,device,logger,writer,max_epoch,pose=None):
+	"""
+		fit_smpl from the usual initialization, returns timing, errors and the loss per epoch.
+		pose: Optional ground truth poses (T x 72) to measure the recovered pose error
+	"""
+	batch_size = smplRetargetter.batch_size
+	with torch.no_grad():
+		smplRetargetter.smpl_params['trans'][:] = target[:,smplRetargetter.index["dataset_index"][0]]
+
+	reset_peak_memory(device)
+	synchronize(device)
+	start = time.perf_counter()
+	meters = fit_smpl(smplRetargetter,target,logger,writer,max_epoch=max_epoch)
+	synchronize(device)
+	duration = time.perf_counter() - start
+
+	with torch.no_grad():
+		_,Jtr,_ = smplRetargetter(joints_only=True)
+		joint_error = (Jtr.index_select(1,smplRetargetter.index["smpl_index"]) - target.index_select(1,smplRetargetter.index["dataset_index"])).norm(dim=-1)
+
+	res = {"batch_size":batch_size,"epochs":max_epoch,
+			"time_s":duration,
+			"epochs_per_s":max_epoch/duration,
+			"frames_per_s":batch_size*max_epoch/duration,
+			"peak_memory_mb":peak_memory(device),
+			"final_loss":float(meters.loss_history[-1]),
+			"joint_error_mm":1e3*float(joint_error.mean())}
+
+	if pose is not None:
+		with torch.no_grad():
+			pose_error = rotation_angle_error(smplRetargetter.pose_axis_angle().reshape(batch_size,-1,3),pose.reshape(batch_size,-1,3))
+		res["pose_error_deg"] = float(np.degrees(float(pose_error.mean())))
+		res["root_error_deg"] = float(np.degrees(float(pose_error[:,0].mean())))
+
+	return res,meters.loss_history
+
+
+def bench_fit(smpl_layer,batch_size,device,logger,writer,max_epoch=100,noise=0.0,seed=0):
+	"""
+		Retarget synthetic targets with fit_smpl and measure throughput and how well the known poses are recovered
+	"""
+	pose,trans = synthetic_motion(batch_size,seed=seed)
+	pose,trans = pose.to(device),trans.to(device)
+
+	smplRetargetter = SMPLRetarget(batch_size,device=device,smpl_layer=smpl_layer).to(device)
+	target = synthetic_target(smpl_layer,pose,trans,smplRetargetter.cfg,noise=noise,seed=seed)
+
+	res,_ = run_fit(smplRetargetter,target,device,logger,writer,max_epoch,pose=pose)
+	res['kind'] = 'fit'
+	return res
+
+
+def compare_rotation_reps(sequences,smpl_layer,device,logger,writer,rotation_reps=['axis_angle','6d','quaternion'],max_epoch=200):
+	"""
+		Fit every sequence with each pose parameterization from the same initialization.
+		epochs_to_baseline: first epoch reaching the final loss of the first (baseline) representation, None if never reached
+
+		sequences: list of (name, target (T x 20 x 3), ground truth pose (T x 72) or None)
+		smpl_layer: None to use the SMPL model in SMPL_MODEL_DIR
+	"""
+	results = []
+	for name,target,pose in sequences:
+		baseline = None
+		for rotation_rep in rotation_reps:
+			smplRetargetter = SMPLRetarget(target.shape[0],device=device,smpl_layer=smpl_layer,rotation_rep=rotation_rep).to(device)
+			res,loss_history = run_fit(smplRetargetter,target,device,logger,writer,max_epoch,pose=pose)
+			if baseline is None:
+				baseline = loss_history[-1]
+			reached = np.where(loss_history <= baseline)[0]
+			res.update({"kind":"rotation_rep","sequence":name,"rotation_rep":rotation_rep,
+						"epochs_to_baseline":int(reached[0])+1 if len(reached) > 0 else None,
+						"loss_history":loss_history.tolist()})
+			results.append(res)
+	return results
+
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git','rev-parse','HEAD'],cwd=HOME_DIR,stderr=subprocess.DEVNULL).decode().strip()
+	except (subprocess.CalledProcessError,FileNotFoundError):
+		return None
+
+
+def run_benchmark(batch_sizes=[1,16,64],threads=[1],max_epoch=100,repeats=10,noise=0.0,device=None,skip_fit=False,seed=0,
+				rotation_reps=None,exercise_frames=120,trc_paths=None):
+	"""
+		rotation_reps: Optional list of ROTATION_REP to compare on the synthetic exercises (and trc_paths with the real SMPL model)
+	"""
+	device = torch.device('cuda' if cuda and torch.cuda.is_available() else 'cpu') if device is None else torch.device(device)
+	logger, writer = get_logger(task_name='Benchmark')
+
+	torch.manual_seed(seed)
+	smpl_layer = synthetic_layer(seed).to(device)
+
+	results = []
+	for num_threads in threads:
+		torch.set_num_threads(num_threads)
+		for batch_size in batch_sizes:
+			runs = [bench_layer(smpl_layer,batch_size,device,repeats=repeats,seed=seed)]
+			if not skip_fit:
+				runs.append(bench_fit(smpl_layer,batch_size,device,logger,writer,max_epoch=max_epoch,noise=noise,seed=seed))
+			for res in runs:
+				res['num_threads'] = num_threads
+				print(json.dumps(res))
+			results.extend(runs)
+
+	if rotation_reps is not None:
+		cfg = SMPLRetarget.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json'))
+		sequences = []
+		for label in EXERCISES:
+			pose,trans = synthetic_exercise(label,exercise_frames,seed=seed)
+			pose,trans = pose.to(device),trans.to(device)
+			sequences.append((label,synthetic_target(smpl_layer,pose,trans,cfg,noise=noise,seed=seed),pose))
+		runs = compare_rotation_reps(sequences,smpl_layer,device,logger,writer,rotation_reps=rotation_reps,max_epoch=max_epoch)
+
+		# Recorded exercises need the real model
+		if trc_paths is not None:
+			sequences = []
+			for trc_path in trc_paths:
+				sample = OpenCapDataLoader(trc_path)
+				sequences.append((sample.name,torch.from_numpy(sample.joints_np).float().to(device),None))
+			runs += compare_rotation_reps(sequences,None,device,logger,writer,rotation_reps=rotation_reps,max_epoch=max_epoch)
+
+		for res in runs:
+			res['num_threads'] = torch.get_num_threads()
+			print(json.dumps(dict([(k,v) for k,v in res.items() if k != 'loss_history'])))
+		results.extend(runs)
+
+	if writer is not None:
+		writer.close()
+
+	return {"meta": {"time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+					 "commit": git_commit(),
+					 "torch": torch.__version__,
+					 "python": platform.python_version(),
+					 "platform": platform.platform(),
+					 "processor": platform.processor(),
+					 "device": str(device),
+					 "cuda_device": torch.cuda.get_device_name(device) if device.type == 'cuda' else None,
+					 "noise": noise,
+					 "seed": seed},
+			"results": results}
+
+
+def compare(old,new):
+	"""
+		Print relative change of every metric for runs present in both benchmark results
+	"""
+	key = lambda res: (res['kind'],res['batch_size'],res['num_threads'],res.get('sequence'),res.get('rotation_rep'))
+	old_results = dict([(key(res),res) for res in old['results']])
+	for res in new['results']:
+		if key(res) not in old_results:
+			continue
+		prev = old_results[key(res)]
+		changes = [f"{k}:{prev[k]:.3f}->{res[k]:.3f} ({100*(res[k]-prev[k])/max(abs(prev[k]),1e-12):+.1f}%)"
+				for k in res if isinstance(res[k],float) and isinstance(prev.get(k),float)]
+		name = f" {res['sequence']} {res['rotation_rep']}" if res['kind'] == 'rotation_rep' else ""
+		print(f"{res['kind']:<6}batch:{res['batch_size']:<5}threads:{res['num_threads']:<3}{name} " + " ".join(changes))
+
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+					prog='Benchmark',
+					description='Benchmarks SMPL_Layer and SMPL retargetting on a synthetic model',
+					epilog='')
+	parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1,16,64]) # Frames per forward / sequence length of the fit
+	parser.add_argument('--threads', type=int, nargs='+', default=[1,torch.get_num_threads()])
+	parser.add_argument('--epochs', type=int, default=100)
+	parser.add_argument('--repeats', type=int, default=10)
+	parser.add_argument('--noise', type=float, default=0.0) # Marker noise std in meters
+	parser.add_argument('--device', default=None)
+	parser.add_argument('--layer-only', action='store_true') # Skip the retargetting fit
+	parser.add_argument('--rotation-reps', nargs='+', default=None) # Compare convergence of ROTATION_REP options, first one is the baseline
+	parser.add_argument('--exercise-frames', type=int, default=120)
+	parser.add_argument('--trc', nargs='+', default=None) # Recorded exercises for --rotation-reps (needs the SMPL model)
+	parser.add_argument('--compare', default=None) # Previous result json to compare against
+	parser.add_argument('-o', '--output', default=None)
+	args = parser.parse_args()
+
+	res = run_benchmark(batch_sizes=args.batch_sizes,threads=sorted(set(args.threads)),max_epoch=args.epochs,repeats=args.repeats,
+						noise=args.noise,device=args.device,skip_fit=args.layer_only,
+						rotation_reps=args.rotation_reps,exercise_frames=args.exercise_frames,trc_paths=args.trc)
+
+	output = args.output
+	if output is None:
+		os.makedirs(BENCHMARK_DIR,exist_ok=True)
+		output = os.path.join(BENCHMARK_DIR,f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+	with open(output,'w') as f:
+		json.dump(res,f,indent=4)
+	print(f"Saved benchmark results to:{output}")
+
+	if args.compare is not None:
+		with open(args.compare,'r') as f:
+			compare(json.load(f),res)
@@ -0,0 +1,69 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from utils import * # Paths
+
+
+# Content addressed cache keys for retargetting results.
+# A result is valid only if it was computed from the same TRC content, the same effective config
+# (Rajagopal_2016.json incl. DATA_MAP) and the same SMPL model file.
+
+CACHE_VERSION = 1
+
+# Config sections that do not change the retargetted parameters
+IGNORED_CONFIG_KEYS = ["TELEMETRY","ONLINE","DEBUG","RABIT"]
+
+_FILE_HASHES = {}
+
+def file_hash(path,block_size=1<<20):
+	"""
+		sha256 of the file content. Memoized per process on (path, size, mtime) since the model file is large.
+	"""
+	stat = os.stat(path)
+	key = (os.path.abspath(path),stat.st_size,stat.st_mtime_ns)
+	if key not in _FILE_HASHES:
+		h = hashlib.sha256()
+		with open(path,'rb') as f:
+			for block in iter(lambda: f.read(block_size),b''):
+				h.update(block)
+		_FILE_HASHES[key] = h.hexdigest()
+	return _FILE_HASHES[key]
+
+
+def config_hash(cfg):
+	"""
+		Hash of the config sections affecting the result
+	"""
+	cfg = dict([(k,v) for k,v in dict(cfg).items() if k not in IGNORED_CONFIG_KEYS])
+	return hashlib.sha256(json.dumps(cfg,sort_keys=True).encode()).hexdigest()
+
+
+def array_hash(arrays):
+	"""
+		Hash of a dict of numpy arrays (eg. calibrated body parameters)
+	"""
+	h = hashlib.sha256()
+	for k in sorted(arrays.keys()):
+		h.update(k.encode())
+		h.update(np.ascontiguousarray(arrays[k],dtype=np.float32).tobytes())
+	return h.hexdigest()
+
+
+def cache_key(trc_paths,cfg,model_path,body_params=None):
+	"""
+		trc_paths: Path or list of paths of the source trc files
+		body_params: Calibrated subject body if used
+	"""
+	if isinstance(trc_paths,str):
+		trc_paths = [trc_paths]
+
+	components = {
+		"version": CACHE_VERSION,
+		"trc": [file_hash(p) for p in trc_paths],
+		"config": config_hash(cfg),
+		"model": file_hash(model_path) if os.path.isfile(model_path) else None,
+		"body": array_hash(body_params) if body_params is not None else None,
+	}
+	return hashlib.sha256(json.dumps(components,sort_keys=True).encode()).hexdigest()
@@ -70,6 +70,13 @@ class OpenCapDataLoader:
 			raise KeyError(f'{sample_path} does not match regex')
 
 
+	@staticmethod
+	def get_name(sample_path):
+		# Sample name (openCapID_label_mcs) from the path without reading the file
+		openCapID = next(filter(lambda x: "OpenCapData" in x,sample_path.split('/'))).split('_')[-1]
+		label,mcs = OpenCapDataLoader.get_label(os.path.basename(sample_path))
+		return f"{openCapID}_{label}_{mcs}"
+
 	@staticmethod
 	def load_trc(sample_path):		
 		assert '.trc' == sample_path[-4:], f"Filename:{sample_path} not a OpenSim trc file" 
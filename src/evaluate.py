@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+import json
+import argparse
+import numpy as np
+from easydict import EasyDict as edict
+
+# DL Modules
+import torch
+
+# Modules
+from utils import * # Paths and config
+from dataloader import OpenCapDataLoader
+from smplpytorch.pytorch.smpl_layer import SMPL_Layer
+from store import find_smpl_result, load_smpl
+
+EVALUATION_DIR = os.path.join(LOG_DIR,'evaluation')
+
+
+# Dataset wide retargetting accuracy.
+# All sequences are concatenated into one frame batch, joints are computed with joints_only forwards in chunks
+# and the per sequence statistics are reduced with index_add over the sequence id of every frame.
+#
+# Metrics (millimeters unless noted)
+#	mpjpe               mean distance between SMPL joints and TRC joints over the DATA_MAP pairs
+#	mpjpe_offset        same for the offset joints (second output used by the retargetting loss)
+#	bone_error          |SMPL bone length - TRC bone length| for TRC bones whose both ends are mapped
+#	bone_std            std over frames of the TRC bone lengths (marker inconsistency)
+#	jitter              mean acceleration magnitude of the SMPL joints (m/s^2)
+#	source_jitter       same for the TRC joints
+
+
+def load_config():
+	with open(os.path.join(HOME_DIR,'Rajagopal_2016.json'), 'r') as f:
+		return edict(json.load(f))
+
+
+def load_sequences(dataset_dir=DATASET_DIR):
+	"""
+		Source TRC and retargetting result of every sequence that has been retargetted
+		Returns list of dicts (name, subject, label, fps, target (T x 20 x 3), smpl (dict of arrays)), names of skipped sequences
+	"""
+	sequences = []
+	skipped = []
+	for subject in sorted(os.listdir(dataset_dir)):
+		marker_dir = os.path.join(dataset_dir,subject,'MarkerData')
+		if not os.path.isdir(marker_dir):
+			continue
+		for file in sorted(os.listdir(marker_dir)):
+			if not file.endswith('.trc'):
+				continue
+			sample_path = os.path.join(marker_dir,file)
+			result_path = find_smpl_result(OpenCapDataLoader.get_name(sample_path))
+			if result_path is None:
+				skipped.append(sample_path)
+				continue
+
+			sample = OpenCapDataLoader(sample_path)
+			smpl = load_smpl(result_path)
+			if smpl['pose_params'].shape[0] != sample.num_frames:
+				print(f"Skipping:{sample.name}, result has {smpl['pose_params'].shape[0]} frames, trc has {sample.num_frames}")
+				skipped.append(sample_path)
+				continue
+
+			sequences.append({"name":sample.name,"subject":sample.openCapID,"label":sample.label,"fps":sample.fps,
+							"target":sample.joints_np,"smpl":smpl})
+	return sequences,skipped
+
+
+def concat_sequences(sequences):
+	"""
+		Stack all frames. Per sequence parameters (shape, scale, offset) are repeated per frame.
+	"""
+	num_frames = [len(seq['target']) for seq in sequences]
+	repeat = lambda k: np.concatenate([np.repeat(np.asarray(seq['smpl'][k],dtype=np.float32).reshape(1,-1),n,axis=0) for seq,n in zip(sequences,num_frames)])
+
+	batch = {
+		"pose_params": np.concatenate([seq['smpl']['pose_params'] for seq in sequences]),
+		"trans": np.concatenate([seq['smpl']['trans'] for seq in sequences]),
+		"shape_params": repeat('shape_params'),
+		"scale": repeat('scale'),
+		"offset": repeat('offset').reshape(-1,24,3),
+		"target": np.concatenate([seq['target'] for seq in sequences]),
+		"seq_id": np.repeat(np.arange(len(sequences)),num_frames),
+	}
+	return dict([(k,torch.from_numpy(np.ascontiguousarray(v))) for k,v in batch.items()])
+
+
+@torch.no_grad()
+def smpl_joints(smpl_layer,batch,device,chunk_size=4096):
+	"""
+		Joints and offset joints (N x 24 x 3) of all frames, same transform as SMPLRetarget.forward
+	"""
+	Jtr,Jtr_offset = [],[]
+	for start in range(0,len(batch['pose_params']),chunk_size):
+		chunk = dict([(k,batch[k][start:start+chunk_size].to(device).float()) for k in ["pose_params","trans","shape_params","scale","offset"]])
+		_,J,J_offset = smpl_layer(chunk['pose_params'],th_betas=chunk['shape_params'],th_offset=chunk['offset'],joints_only=True)
+		scale = chunk['scale'].view(-1,1,1)
+		trans = chunk['trans'].unsqueeze(1)
+		Jtr.append(J*scale + trans)
+		Jtr_offset.append(J_offset*scale + trans)
+	return torch.cat(Jtr),torch.cat(Jtr_offset)
+
+
+def per_sequence_mean(values,seq_id,num_sequences,mask=None):
+	"""
+		Mean of values (N x ...) over the frames of every sequence -> (num_sequences x ...)
+	"""
+	if mask is None:
+		mask = torch.ones(len(values),dtype=values.dtype,device=values.device)
+	mask = mask.to(values.dtype)
+	weights = mask.view(-1,*([1]*(values.dim()-1)))
+	sums = torch.zeros((num_sequences,*values.shape[1:]),dtype=values.dtype,device=values.device).index_add_(0,seq_id,values*weights)
+	counts = torch.zeros(num_sequences,dtype=values.dtype,device=values.device).index_add_(0,seq_id,mask)
+	return sums/counts.clamp(min=1).view(-1,*([1]*(values.dim()-1)))
+
+
+def acceleration(joints,seq_id,fps):
+	"""
+		Second finite difference (m/s^2) per frame, masked where the stencil crosses a sequence boundary
+	"""
+	acc = torch.zeros_like(joints[...,0])
+	mask = torch.zeros(len(joints),dtype=torch.bool,device=joints.device)
+	if len(joints) > 2:
+		acc[1:-1] = (joints[2:] - 2*joints[1:-1] + joints[:-2]).norm(dim=-1)*fps[1:-1].view(-1,1)**2
+		mask[1:-1] = (seq_id[2:] == seq_id[:-2])
+	return acc.mean(dim=1),mask
+
+
+def evaluate(sequences,cfg,device,chunk_size=4096,outlier_z=3.5):
+	"""
+		Returns dict with per sequence metrics, per joint MPJPE, aggregates by label/subject and outliers
+	"""
+	num_sequences = len(sequences)
+	batch = concat_sequences(sequences)
+	seq_id = batch['seq_id'].to(device)
+
+	smpl_layer = SMPL_Layer(center_idx=0,gender=cfg.MODEL.GENDER,model_root=SMPL_MODEL_DIR).to(device)
+	Jtr,Jtr_offset = smpl_joints(smpl_layer,batch,device,chunk_size=chunk_size)
+	target = batch['target'].to(device).float()
+
+	smpl_index = torch.LongTensor([x[0] for x in cfg.DATASET.DATA_MAP]).to(device)
+	dataset_index = torch.LongTensor([x[1] for x in cfg.DATASET.DATA_MAP]).to(device)
+
+	# Joint errors (N x pairs)
+	joint_error = (Jtr[:,smpl_index] - target[:,dataset_index]).norm(dim=-1)
+	joint_error_offset = (Jtr_offset[:,smpl_index] - target[:,dataset_index]).norm(dim=-1)
+	frame_mpjpe = joint_error.mean(dim=1)
+
+	# Bones of the TRC skeleton with both joints mapped to SMPL
+	dataset2smpl = dict([(d,s) for s,d in cfg.DATASET.DATA_MAP])
+	bones = [(child,parent) for child,parent in enumerate(cfg.DATASET.PARENT_ARRAY) if child != parent and child in dataset2smpl and parent in dataset2smpl]
+	child = torch.LongTensor([b[0] for b in bones]).to(device)
+	parent = torch.LongTensor([b[1] for b in bones]).to(device)
+	smpl_child = torch.LongTensor([dataset2smpl[b[0]] for b in bones]).to(device)
+	smpl_parent = torch.LongTensor([dataset2smpl[b[1]] for b in bones]).to(device)
+	source_bones = (target[:,child] - target[:,parent]).norm(dim=-1)
+	smpl_bones = (Jtr[:,smpl_child] - Jtr[:,smpl_parent]).norm(dim=-1)
+
+	source_bone_mean = per_sequence_mean(source_bones,seq_id,num_sequences)
+	source_bone_var = per_sequence_mean((source_bones - source_bone_mean[seq_id])**2,seq_id,num_sequences)
+
+	# Temporal jitter
+	fps = torch.FloatTensor([seq['fps'] for seq in sequences]).to(device)[seq_id]
+	jitter,jitter_mask = acceleration(Jtr,seq_id,fps)
+	source_jitter,_ = acceleration(target,seq_id,fps)
+
+	metrics = {
+		"mpjpe": 1e3*per_sequence_mean(frame_mpjpe,seq_id,num_sequences),
+		"mpjpe_offset": 1e3*per_sequence_mean(joint_error_offset.mean(dim=1),seq_id,num_sequences),
+		"max_frame_mpjpe": 1e3*torch.zeros(num_sequences,device=device).scatter_reduce_(0,seq_id,frame_mpjpe,'amax',include_self=False),
+		"bone_error": 1e3*per_sequence_mean((smpl_bones - source_bones).abs().mean(dim=1),seq_id,num_sequences),
+		"bone_std": 1e3*source_bone_var.sqrt().mean(dim=1),
+		"jitter": per_sequence_mean(jitter,seq_id,num_sequences,mask=jitter_mask),
+		"source_jitter": per_sequence_mean(source_jitter,seq_id,num_sequences,mask=jitter_mask),
+	}
+	per_joint = 1e3*per_sequence_mean(joint_error,seq_id,num_sequences)
+
+	# Single host copy
+	metrics = dict([(k,v.cpu().numpy()) for k,v in metrics.items()])
+	per_joint = per_joint.cpu().numpy()
+
+	res = {"sequences": [], "per_joint": {}, "label": {}, "subject": {}, "outliers": []}
+	for i,seq in enumerate(sequences):
+		res['sequences'].append(dict([("name",seq['name']),("subject",seq['subject']),("label",seq['label']),("num_frames",len(seq['target']))]
+								+ [(k,float(v[i])) for k,v in metrics.items()]))
+
+	pair_names = [f"{JOINT_NAMES[d]}" for s,d in cfg.DATASET.DATA_MAP]
+	for j,name in enumerate(pair_names):
+		res['per_joint'][name] = float(per_joint[:,j].mean())
+
+	for group in ["label","subject"]:
+		keys = np.array([seq[group] for seq in sequences])
+		for key in sorted(set(keys)):
+			ind = keys == key
+			res[group][key] = dict([("num_sequences",int(ind.sum()))] + [(k,float(v[ind].mean())) for k,v in metrics.items()])
+
+	# Robust z-score (median absolute deviation) of the error and jitter
+	for k in ["mpjpe","jitter"]:
+		values = metrics[k]
+		mad = np.median(np.abs(values - np.median(values)))
+		z = 0.6745*(values - np.median(values))/max(mad,1e-9)
+		for i in np.where(z > outlier_z)[0]:
+			res['outliers'].append({"name":sequences[i]['name'],"metric":k,"value":float(values[i]),"z":float(z[i])})
+
+	res['frame_mpjpe'] = 1e3*frame_mpjpe.cpu().numpy()
+	return res
+
+
+def print_report(res):
+	columns = ["mpjpe","mpjpe_offset","bone_error","bone_std","jitter","source_jitter"]
+	for group in ["label","subject"]:
+		print(f"{group:<20}{'N':>5}" + "".join([f"{k:>15}" for k in columns]))
+		for key,v in res[group].items():
+			print(f"{key:<20}{v['num_sequences']:>5}" + "".join([f"{v[k]:>15.2f}" for k in columns]))
+		print()
+
+	print("Per joint MPJPE (mm): " + " ".join([f"{k}:{v:.1f}" for k,v in res['per_joint'].items()]))
+	for outlier in res['outliers']:
+		print(f"Outlier: {outlier['name']:<30}{outlier['metric']}={outlier['value']:.2f} z={outlier['z']:.1f}")
+
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+					prog='Evaluate',
+					description='Retargetting accuracy over the complete dataset',
+					epilog='')
+	parser.add_argument('--chunk-size', type=int, default=4096) # Frames per joints-only forward
+	parser.add_argument('--outlier-z', type=float, default=3.5) # Robust z-score above which a sequence is flagged
+	parser.add_argument('-o', '--output', default=os.path.join(EVALUATION_DIR,'evaluation.json'))
+	args = parser.parse_args()
+
+	device = torch.device('cuda' if cuda and torch.cuda.is_available() else 'cpu')
+	cfg = load_config()
+
+	start = time.time()
+	sequences,skipped = load_sequences()
+	assert len(sequences) > 0, f"No retargetted sequences found in:{SMPL_DIR}"
+	print(f"Loaded {len(sequences)} sequences ({len(skipped)} not retargetted) in {time.time()-start:.2f}s")
+
+	start = time.time()
+	res = evaluate(sequences,cfg,device,chunk_size=args.chunk_size,outlier_z=args.outlier_z)
+	print(f"Evaluated {len(res['frame_mpjpe'])} frames in {time.time()-start:.2f}s")
+	print_report(res)
+
+	os.makedirs(os.path.dirname(os.path.abspath(args.output)),exist_ok=True)
+	frame_mpjpe = res.pop('frame_mpjpe')
+	res['skipped'] = skipped
+	with open(args.output,'w') as f:
+		json.dump(res,f,indent=4)
+	np.savez(args.output.replace('.json','_frames.npz'),frame_mpjpe=frame_mpjpe,
+			names=np.array([seq['name'] for seq in sequences]),num_frames=np.array([len(seq['target']) for seq in sequences]))
+	print(f"Saved evaluation to:{args.output}")
@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import json
+import contextlib
+import numpy as np
+
+import torch
+
+from utils import * # Paths
+
+PROFILE_DIR = os.path.join(LOG_DIR,'profile')
+
+
+# Stage level timers for the retargetting pipeline.
+# Disabled profilers hand out a shared null context so the instrumented code pays nothing.
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+class StageProfiler:
+	def __init__(self,enabled=False,trace_epochs=None,device=None):
+		"""
+			enabled: Time stages, else every call is a no-op
+			trace_epochs: Optional (start,end) epoch range to record a torch profiler (chrome) trace
+			device: Synchronize cuda before reading the clock if the device is cuda
+		"""
+		self.enabled = enabled
+		self.trace_epochs = trace_epochs
+		self.sync = enabled and device is not None and torch.device(device).type == 'cuda'
+		self.reset()
+
+	def reset(self,name=None):
+		"""
+			Start a new sequence
+		"""
+		self.name = name
+		self.times = {}
+		self.counts = {}
+		self.torch_profiler = None
+		self.traced = False
+
+	def stage(self,name):
+		"""
+			with profiler.stage('forward'): ...
+		"""
+		if not self.enabled:
+			return _NULL_CONTEXT
+		return self._timer(name)
+
+	@contextlib.contextmanager
+	def _timer(self,name):
+		if self.sync:
+			torch.cuda.synchronize()
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			if self.sync:
+				torch.cuda.synchronize()
+			self.times[name] = self.times.get(name,0) + time.perf_counter() - start
+			self.counts[name] = self.counts.get(name,0) + 1
+
+	def epoch(self,epoch):
+		"""
+			Call at the start of every optimization epoch to start/stop the torch profiler trace
+		"""
+		if not self.enabled or self.trace_epochs is None or self.traced:
+			return
+
+		start,end = self.trace_epochs
+		if epoch == start and self.torch_profiler is None:
+			activities = [torch.profiler.ProfilerActivity.CPU]
+			if torch.cuda.is_available():
+				activities.append(torch.profiler.ProfilerActivity.CUDA)
+			self.torch_profiler = torch.profiler.profile(activities=activities,record_shapes=True)
+			self.torch_profiler.__enter__()
+		elif epoch == end and self.torch_profiler is not None:
+			self.stop_trace()
+
+	def stop_trace(self):
+		if self.torch_profiler is None:
+			return
+		self.torch_profiler.__exit__(None,None,None)
+		os.makedirs(PROFILE_DIR,exist_ok=True)
+		self.torch_profiler.export_chrome_trace(os.path.join(PROFILE_DIR,f"{self.name}_trace.json"))
+		self.torch_profiler = None
+		self.traced = True
+
+	def record(self,**info):
+		"""
+			Per sequence record: seconds and number of calls for every stage
+		"""
+		res = dict(info)
+		res['name'] = self.name
+		res['stages'] = dict([(k,{"time":self.times[k],"count":self.counts[k]}) for k in self.times])
+		return res
+
+	def save(self,**info):
+		"""
+			Write PROFILE_DIR/<name>.json
+		"""
+		if not self.enabled:
+			return None
+		self.stop_trace()
+		os.makedirs(PROFILE_DIR,exist_ok=True)
+		record = self.record(**info)
+		with open(os.path.join(PROFILE_DIR,f"{self.name}.json"),'w') as f:
+			json.dump(record,f,indent=4)
+		return record
+
+
+def load_records(profile_dir=PROFILE_DIR):
+	records = []
+	for file in sorted(os.listdir(profile_dir)):
+		if not file.endswith('.json') or file.endswith('_trace.json'):
+			continue
+		with open(os.path.join(profile_dir,file),'r') as f:
+			records.append(json.load(f))
+	return records
+
+
+def report(records):
+	"""
+		Dataset level p50/p95 (seconds per sequence) for every stage
+	"""
+	stages = {}
+	for record in records:
+		for k,v in record['stages'].items():
+			stages.setdefault(k,[]).append(v['time'])
+
+	lines = [f"Profiled sequences:{len(records)}",f"{'Stage':<20}{'p50 (s)':>12}{'p95 (s)':>12}{'total (s)':>12}"]
+	for k,times in sorted(stages.items(),key=lambda x: -sum(x[1])):
+		lines.append(f"{k:<20}{np.percentile(times,50):>12.4f}{np.percentile(times,95):>12.4f}{np.sum(times):>12.2f}")
+	res = "\n".join(lines)
+	print(res)
+	return res
+
+
+
+if __name__ == "__main__":
+	# Print aggregated report of the saved records
+	report(load_records(sys.argv[1] if len(sys.argv) > 1 else PROFILE_DIR))
@@ -0,0 +1,309 @@
+import os
+import zlib
+import logging
+import struct
+import numpy as np
+
+from utils import * # Render settings
+
+
+# Headless software renderer for the Visualizer (renderer.py), needs no display or OpenGL context.
+# HeadlessScene implements the subset of the polyscope API used by the Visualizer so both backends share the camera logic.
+# Surface meshes (flat shaded, optionally transparent), curve networks and point clouds are rasterized with NumPy
+# into in-memory RGB frames (HeadlessScene.render).
+
+DEFAULT_COLOR = np.array([0.55,0.7,0.9])
+DEFAULT_RADIUS = 0.005 # Relative to the length scale of the scene, as in polyscope
+FRAGMENTS_PER_CHUNK = 1 << 22
+
+
+def write_png(path,image,compress_level=1):
+	"""
+		Save an RGB or RGBA uint8 image (H x W x 3|4) as png with the standard library only
+	"""
+	image = np.ascontiguousarray(image,dtype=np.uint8)
+	h,w,c = image.shape
+	raw = np.concatenate([np.zeros((h,1),dtype=np.uint8),image.reshape(h,w*c)],axis=1).tobytes()
+	def chunk(tag,data):
+		return struct.pack('>I',len(data)) + tag + data + struct.pack('>I',zlib.crc32(tag + data) & 0xffffffff)
+	with open(path,'wb') as f:
+		f.write(b'\x89PNG\r\n\x1a\n'
+			+ chunk(b'IHDR',struct.pack('>IIBBBBB',w,h,8,6 if c == 4 else 2,0,0,0))
+			+ chunk(b'IDAT',zlib.compress(raw,compress_level))
+			+ chunk(b'IEND',b''))
+
+
+class HeadlessStructure:
+	def __init__(self,points,color,enabled=True):
+		self.points = np.asarray(points,dtype=np.float64).reshape(-1,3)
+		self.color = DEFAULT_COLOR if color is None else np.asarray(color,dtype=np.float64)
+		self.enabled = enabled
+
+	def set_enabled(self,enabled=True):
+		self.enabled = enabled
+
+	def set_color(self,color):
+		self.color = np.asarray(color,dtype=np.float64)
+
+
+class HeadlessMesh(HeadlessStructure):
+	def __init__(self,vertices,faces,color=None,transparency=1.0,enabled=True):
+		super().__init__(vertices,color,enabled)
+		self.faces = np.asarray(faces,dtype=np.int64).reshape(-1,3)
+		self.transparency = transparency
+
+	def update_vertex_positions(self,vertices):
+		self.points = np.asarray(vertices,dtype=np.float64).reshape(-1,3)
+
+	def set_transparency(self,transparency):
+		self.transparency = transparency
+
+
+class HeadlessCurveNetwork(HeadlessStructure):
+	def __init__(self,nodes,edges,color=None,radius=DEFAULT_RADIUS,enabled=True):
+		super().__init__(nodes,color,enabled)
+		self.edges = np.asarray(edges,dtype=np.int64).reshape(-1,2)
+		self.radius = radius
+
+	def update_node_positions(self,nodes):
+		self.points = np.asarray(nodes,dtype=np.float64).reshape(-1,3)
+
+
+class HeadlessPointCloud(HeadlessStructure):
+	def __init__(self,points,color=None,radius=DEFAULT_RADIUS,enabled=True):
+		super().__init__(points,color,enabled)
+		self.radius = radius
+
+	def update_point_positions(self,points):
+		self.points = np.asarray(points,dtype=np.float64).reshape(-1,3)
+
+
+class HeadlessScene:
+	"""
+		Drop-in for the polyscope module in the Visualizer.
+		resolution: (width, height) of the frames
+		fov: vertical field of view in degrees (polyscope default)
+	"""
+	def __init__(self,resolution=RENDER_RESOLUTION,fov=45.0,background=(1.0,1.0,1.0)):
+		self.width,self.height = int(resolution[0]),int(resolution[1])
+		self.fov = fov
+		self.background = np.asarray(background,dtype=np.float64)
+		self.structures = {}
+		self.look_at(np.array([0.0,0.0,3.0]),np.zeros(3))
+
+	# Polyscope settings without an effect on the software renderer
+	def init(self): pass
+	def set_automatically_compute_scene_extents(self,value): pass
+	def set_navigation_style(self,style): pass
+	def set_ground_plane_mode(self,mode): pass
+	def set_screenshot_extension(self,extension): pass
+
+	def set_window_size(self,width,height):
+		self.width,self.height = int(width),int(height)
+		self.focal = 0.5*self.height/np.tan(np.deg2rad(self.fov)/2)
+
+	def show(self):
+		# Same logger as utils.get_logger
+		logging.getLogger('utils').warning("Headless renderer has no window, pass video_dir to render the frames")
+
+	def remove_all_structures(self):
+		self.structures = {}
+
+	def register_surface_mesh(self,name,vertices,faces,color=None,transparency=1.0,enabled=True,**kwargs):
+		self.structures[name] = HeadlessMesh(vertices,faces,color=color,transparency=transparency,enabled=enabled)
+		return self.structures[name]
+
+	def register_curve_network(self,name,nodes,edges,color=None,radius=DEFAULT_RADIUS,enabled=True,**kwargs):
+		self.structures[name] = HeadlessCurveNetwork(nodes,edges,color=color,radius=radius,enabled=enabled)
+		return self.structures[name]
+
+	def register_point_cloud(self,name,points,color=None,radius=DEFAULT_RADIUS,enabled=True,**kwargs):
+		self.structures[name] = HeadlessPointCloud(points,color=color,radius=radius,enabled=enabled)
+		return self.structures[name]
+
+	def look_at(self,camera_location,target):
+		"""
+			Camera at camera_location looking at target, y is up (polyscope default)
+		"""
+		self.camera = np.asarray(camera_location,dtype=np.float64).reshape(3)
+		forward = np.asarray(target,dtype=np.float64).reshape(3) - self.camera
+		forward /= max(np.linalg.norm(forward),1e-12)
+		up = np.array([0.0,1.0,0.0]) if abs(forward[1]) < 0.999 else np.array([0.0,0.0,-1.0])
+		right = np.cross(forward,up)
+		right /= np.linalg.norm(right)
+		self.rotation = np.stack([right,np.cross(right,forward),forward]) # world -> camera (x right, y up, z forward)
+		self.focal = 0.5*self.height/np.tan(np.deg2rad(self.fov)/2)
+
+	def project(self,points):
+		"""
+			Pixel coordinates (x right, y down) and depth along the view direction of points (N x 3)
+		"""
+		p = (points - self.camera) @ self.rotation.T
+		z = p[:,2]
+		safe_z = np.where(z > 1e-6,z,1e-6)
+		x = 0.5*self.width + self.focal*p[:,0]/safe_z
+		y = 0.5*self.height - self.focal*p[:,1]/safe_z
+		return x,y,z
+
+	def length_scale(self):
+		points = [s.points for s in self.structures.values() if s.enabled and len(s.points) > 0]
+		if len(points) == 0:
+			return 1.0
+		points = np.concatenate(points,axis=0)
+		return max(float(np.linalg.norm(points.max(axis=0) - points.min(axis=0))),1e-6)
+
+	def _rasterize_mesh(self,mesh):
+		"""
+			Fragments (pixel, inverse depth, rgb) of the triangles of a mesh, flat shaded with a head light
+		"""
+		x,y,z = self.project(mesh.points)
+		faces = mesh.faces[(z[mesh.faces] > 1e-6).all(axis=1)]
+		tx,ty,tz = x[faces],y[faces],z[faces]
+
+		# Clipped pixel bounding box of every triangle
+		x0 = np.clip(np.floor(tx.min(axis=1)),0,self.width).astype(np.int64)
+		x1 = np.clip(np.ceil(tx.max(axis=1)),0,self.width).astype(np.int64)
+		y0 = np.clip(np.floor(ty.min(axis=1)),0,self.height).astype(np.int64)
+		y1 = np.clip(np.ceil(ty.max(axis=1)),0,self.height).astype(np.int64)
+		area = (tx[:,1] - tx[:,0])*(ty[:,2] - ty[:,0]) - (tx[:,2] - tx[:,0])*(ty[:,1] - ty[:,0])
+		keep = (x1 > x0) & (y1 > y0) & (np.abs(area) > 1e-12)
+		faces,tx,ty,tz,x0,x1,y0,y1,area = faces[keep],tx[keep],ty[keep],tz[keep],x0[keep],x1[keep],y0[keep],y1[keep],area[keep]
+
+		# Lambert shading of every face lit from the camera, both sides
+		v = mesh.points[faces]
+		normals = np.cross(v[:,1] - v[:,0],v[:,2] - v[:,0])
+		view = self.camera - v.mean(axis=1)
+		cos = np.abs((normals*view).sum(axis=1))/np.maximum(np.linalg.norm(normals,axis=1)*np.linalg.norm(view,axis=1),1e-12)
+		face_colors = mesh.color[None]*(0.35 + 0.65*cos[:,None])
+
+		# Candidate pixels of the bounding boxes, chunked over triangles to bound memory
+		w = x1 - x0
+		counts = w*(y1 - y0)
+		ends = np.cumsum(counts)
+		fragments = []
+		start = 0
+		while start < len(faces):
+			stop = max(int(np.searchsorted(ends,(ends[start] - counts[start]) + FRAGMENTS_PER_CHUNK,side='right')),start + 1)
+			chunk_counts = counts[start:stop]
+			fid = np.repeat(np.arange(start,stop),chunk_counts)
+			local = np.arange(len(fid)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts,chunk_counts)
+			px = x0[fid] + local % w[fid]
+			py = y0[fid] + local // w[fid]
+			cx,cy = px + 0.5,py + 0.5
+
+			# Barycentric coordinates from the edge functions
+			ftx,fty = tx[fid],ty[fid]
+			b0 = ((ftx[:,1] - cx)*(fty[:,2] - cy) - (ftx[:,2] - cx)*(fty[:,1] - cy))/area[fid]
+			b1 = ((ftx[:,2] - cx)*(fty[:,0] - cy) - (ftx[:,0] - cx)*(fty[:,2] - cy))/area[fid]
+			b2 = 1 - b0 - b1
+			inside = (b0 >= 0) & (b1 >= 0) & (b2 >= 0)
+			fid,px,py = fid[inside],px[inside],py[inside]
+			# Inverse depth is linear in screen space
+			inv_z = b0[inside]/tz[fid,0] + b1[inside]/tz[fid,1] + b2[inside]/tz[fid,2]
+			fragments.append((py*self.width + px,inv_z,face_colors[fid]))
+			start = stop
+
+		if len(fragments) == 0:
+			return np.zeros(0,dtype=np.int64),np.zeros(0),np.zeros((0,3))
+		return tuple(np.concatenate(f,axis=0) for f in zip(*fragments))
+
+	def _splat(self,x,y,z,radius,color):
+		"""
+			Fragments of discs of radius (pixels) centered at projected points
+		"""
+		keep = (z > 1e-6) & (x > -radius) & (x < self.width + radius) & (y > -radius) & (y < self.height + radius)
+		x,y,z,radius,color = x[keep],y[keep],z[keep],radius[keep],color[keep]
+		pix,inv_z,rgb = [],[],[]
+		for r in np.unique(radius):
+			sel = radius == r
+			oy,ox = np.mgrid[-r:r+1,-r:r+1]
+			disc = ox**2 + oy**2 <= r**2 + r
+			ox,oy = ox[disc],oy[disc]
+			px = (np.floor(x[sel])[:,None] + ox[None]).astype(np.int64).ravel()
+			py = (np.floor(y[sel])[:,None] + oy[None]).astype(np.int64).ravel()
+			inside = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+			pix.append((py*self.width + px)[inside])
+			inv_z.append(np.repeat(1/z[sel],len(ox))[inside])
+			rgb.append(np.repeat(color[sel],len(ox),axis=0)[inside])
+		if len(pix) == 0:
+			return np.zeros(0,dtype=np.int64),np.zeros(0),np.zeros((0,3))
+		return np.concatenate(pix),np.concatenate(inv_z),np.concatenate(rgb,axis=0)
+
+	def _rasterize_curves(self,curves,length_scale):
+		"""
+			Fragments of the edges of curve networks, sampled every pixel, and of point clouds
+		"""
+		xs,ys,zs,rs,cs = [],[],[],[],[]
+		for curve in curves:
+			x,y,z = self.project(curve.points)
+			radius_px = lambda depth: np.maximum(np.round(curve.radius*length_scale*self.focal/np.maximum(depth,1e-6)),1).astype(np.int64)
+			if isinstance(curve,HeadlessPointCloud):
+				xs.append(x); ys.append(y); zs.append(z); rs.append(radius_px(z)); cs.append(np.repeat(curve.color[None],len(x),axis=0))
+				continue
+			e = curve.edges
+			if len(e) == 0:
+				continue
+			samples = np.ceil(np.hypot(x[e[:,1]] - x[e[:,0]],y[e[:,1]] - y[e[:,0]])).clip(0,4*(self.width + self.height)).astype(np.int64) + 1
+			eid = np.repeat(np.arange(len(e)),samples)
+			t = (np.arange(len(eid)) - np.repeat(np.cumsum(samples) - samples,samples))/np.maximum(samples[eid] - 1,1)
+			# Interpolate in 3D so the depth of the samples is exact
+			p = curve.points[e[eid,0]]*(1 - t[:,None]) + curve.points[e[eid,1]]*t[:,None]
+			x,y,z = self.project(p)
+			xs.append(x); ys.append(y); zs.append(z); rs.append(radius_px(z)); cs.append(np.repeat(curve.color[None],len(x),axis=0))
+		if len(xs) == 0:
+			return np.zeros(0,dtype=np.int64),np.zeros(0),np.zeros((0,3))
+		return self._splat(np.concatenate(xs),np.concatenate(ys),np.concatenate(zs),np.concatenate(rs),np.concatenate(cs,axis=0))
+
+	@staticmethod
+	def _nearest(pix,inv_z):
+		"""
+			Index of the nearest fragment of every covered pixel (z-buffer)
+		"""
+		order = np.lexsort((-inv_z,pix))
+		first = np.ones(len(order),dtype=bool)
+		first[1:] = pix[order][1:] != pix[order][:-1]
+		return order[first]
+
+	def render(self):
+		"""
+			Current frame as an RGB uint8 array (height x width x 3)
+		"""
+		image = np.repeat(self.background[None],self.width*self.height,axis=0)
+		meshes = [s for s in self.structures.values() if s.enabled and isinstance(s,HeadlessMesh)]
+		curves = [s for s in self.structures.values() if s.enabled and not isinstance(s,HeadlessMesh)]
+
+		# Nearest surface of all meshes, blended over the background by its transparency
+		mesh_inv_z = np.zeros(self.width*self.height)
+		mesh_rgb = np.zeros((self.width*self.height,3))
+		mesh_alpha = np.zeros(self.width*self.height)
+		fragments = [self._rasterize_mesh(mesh) + (mesh.transparency,) for mesh in meshes]
+		if len(fragments) > 0:
+			pix = np.concatenate([f[0] for f in fragments])
+			inv_z = np.concatenate([f[1] for f in fragments])
+			rgb = np.concatenate([f[2] for f in fragments],axis=0)
+			alpha = np.concatenate([np.full(len(f[0]),f[3]) for f in fragments])
+			nearest = self._nearest(pix,inv_z)
+			pix = pix[nearest]
+			mesh_inv_z[pix],mesh_rgb[pix],mesh_alpha[pix] = inv_z[nearest],rgb[nearest],alpha[nearest]
+			image[pix] = alpha[nearest,None]*rgb[nearest] + (1 - alpha[nearest,None])*image[pix]
+
+		# Curves and points are drawn over the meshes, seen through transparent surfaces when behind them
+		pix,inv_z,rgb = self._rasterize_curves(curves,self.length_scale())
+		if len(pix) > 0:
+			nearest = self._nearest(pix,inv_z)
+			pix,inv_z,rgb = pix[nearest],inv_z[nearest],rgb[nearest]
+			behind = inv_z < mesh_inv_z[pix]
+			alpha = np.where(behind,mesh_alpha[pix],0)[:,None]
+			image[pix] = alpha*mesh_rgb[pix] + (1 - alpha)*rgb
+
+		return (image.reshape(self.height,self.width,3).clip(0,1)*255).round().astype(np.uint8)
+
+	def screenshot_to_buffer(self,transparent_bg=False):
+		"""
+			RGBA frame, same layout as polyscope.screenshot_to_buffer
+		"""
+		rgb = self.render()
+		return np.concatenate([rgb,np.full(rgb.shape[:2] + (1,),255,dtype=np.uint8)],axis=2)
+
+	def screenshot(self,filename,transparent_bg=False):
+		write_png(filename,self.render())
@@ -1,29 +1,121 @@
 import os 
 import sys
+import json
+import argparse
+import time
+import traceback
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np 
+import torch
 from tqdm import tqdm
-import polyscope as ps 
-import trimesh 
+
+# Rendering libraries are optional so the retargetting modules can be imported on headless machines (eg. benchmark.py)
+# Without polyscope (or a display) the Visualizer uses the NumPy software renderer (rasterizer.py)
+try: 
+	import polyscope as ps 
+except ModuleNotFoundError as e: 
+	print(f"Unable to load rendering libraries:{e}. Using the headless renderer.")
+	ps = None 
+try: 
+	import trimesh 
+except ModuleNotFoundError as e: 
+	trimesh = None
 
 from utils import * 
 from dataloader import OpenCapDataLoader
+from store import ArrayStore, rabit_mesh_path, load_rabit_mesh
+from rasterizer import HeadlessScene
+from video import VideoEncoder
+from cache import file_hash
 
-class Visualizer: 
-	def __init__(self): 
-		
-		ps.init()
 
-		ps.remove_all_structures()
+def rendering_backend(backend=RENDER_BACKEND):
+	"""
+		Resolve 'auto': polyscope if it is installed and a display is available, the headless NumPy renderer otherwise
+	"""
+	if backend == 'auto':
+		has_display = os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')
+		backend = 'polyscope' if ps is not None and has_display else 'numpy'
+	assert backend in ['polyscope','numpy'], f"Unknown rendering backend:{backend}"
+	return backend
+
+
+class Visualizer: 
+	def __init__(self,backend=RENDER_BACKEND,resolution=RENDER_RESOLUTION,preview=False): 
+		"""
+			backend: 'polyscope' (OpenGL), 'numpy' (headless, frames rendered in memory) or 'auto'
+			resolution: (width, height) of the frames
+			preview: render short low resolution skeleton clips by default (see video_frames)
+		"""
+		self.backend = rendering_backend(backend)
+		self.resolution = resolution
+		self.preview = preview
+		if self.backend == 'polyscope':
+			assert ps is not None, "polyscope is required for the polyscope backend"
+			self.ps = ps
+		else:
+			self.ps = HeadlessScene(resolution=resolution)
+
+		self.ps.init()
+
+		self.ps.remove_all_structures()
 		# Set camera 
-		ps.set_automatically_compute_scene_extents(True)
-		ps.set_navigation_style("free")
+		self.ps.set_automatically_compute_scene_extents(True)
+		self.ps.set_navigation_style("free")
 		# ps.set_view_projection_mode("orthographic")
-		ps.set_ground_plane_mode('shadow_only')
+		self.ps.set_ground_plane_mode('shadow_only')
+
+	def video_frames(self,num_frames,frame_rate,preview=None):
+		"""
+			Frames to render, frame rate of the video and whether it is a preview, sets the frame size.
+			preview: every PREVIEW_STRIDE-th frame (at most PREVIEW_MAX_FRAMES) at PREVIEW_RESOLUTION, meshes are hidden.
+				Defaults to the preview setting of the Visualizer
+		"""
+		preview = self.preview if preview is None else preview
+		if not preview:
+			self.ps.set_window_size(*self.resolution)
+			return range(num_frames),frame_rate,False
+		self.ps.set_window_size(*PREVIEW_RESOLUTION)
+		return range(0,num_frames,PREVIEW_STRIDE)[:PREVIEW_MAX_FRAMES],frame_rate/PREVIEW_STRIDE,True
+
+	def render_frames(self,num_frames,frame_rate,video_dir,preview=None):
+		"""
+			video_frames for a video, all frames (no preview) for the interactive view (video_dir None)
+		"""
+		if video_dir is None:
+			return range(num_frames),frame_rate,False
+		return self.video_frames(num_frames,frame_rate,preview)
+
+	@staticmethod
+	def png_pattern(video_dir,name):
+		os.makedirs(os.path.join(video_dir,"images"),exist_ok=True)
+		return os.path.join(video_dir,"images",name)
+
+	def frame(self):
+		"""
+			Current frame as an RGB uint8 array (height x width x 3)
+		"""
+		if self.backend == 'numpy':
+			return self.ps.render()
+		return self.ps.screenshot_to_buffer(transparent_bg=False)[...,:3]
 
-	def render_skeleton(self,sample,video_dir=None,screen_scale=[1.4,1.0,1.0],frame_rate=60): 
+	def show(self):
+		"""
+			Interactive window, only available with the polyscope backend
+		"""
+		if self.backend == 'numpy':
+			raise RuntimeError("The headless numpy backend has no window, pass video_dir to render a video")
+		self.ps.show()
+
+	def render_skeleton(self,sample,video_dir=None,screen_scale=[1.4,1.0,1.0],frame_rate=60,save_png=SAVE_PNG,preview=None): 
 		"""
 			
 			screen_scale scales the bounding box 
+			save_png: also save every frame to images/
+			preview: short low resolution clip, defaults to the Visualizer setting (see video_frames)
+			Returns the number of rendered frames
 		"""
 		joints = sample.joints_np
 		bones = np.array([(i,x) for i,x in enumerate(JOINT_PARENT_ARRAY)])
@@ -36,139 +128,128 @@ class Visualizer:
 
 		camera_position = np.array([10*self.bbox[0],self.bbox[1],0]) + self.object_position
 		look_at_position = np.array([0,0,0]) + self.object_position
-		ps.look_at(camera_position,look_at_position)
+		self.ps.look_at(camera_position,look_at_position)
 
-		ps_joints   = ps.register_point_cloud("Joints", joints[0],enabled=True,color=np.array([1,0,0]),radius=0.01)
-		ps_skeleton = ps.register_curve_network("Skeleton", joints[0], bones,color=np.array([0,1,0]),enabled=True)
+		ps_joints   = self.ps.register_point_cloud("Joints", joints[0],enabled=True,color=np.array([1,0,0]),radius=0.01)
+		ps_skeleton = self.ps.register_curve_network("Skeleton", joints[0], bones,color=np.array([0,1,0]),enabled=True)
 
 
 		if video_dir is None:
-			ps.show()
+			self.show()
 			return 
 
 		video_dir = os.path.join(video_dir,f"{sample.openCapID}_{sample.label}_{sample.mcs}")
-		os.makedirs(video_dir,exist_ok=True)
-		os.makedirs(os.path.join(video_dir,"images"),exist_ok=True)
-		os.makedirs(os.path.join(video_dir,"video"),exist_ok=True)
-
-		# Render each frame
-		for i,traj in enumerate(joints): 
-			ps_joints.update_point_positions(traj)
-			ps_skeleton.update_node_positions(traj)
+		frames,frame_rate,preview = self.video_frames(len(joints),sample.fps,preview)
+		video_path = os.path.join(video_dir,"video","skeleton_preview.mp4" if preview else "skeleton.mp4")
+		png_pattern = self.png_pattern(video_dir,"{}.png") if save_png else None
 
+		# Render each frame straight into ffmpeg
+		with VideoEncoder(video_path,frame_rate,png_pattern=png_pattern) as encoder:
+			for i in frames: 
+				traj = joints[i]
+				ps_joints.update_point_positions(traj)
+				ps_skeleton.update_node_positions(traj)
 
-			image_path = os.path.join(video_dir,"images",f"{i}.png")
-			print(f"Saving plot to :{image_path}")	
-			ps.set_screenshot_extension(".png");
-			ps.screenshot(image_path,transparent_bg=False)
-				
-		image_path = os.path.join(video_dir,"images",f"\%d.png")
-		video_path = os.path.join(video_dir,"video",f"skeleton.mp4")
-		palette_path = os.path.join(video_dir,"video",f"skeleton_palette.png")
-		frame_rate = sample.fps
-		os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -vf palettegen {palette_path}")
-		os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse 	 {video_path}")	
-		# os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse {video_path.replace('mp4','gif')}")	
+				encoder.write(self.frame())
 
-		print(f"Running Command:",f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse {video_path}")
+		print(f"Saved video to :{video_path}")
+		return encoder.num_frames
 
-	def render_smpl(self,sample,smplRetargetter,video_dir=None):
+	def render_smpl(self,sample,smplRetargetter,video_dir=None,save_png=SAVE_PNG,preview=None):
 
 		target = sample.joints_np
-		verts,Jtr,Jtr_offset = smplRetargetter()
+		frames,frame_rate,preview = self.render_frames(target.shape[0],sample.fps,video_dir,preview)
+
+		# Only the rendered frames are posed, previews hide the mesh so skinning is skipped
+		with torch.no_grad():
+			verts,Jtr,Jtr_offset = smplRetargetter(joints_only=preview,frames=None if len(frames) == target.shape[0] else list(frames))
 
-		verts = verts.cpu().data.numpy()
+		verts = None if verts is None else verts.cpu().data.numpy()
 		if not hasattr(self,'ps_data'):
-			# Initialize Plot SMPL in polyscope
-			ps.init()
+			# Initialize Plot SMPL (the backend is initialized once in __init__)
+			points = Jtr.cpu().data.numpy() if verts is None else verts
 			self.ps_data = {}
-			self.ps_data['bbox'] = verts.max(axis=(0,1)) - verts.min(axis=(0,1))
+			self.ps_data['bbox'] = points.max(axis=(0,1)) - points.min(axis=(0,1))
 			self.ps_data['object_position'] = sample.joints_np[0,0]
 
 		# camera_position = np.array([0,0,3*self.ps_data['bbox'][0]])
 		camera_position = np.array([7*self.ps_data['bbox'][0],0.5*self.ps_data['bbox'][1],0]) + self.ps_data['object_position']
 		look_at_position = np.array([0,0,0]) + self.ps_data['object_position']
-		ps.look_at(camera_position,look_at_position)
+		self.ps.look_at(camera_position,look_at_position)
 
 		Jtr = Jtr.cpu().data.numpy() + np.array([0,0,0])*self.ps_data['bbox']
 
-		verts += np.array([0, 0, 0]) * self.ps_data['bbox']
 		# target_joints = target - target[:,7:8,:] + Jtr[:,0:1,:] + np.array([0,0,0])*self.ps_data['bbox']
 		target_joints = target + np.array([0,0,0])*self.ps_data['bbox']
 
 		Jtr_offset = Jtr_offset[:,smplRetargetter.index['smpl_index']].cpu().data.numpy() + np.array([0.0,0,0])*self.ps_data['bbox']       
 		# Jtr_offset = Jtr_offset.cpu().data.numpy() + np.array([0,0,0])*self.ps_data['bbox']       
 
-		ps.remove_all_structures()
-		ps_mesh = ps.register_surface_mesh('mesh',verts[0],smplRetargetter.smpl_layer.smpl_data['f'],transparency=0.5)
+		self.ps.remove_all_structures()
+		if verts is not None:
+			ps_mesh = self.ps.register_surface_mesh('mesh',verts[0],smplRetargetter.smpl_layer.smpl_data['f'],transparency=0.5)
 		
 
 		target_bone_array = np.array([[i,p] for i,p in enumerate(smplRetargetter.index['dataset_parent_array'])])
-		ps_target_skeleton = ps.register_curve_network(f"Target Skeleton",target_joints[0],target_bone_array,color=np.array([0,0,1]))
+		ps_target_skeleton = self.ps.register_curve_network(f"Target Skeleton",target_joints[0],target_bone_array,color=np.array([0,0,1]))
 
 		smpl_bone_array = np.array([[i,p] for i,p in enumerate(smplRetargetter.index['parent_array'])])
-		ps_smpl_skeleton = ps.register_curve_network(f"Smpl Skeleton",Jtr[0],smpl_bone_array,color=np.array([1,0,0]))
+		ps_smpl_skeleton = self.ps.register_curve_network(f"Smpl Skeleton",Jtr[0],smpl_bone_array,color=np.array([1,0,0]))
 
 		smpl_index = list(smplRetargetter.index['smpl_index'].cpu().data.numpy())    
 
 		offset_skeleton_bones = np.array([[x,smpl_index.index(smplRetargetter.index['parent_array'][i])] for x,i in enumerate(smpl_index) if smplRetargetter.index['parent_array'][i] in smpl_index])
-		ps_offset_skeleton = ps.register_curve_network(f"Offset Skeleton",Jtr_offset[0],offset_skeleton_bones,color=np.array([1,1,0]))
+		ps_offset_skeleton = self.ps.register_curve_network(f"Offset Skeleton",Jtr_offset[0],offset_skeleton_bones,color=np.array([1,1,0]))
 
 
 		dataset_index = list(smplRetargetter.index['dataset_index'].cpu().data.numpy())    		
 		joint_mapping = np.concatenate([target_joints[0,dataset_index],Jtr_offset[0]],axis=0)
 		joint_mapping_edges = np.array([(i,joint_mapping.shape[0]//2+i) for i in range(joint_mapping.shape[0]//2)])
-		ps_joint_mapping = ps.register_curve_network(f"Mapping (target- smpl) joints",joint_mapping,joint_mapping_edges,radius=0.001,color=np.array([0,1,0]))
+		ps_joint_mapping = self.ps.register_curve_network(f"Mapping (target- smpl) joints",joint_mapping,joint_mapping_edges,radius=0.001,color=np.array([0,1,0]))
 
 		if video_dir is None:
-			ps.show()
+			self.show()
 			return 
-		os.makedirs(video_dir,exist_ok=True)
-		os.makedirs(os.path.join(video_dir,"images"),exist_ok=True)
-		os.makedirs(os.path.join(video_dir,"video"),exist_ok=True)
+		video_path = os.path.join(video_dir,"video",f"{sample.label}_{sample.mcs}_smpl{'_preview' if preview else ''}.mp4")
+		png_pattern = self.png_pattern(video_dir,"smpl_{}.png") if save_png else None
 
 		# ps.show()
 		print(f'Rendering images:')
-		for i in tqdm(range(verts.shape[0])):
-			ps_mesh.update_vertex_positions(verts[i])
-			ps_target_skeleton.update_node_positions(target_joints[i])
-			ps_smpl_skeleton.update_node_positions(Jtr[i])
-			ps_offset_skeleton.update_node_positions(Jtr_offset[i])
-			ps_joint_mapping.update_node_positions(np.concatenate([target_joints[i,dataset_index],Jtr_offset[i]],axis=0))
-
-			image_path = os.path.join(video_dir,"images",f"smpl_{i}.png")
-			# print(f"Saving plot to :{image_path}")	
-			ps.set_screenshot_extension(".png");
-			ps.screenshot(image_path,transparent_bg=False)
-			
-			# if i > 0.6*verts.shape[0]:
-			# if i  % 100 == 99: 
-			# 	ps.show()
+		with VideoEncoder(video_path,frame_rate,png_pattern=png_pattern) as encoder:
+			# k indexes the posed frames, i the sample
+			for k,i in enumerate(tqdm(frames)):
+				if verts is not None:
+					ps_mesh.update_vertex_positions(verts[k])
+				ps_target_skeleton.update_node_positions(target_joints[i])
+				ps_smpl_skeleton.update_node_positions(Jtr[k])
+				ps_offset_skeleton.update_node_positions(Jtr_offset[k])
+				ps_joint_mapping.update_node_positions(np.concatenate([target_joints[i,dataset_index],Jtr_offset[k]],axis=0))
 
-		image_path = os.path.join(video_dir,"images",f"smpl_\%d.png")
-		video_path = os.path.join(video_dir,"video",f"{sample.label}_{sample.mcs}_smpl.mp4")
-		palette_path = os.path.join(video_dir,"video",f"smpl.png")
-		frame_rate = sample.fps
-		os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -vf palettegen {palette_path}")
-		os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse 	 {video_path}")	
-		# os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse {video_path.replace('mp4','gif')}")	
+				encoder.write(self.frame())
 
-		print(f"Running Command:",f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse {video_path}")
+		print(f"Saved video to :{video_path}")
 
 
-	def render_rabit(self,sample,video_dir=None): 
+	def render_rabit(self,sample,video_dir=None,save_png=SAVE_PNG,preview=None): 
 
 		T = sample.num_frames
+		frames,frame_rate,preview = self.render_frames(T,sample.fps,video_dir,preview)
 
-		# Get bounding box and object position 
-		smpl_verts,smpl_joints,_ = sample.smpl()
-		smpl_verts = smpl_verts.cpu().data.numpy()
+		# Get bounding box and object position, only the rendered frames are posed and previews skip the SMPL mesh
+		with torch.no_grad():
+			smpl_verts,smpl_joints,_ = sample.smpl(joints_only=preview,frames=None if len(frames) == T else list(frames))
 		smpl_joints = smpl_joints.cpu().data.numpy()
+		smpl_verts = smpl_joints if smpl_verts is None else smpl_verts.cpu().data.numpy()
 
-		# Load 0th frame and get params
-		sample.rabit.load_smpl_params(sample.smpl.smpl_params,0)
-		rabit_verts = sample.rabit.verts
-		rabit_joints = sample.rabit.J
+		# Load 0th frame, from the exported mesh sequence if available
+		if ArrayStore.exists(rabit_mesh_path(sample.name)):
+			rabit_mesh = load_rabit_mesh(rabit_mesh_path(sample.name),0)
+			rabit_verts = rabit_mesh['verts']
+			rabit_joints = rabit_mesh['joints']
+		else:
+			sample.rabit.load_smpl_params(sample.smpl.pose_axis_angle().detach().cpu().numpy(),sample.smpl.smpl_params['trans'].cpu().data.numpy(),0)
+			rabit_verts = sample.rabit.verts
+			rabit_joints = sample.rabit.J
 
 
 		bbox_smpl = smpl_verts.max(axis=(0,1))  - smpl_verts.min(axis=(0,1))
@@ -181,64 +262,59 @@ class Visualizer:
 		# camera_position = np.array([0,0,3*self.ps_data['bbox'][0]])
 		camera_position = np.array([7*bbox[0],0,0]) + object_position
 		look_at_position = np.array([0,0,0]) + object_position
-		ps.look_at(camera_position,look_at_position)
+		self.ps.look_at(camera_position,look_at_position)
 
 		# Translate objects to visualize 
 		smpl_joints += (np.array([0,0,+0.5])*bbox).reshape((1,-1,3))  
-		smpl_verts += (np.array([0, 0, +0.5]) * bbox).reshape((1,-1,3))
+		if not preview:
+			smpl_verts += (np.array([0, 0, +0.5]) * bbox).reshape((1,-1,3))
 
 		rabit_joints += (np.array([0,0,-0.5])*bbox).reshape((1,3))  
 		rabit_verts += (np.array([0, 0, -0.5]) * bbox).reshape((1,3))
 
 
 		# Initial plot
-		ps.remove_all_structures()
-		ps_smpl_mesh = ps.register_surface_mesh('SMPL Mesh',smpl_verts[0],sample.smpl.smpl_layer.smpl_data['f'],transparency=0.5)
+		self.ps.remove_all_structures()
+		if not preview:
+			ps_smpl_mesh = self.ps.register_surface_mesh('SMPL Mesh',smpl_verts[0],sample.smpl.smpl_layer.smpl_data['f'],transparency=0.5)
 		
 		smpl_bone_array = np.array([[i,p] for i,p in enumerate(sample.smpl.index['parent_array'])])
-		ps_smpl_skeleton = ps.register_curve_network(f"SMPL Skeleton",smpl_joints[0],smpl_bone_array,color=np.array([1,0,0]))
+		ps_smpl_skeleton = self.ps.register_curve_network(f"SMPL Skeleton",smpl_joints[0],smpl_bone_array,color=np.array([1,0,0]))
 
 
-		ps_rabit_mesh = ps.register_surface_mesh('RaBit Mesh',rabit_verts,sample.rabit._faces,transparency=0.5)
+		ps_rabit_mesh = self.ps.register_surface_mesh('RaBit Mesh',rabit_verts,sample.rabit._faces,transparency=0.5)
 		
 		rabit_bone_array = np.array([[i,p] for i,p in enumerate(sample.smpl.index['parent_array'])])
-		ps_rabit_skeleton = ps.register_curve_network(f"RaBit Skeleton",rabit_joints,rabit_bone_array,color=np.array([1,0,0]))
+		ps_rabit_skeleton = self.ps.register_curve_network(f"RaBit Skeleton",rabit_joints,rabit_bone_array,color=np.array([1,0,0]))
 
 
 		if video_dir is None:
-			ps.show()
+			self.show()
 			return 
-		os.makedirs(video_dir,exist_ok=True)
-		os.makedirs(os.path.join(video_dir,"images"),exist_ok=True)
-		os.makedirs(os.path.join(video_dir,"video"),exist_ok=True)
+		video_path = os.path.join(video_dir,"video",f"{sample.label}_{sample.mcs}_rabit{'_preview' if preview else ''}.mp4")
+		png_pattern = self.png_pattern(video_dir,"rabit_{}.png") if save_png else None
+		ps_rabit_mesh.set_enabled(not preview)
+
+		# RaBit frames from the exported mesh sequence (read one frame at a time), only the first frame is shown otherwise
+		mesh_path = rabit_mesh_path(sample.name) if ArrayStore.exists(rabit_mesh_path(sample.name)) else None
+		rabit_shift = (np.array([0,0,-0.5])*bbox).reshape((1,3))
 
-		# ps.show()
 		print(f'Rendering images:')
-		for i in tqdm(range(verts.shape[0])):
-			ps_mesh.update_vertex_positions(verts[i])
-			ps_target_skeleton.update_node_positions(target_joints[i])
-			ps_smpl_skeleton.update_node_positions(Jtr[i])
-			ps_offset_skeleton.update_node_positions(Jtr_offset[i])
-			ps_joint_mapping.update_node_positions(np.concatenate([target_joints[i,dataset_index],Jtr_offset[i]],axis=0))
-
-			image_path = os.path.join(video_dir,"images",f"smpl_{i}.png")
-			# print(f"Saving plot to :{image_path}")	
-			ps.set_screenshot_extension(".png");
-			ps.screenshot(image_path,transparent_bg=False)
-			
-			# if i > 0.6*verts.shape[0]:
-			# if i  % 100 == 99: 
-			# 	ps.show()
+		with VideoEncoder(video_path,frame_rate,png_pattern=png_pattern) as encoder:
+			# k indexes the posed frames, i the sample
+			for k,i in enumerate(tqdm(frames)):
+				if not preview:
+					ps_smpl_mesh.update_vertex_positions(smpl_verts[k])
+				ps_smpl_skeleton.update_node_positions(smpl_joints[k])
+				if mesh_path is not None:
+					rabit_mesh = load_rabit_mesh(mesh_path,i,static=False)
+					if not preview:
+						ps_rabit_mesh.update_vertex_positions(rabit_mesh['verts'] + rabit_shift)
+					ps_rabit_skeleton.update_node_positions(rabit_mesh['joints'] + rabit_shift)
 
-		image_path = os.path.join(video_dir,"images",f"smpl_\%d.png")
-		video_path = os.path.join(video_dir,"video",f"{sample.label}_{sample.mcs}_smpl.mp4")
-		palette_path = os.path.join(video_dir,"video",f"smpl.png")
-		frame_rate = sample.fps
-		os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -vf palettegen {palette_path}")
-		os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse 	 {video_path}")	
-		# os.system(f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse {video_path.replace('mp4','gif')}")	
+				encoder.write(self.frame())
 
-		print(f"Running Command:",f"ffmpeg -y -framerate {frame_rate} -i {image_path} -i {palette_path} -lavfi paletteuse {video_path}")
+		print(f"Saved video to :{video_path}")
 
 
 
@@ -292,33 +368,131 @@ class VisualizerTrimesh:
 			scene.delete_geometry(['m_t.obj'])
 
 
-		os.system(f"ffmpeg -y -framerate 60 -i output/renderings/render_\%d.png output/video.mp4")
+		subprocess.run(["ffmpeg","-y","-framerate","60","-i","output/renderings/render_%d.png","output/video.mp4"],check=True)
+
+
+# Sharded dataset rendering.
+# Samples are distributed over worker processes, each with its own Visualizer (rendering context).
+# A record next to every video (video/render.json) stores the trc hash and render settings,
+# samples whose record matches are skipped. A failing sample is reported and does not stop the others.
+
+RENDER_RECORD = 'render.json'
+
+def list_samples(dataset_dir=DATASET_DIR):
+	samples = []
+	for subject in sorted(os.listdir(dataset_dir)):
+		marker_dir = os.path.join(dataset_dir,subject,'MarkerData')
+		if not os.path.isdir(marker_dir):
+			continue
+		samples += [os.path.join(marker_dir,file) for file in sorted(os.listdir(marker_dir)) if file.endswith('.trc')]
+	return samples
+
+
+def render_record_path(video_dir,sample_path,preview=False):
+	return os.path.join(video_dir,OpenCapDataLoader.get_name(sample_path),"video",RENDER_RECORD.replace('.json','_preview.json') if preview else RENDER_RECORD)
+
+
+def is_rendered(video_dir,sample_path,settings):
+	path = render_record_path(video_dir,sample_path,settings["preview"])
+	if not os.path.isfile(path):
+		return False
+	with open(path,'r') as f:
+		record = json.load(f)
+	return record.get("trc") == file_hash(sample_path) and record.get("settings") == settings \
+		and os.path.isfile(os.path.join(os.path.dirname(path),record.get("video","")))
+
+
+# Visualizer of a worker process, created once by the pool initializer
+_worker_vis = None
+
+def _init_render_worker(backend,resolution,preview):
+	global _worker_vis
+	_worker_vis = Visualizer(backend=backend,resolution=resolution,preview=preview)
+
+
+def _render_sample(sample_path,video_dir,settings):
+	"""
+		Render the skeleton video of a sample and write its record, errors are returned instead of raised
+	"""
+	start = time.time()
+	try:
+		sample = OpenCapDataLoader(sample_path)
+		frames = _worker_vis.render_skeleton(sample,video_dir=video_dir)
+
+		path = render_record_path(video_dir,sample_path,settings["preview"])
+		with open(path + '.tmp','w') as f:
+			json.dump({"trc":file_hash(sample_path),"settings":settings,"video":"skeleton_preview.mp4" if settings["preview"] else "skeleton.mp4",
+				"frames":frames},f)
+		os.replace(path + '.tmp',path)
+		return {"sample":sample_path,"frames":frames,"time":time.time()-start,"error":None}
+	except Exception:
+		return {"sample":sample_path,"frames":0,"time":time.time()-start,"error":traceback.format_exc()}
 
 
 # Load file and render skeleton for each video
-def render_dataset():
-	video_dir = 'rendered_videos'
-	
-	vis = Visualizer()
-	
-	for subject in os.listdir(DATASET_DIR):
-		for sample_path in os.listdir(os.path.join(DATASET_DIR,subject,'MarkerData')):
-			sample_path = os.path.join(DATASET_DIR,subject,'MarkerData',sample_path)
-			sample = OpenCapDataLoader(sample_path)
-			vis.render_skeleton(sample,video_dir=video_dir)
-		
-	
+def render_dataset(video_dir='rendered_videos',workers=RENDER_WORKERS,shard=(0,1),backend=RENDER_BACKEND,resolution=RENDER_RESOLUTION,force=False,preview=False):
+	"""
+		workers: Number of rendering processes, 1 renders in this process
+		shard: (index, count), only render every count-th sample starting at index (eg. one shard per node)
+		force: Render samples even if their record is up to date
+		preview: Short low resolution clips (Visualizer.video_frames), recorded separately from the full renders
+		Returns list of per sample results (sample, frames, time, error)
+	"""
+	backend = rendering_backend(backend)
+	settings = {"backend":backend,"resolution":list(PREVIEW_RESOLUTION if preview else resolution),"codec":VIDEO_CODEC,"preview":preview}
+	if preview:
+		settings.update({"stride":PREVIEW_STRIDE,"max_frames":PREVIEW_MAX_FRAMES})
+
+	samples = list_samples()[shard[0]::shard[1]]
+	pending = [sample_path for sample_path in samples if force or not is_rendered(video_dir,sample_path,settings)]
+	print(f"Rendering {len(pending)} of {len(samples)} samples in shard {shard[0]}/{shard[1]} ({len(samples)-len(pending)} up to date)")
+
+	start = time.time()
+	results = []
+	workers = max(1,min(workers or 1,len(pending)))
+	if workers == 1:
+		_init_render_worker(backend,resolution,preview)
+		for sample_path in pending:
+			results.append(_render_sample(sample_path,video_dir,settings))
+	else:
+		# spawn so every worker initializes its own rendering context
+		with ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context('spawn'),
+				initializer=_init_render_worker,initargs=(backend,resolution,preview)) as executor:
+			futures = [executor.submit(_render_sample,sample_path,video_dir,settings) for sample_path in pending]
+			for future in as_completed(futures):
+				results.append(future.result())
+	elapsed = time.time() - start
 
+	failed = [res for res in results if res['error'] is not None]
+	for res in failed:
+		print(f"Failed to render:{res['sample']}\n{res['error']}")
+	# Rendered frames, fewer than the sample frames for previews
+	frames = sum(res['frames'] for res in results)
+	print(f"Rendered {len(results)-len(failed)} samples, {len(failed)} failed, {frames} frames in {elapsed:.1f}s "
+		f"({frames/max(elapsed,1e-9):.1f} frames/s with {workers} workers)")
+	return results
 
 
-if __name__ == "__main__": 
 
-	if len(sys.argv) == 1: 
-		render_dataset()
+if __name__ == "__main__": 
+	parser = argparse.ArgumentParser(
+					prog='Renderer',
+					description='Renders the skeleton video of a sample, or of the complete dataset if no sample is given',
+					epilog='')
+	parser.add_argument('sample_path', nargs='?', default=None) # trc file
+	parser.add_argument('video_dir', nargs='?', default=None) # Shows the sample if not set
+	parser.add_argument('--workers', type=int, default=RENDER_WORKERS)
+	parser.add_argument('--shard', default='0/1') # index/count of the samples rendered by this job
+	parser.add_argument('--backend', default=RENDER_BACKEND) # polyscope, numpy or auto
+	parser.add_argument('--force', action='store_true') # Render up to date samples again
+	parser.add_argument('--preview', action='store_true') # Short low resolution skeleton clips for QA
+	args = parser.parse_args()
+
+	if args.sample_path is None: 
+		shard = tuple(int(x) for x in args.shard.split('/'))
+		render_dataset(workers=args.workers,shard=shard,backend=args.backend,force=args.force,preview=args.preview)
 	else:
-		sample_path = sys.argv[1]
-		sample = OpenCapDataLoader(sample_path)
+		sample = OpenCapDataLoader(args.sample_path)
 
-		vis = Visualizer()
-		video_dir = sys.argv[2] if len(sys.argv) > 2 else None
-		vis.render_skeleton(sample,video_dir=video_dir)		 
+		vis = Visualizer(backend=args.backend,preview=args.preview)
+		vis.render_skeleton(sample,video_dir=args.video_dir)
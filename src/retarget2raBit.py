@@ -22,15 +22,212 @@ from utils import * # Config details
 from dataloader import OpenCapDataLoader,SMPLLoader # To load TRC file
 from meters import Meters # Metrics to measure inverse kinematics
 from renderer import Visualizer
-from retarget2smpl import SMPLRetarget
+from retarget2smpl import SMPLRetarget, retarget_sample
+from store import find_smpl_result, result_cache_key, rabit_mesh_path, save_rabit_mesh, ArrayStore, rabit_export_done, mark_rabit_export
+from smplpytorch.pytorch.rodrigues_layer import batch_rodrigues
+from smplpytorch.pytorch.kinematics import kintree_levels, th_global_transforms, th_skinning, topk_skinning_weights, th_skinning_topk
 
 
 import numpy as np
-import meshio
 import os
-import openmesh as om
-import texture_util
+from texture_pool import subject_texture, link_texture
+# Only needed to convert the raw RaBit data to the bundle
+try:
+	import meshio
+except ModuleNotFoundError as e:
+	meshio = None
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Vertex line of the exported .obj files, float32 vertices need no more than 6 decimals
+OBJ_VERTEX_FORMAT = "v %.6f %.6f %.6f\n"
+
+# Sparse skinning of a shared shape has a fixed cost, dense skinning is faster for a few frames
+SPARSE_SKINNING_MIN_BATCH = 4
+
+# Pre-rendered UV templates, path -> (header, tail)
+_OBJ_TEMPLATES = {}
+
+def load_obj_template(path):
+	"""
+	Parse the RaBit UV template once per process.
+	Returns the mtllib/usemtl header and the texture coordinates + faces (v/vt only) as bytes,
+	the vertices of an exported frame go in between.
+	"""
+	if path in _OBJ_TEMPLATES:
+		return _OBJ_TEMPLATES[path]
+
+	vertex_texture_lines = []
+	face_lines = []
+	usemtl = ""
+	mtllib = ""
+	with open(path) as file_in_template:
+		for line in file_in_template.readlines():
+			line = line.replace('\n', '')
+			if line.startswith('#'):
+				continue
+			values = line.split()
+			if len(values) == 0:
+				continue
+			elif values[0] == "usemtl":
+				usemtl = line + "\n"
+			elif values[0] == "mtllib":
+				mtllib = line + "\n"
+			elif values[0] == "vt":
+				vertex_texture_lines.append(line + "\n")
+			elif values[0] == "f" or values[0] == "g":
+				# Keep only the vertex and texture index of the faces, drop groups
+				new_line = ""
+				for item in line.split(" "):
+					if item == "f":
+						new_line += item
+					elif 'g' in item or "G" in item:
+						continue
+					else:
+						splits = item.split("/")
+						new_line += " " + splits[0] + "/" + splits[1]
+				face_lines.append(new_line + "\n")
+
+	_OBJ_TEMPLATES[path] = ((mtllib + usemtl).encode(), ("".join(vertex_texture_lines) + "".join(face_lines)).encode())
+	return _OBJ_TEMPLATES[path]
+
+
+def format_obj_vertices(verts):
+	"""
+	All vertex lines of a mesh with a single format call
+	"""
+	verts = np.asarray(verts).reshape(-1, 3)
+	return ((OBJ_VERTEX_FORMAT * verts.shape[0]) % tuple(verts.ravel().tolist())).encode()
+
+
+def write_obj_frame(path, verts, template_path):
+	"""
+	Write one exported frame, run by the worker processes of RaBitModel.save_to_obj_sequence
+	"""
+	header, tail = load_obj_template(template_path)
+	with open(path, 'wb') as file_out:
+		file_out.write(header + format_obj_vertices(verts) + tail)
+
+
+# Texture coordinates and faces of UV templates, path -> (uvs, faces, face_uvs)
+_OBJ_UVS = {}
+
+def load_obj_uvs(path):
+	"""
+	Texture coordinates (N x 2) and the zero based vertex / texture coordinate index of every face (F x 3)
+	of the RaBit UV template, used by the mesh store export.
+	"""
+	if path not in _OBJ_UVS:
+		uvs = []
+		faces = []
+		face_uvs = []
+		with open(path) as file_in_template:
+			for line in file_in_template:
+				values = line.split()
+				if len(values) == 0:
+					continue
+				elif values[0] == "vt":
+					uvs.append([float(x) for x in values[1:3]])
+				elif values[0] == "f":
+					items = [item.split("/") for item in values[1:]]
+					faces.append([int(item[0]) - 1 for item in items])
+					face_uvs.append([int(item[1]) - 1 for item in items])
+		_OBJ_UVS[path] = (np.array(uvs, dtype=np.float32), np.array(faces, dtype=np.int32), np.array(face_uvs, dtype=np.int32))
+	return _OBJ_UVS[path]
+
+
+def load_float32_basis(path):
+	"""
+	Memory mapped float32 copy of a float64 .npy basis (eg. shape/pcamat.npy), converted once next to the original.
+	Only the rows that are used are read from disk, and the pages are shared between worker processes.
+	"""
+	cache_path = path.replace('.npy', '_float32.npy')
+	if not os.path.isfile(cache_path):
+		basis = np.load(path, mmap_mode='r')
+		# Convert in blocks of rows so the float64 basis is never fully loaded, rename once complete
+		tmp_path = cache_path + f'.{os.getpid()}.tmp'
+		out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=basis.shape)
+		for start in range(0, basis.shape[0], 50):
+			out[start:start+50] = basis[start:start+50]
+		out.flush()
+		del out
+		os.replace(tmp_path, cache_path)
+	return np.load(cache_path, mmap_mode='r')
+
+
+# Directory with everything the model needs except the PCA basis, one .npy per array (no pickled objects)
+# so the arrays are memory mapped and their pages shared between worker processes
+RABIT_BUNDLE = "shape/rabit_bundle"
+RABIT_BUNDLE_VERSION = 2
+
+def convert_rabit_bundle(dataroot, bundle_path):
+	"""
+	One time conversion of the raw RaBit data (mean.obj and the pickled .npy dictionaries) into the bundle:
+	template vertices, faces, weights, parent table, reorder index and the vertex clusters of the joints as
+	CSR arrays (cluster_verts[cluster_offsets[i]:cluster_offsets[i+1]] are the vertices of joint i).
+	"""
+	assert meshio is not None, "meshio is required to convert the RaBit data"
+	mesh = meshio.read(dataroot + "shape/mean.obj")
+
+	clusterdic = np.load(dataroot + "shape/clusterdic.npy", allow_pickle=True).item()
+	index2cluster = {}
+	for key in clusterdic.keys():
+		index2cluster[clusterdic[key]] = key
+	joint2index = np.load(dataroot + "shape/joint2index.npy", allow_pickle=True).item()
+	joint_order = np.load(dataroot + "shape/pose_order.npy")
+
+	# reorder joint
+	parents = np.ones(24, dtype=np.int64) * -1
+	ktree_table = np.load(dataroot + "shape/ktree_table.npy", allow_pickle=True).item()
+	name2index = {}
+	for i in range(1, 24):
+		parents[i] = ktree_table[i][1]
+		name2index[ktree_table[i][0]] = i
+	reorder_index = np.zeros(24, dtype=np.int64)
+	for i, jointname in enumerate(joint_order):
+		if jointname in name2index:
+			reorder_index[name2index[jointname]] = i
+		else:
+			reorder_index[0] = 2
+
+	cluster_names = [index2cluster[i] for i in range(len(index2cluster))]
+	clusters = [np.zeros(0, dtype=np.int64) if name == 'RootNode' else np.asarray(joint2index[name], dtype=np.int64).reshape(-1) for name in cluster_names]
+
+	arrays = dict(
+		version=np.array(RABIT_BUNDLE_VERSION),
+		v_template=np.asarray(mesh.points, dtype=np.float64),
+		faces=np.asarray(mesh.cells[0].data),
+		weights=np.asarray(np.load(dataroot + "shape/weight_matrix.npy", allow_pickle=True), dtype=np.float64),
+		parents=parents,
+		reorder_index=reorder_index,
+		cluster_names=np.array(cluster_names),
+		cluster_offsets=np.cumsum([0] + [len(c) for c in clusters]).astype(np.int64),
+		cluster_verts=np.concatenate(clusters))
+
+	# Write then rename so concurrent workers never read a partial bundle
+	tmp_path = bundle_path + f'.{os.getpid()}.tmp'
+	os.makedirs(tmp_path, exist_ok=True)
+	for name, array in arrays.items():
+		np.save(os.path.join(tmp_path, name + '.npy'), array, allow_pickle=False)
+	try:
+		os.replace(tmp_path, bundle_path)
+	except OSError:
+		# Another process converted the bundle first
+		shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_rabit_bundle(dataroot):
+	"""
+	Memory mapped arrays of the RaBit bundle, converted from the raw data on first use
+	"""
+	bundle_path = dataroot + RABIT_BUNDLE
+	if not os.path.isdir(bundle_path):
+		convert_rabit_bundle(dataroot, bundle_path)
+	bundle = dict([(file[:-len('.npy')], np.load(os.path.join(bundle_path, file), mmap_mode='r', allow_pickle=False))
+		for file in os.listdir(bundle_path) if file.endswith('.npy')])
+	assert int(bundle['version']) == RABIT_BUNDLE_VERSION, f"RaBit bundle:{bundle_path} has version:{int(bundle['version'])}, delete it to convert again"
+	return bundle
 
 
 class RaBitModel():
@@ -39,52 +236,45 @@ class RaBitModel():
 	This model was built by numpy, exclude eyes rebuild.
 
 	"""
-	def __init__(self):
+	def __init__(self, num_betas=RABIT_NUM_BETAS):
+		"""
+		num_betas: number of PCA shape components used (at most 500), only these rows of the basis are read
 
+		"""
 		dataroot = os.path.join(RABIT_DIR,"rabit_data/")
-		self.mean_file = [dataroot + "shape/mean.obj"]
-		self.pca_weight = np.load(dataroot + "shape/pcamat.npy", allow_pickle=True)
-		self.clusterdic = np.load(dataroot + "shape/clusterdic.npy", allow_pickle=True).item()
-
-		self.index2cluster = {}
-		for key in self.clusterdic.keys():
-			val = self.clusterdic[key]
-			self.index2cluster[val] = key
-
-		self.joint2index = np.load(dataroot + "shape/joint2index.npy", allow_pickle=True).item()
-		joint_order = np.load(dataroot + "shape/pose_order.npy")
-		self.weightMatrix = np.load(dataroot + "shape/weight_matrix.npy", allow_pickle=True)
-
-		# reorder joint
-		self.ktree_table = np.ones(24) * -1
-		ktree_table = np.load(dataroot + "shape/ktree_table.npy", allow_pickle=True).item()
-		name2index = {}
-		for i in range(1, 24):
-			self.ktree_table[i] = ktree_table[i][1]
-			name2index[ktree_table[i][0]] = i
-		reorder_index = np.zeros(24)
-		for i, jointname in enumerate(joint_order):
-			if jointname in name2index:
-				reorder_index[name2index[jointname]] = i
-			else:
-				reorder_index[0] = 2
-		self.reorder_index = np.array(reorder_index).astype(int)
-
-		# import mesh
-		self.points, self.cells = self.mesh_load()
-
-		self.weights = self.weightMatrix
-		self.v_template = self.points
+		self.pca_weight = load_float32_basis(dataroot + "shape/pcamat.npy")[:num_betas]
+		bundle = load_rabit_bundle(dataroot)
+
+		self.index2cluster = dict(enumerate(bundle['cluster_names'].tolist()))
+		self.joint2index = dict([(name, bundle['cluster_verts'][bundle['cluster_offsets'][i]:bundle['cluster_offsets'][i+1]])
+			for i, name in self.index2cluster.items() if name != 'RootNode'])
+		self.ktree_table = bundle['parents']
+		self.reorder_index = bundle['reorder_index']
+
+		self.weights = bundle['weights']
+		self.v_template = bundle['v_template']
 		self.shapedirs = self.pca_weight
 
-		self.faces = self.cells
-		self._faces = self.faces[0].data
+		self.faces = bundle['faces']
+		self._faces = self.faces
 		self.parent = self.ktree_table
-		# print(self._faces)
+
+		# Torch model used by batch_forward, float32 is enough for the exported meshes
+		self.th_weights = torch.from_numpy(np.asarray(self.weights, dtype=np.float32))
+		self.th_v_template = torch.from_numpy(np.asarray(self.v_template, dtype=np.float32).reshape(-1))
+		# Most influential joints of every vertex for the sparse skinning of a shared shape
+		self.th_skin_index, self.th_skin_weights = topk_skinning_weights(self.th_weights)
+		self.kintree_parents = [int(p) for p in self.parent]
+		self.kintree_levels = kintree_levels(self.kintree_parents)
+
+		# Vertices of every joint cluster concatenated (RootNode has none), used to compute all joints at once
+		self.J_count = len(self.index2cluster)
+		self.th_cluster_verts = torch.from_numpy(bundle['cluster_verts'].astype(np.int64))
+		self.th_cluster_joints = torch.from_numpy(np.repeat(np.arange(self.J_count), np.diff(bundle['cluster_offsets'])))
 
 		# INFO:
 		# pose_shape: [23, 3]
-		# beta_shape: [500]
+		# beta_shape: [num_betas]
 		self.quads = self._faces.reshape(-1)
 		self.pose_shape = [23, 3]
 		self.beta_shape = [self.pca_weight.shape[0]]
@@ -98,28 +288,14 @@ class RaBitModel():
 		self.J = None
 		self.R = None
 
+		# (beta, v_shaped, J) of the last shape, pose only updates skip the shape blend and joints
+		self._shape_cache = None
+		# Random shape used for SMPL parameters, drawn once per model
+		self.smpl_beta = None
+
 		# update params after model init
 		self.update()
 
-	def mesh_load(self):
-		"""
-		import mesh from file list.
-
-		"""
-		mesh_list = []
-
-		for f in self.mean_file:
-			try:
-				fmesh = meshio.read(f)
-				mesh_list.append(fmesh)
-			except Exception as e:
-				print(e, f)
-
-		points_list = [mesh.points for mesh in mesh_list]
-		cells_list = [mesh.cells for mesh in mesh_list]  # faces
-
-		return points_list[0], cells_list[0]
-
 	def set_params(self, pose=None, beta=None, trans=None):
 		"""
 		Set pose, shape, and/or translation parameters of RaBit model.
@@ -133,7 +309,7 @@ class RaBitModel():
 		relative to parent joint. For root joint it's global orientation.
 		Represented in a axis-angle format.
 
-		beta: Parameter for model shape. A vector of shape [500]. Coefficients for
+		beta: Parameter for model shape. A vector of shape [num_betas]. Coefficients for
 		PCA component. Only 500 components were released by GAP LAB.
 
 		trans: Global translation of shape [3].
@@ -144,7 +320,7 @@ class RaBitModel():
 
 		"""
 		if pose is not None:
-			self.global_pose = self.pose[]
+			self.global_pose = pose[0,:]
 			self.pose = pose[1:,:]
 		if beta is not None:
 			self.beta = beta
@@ -156,265 +332,407 @@ class RaBitModel():
 
 	def update(self):
 		"""
-		Called automatically when parameters are updated
-		and numpy implementation.
+		Called automatically when parameters are updated.
+		Single frame of batch_forward.
 
 		"""
-		# INFO:
-		# shapedirs: (500, 116178)
-		# beta: (500,)
-		# v_template: (38726, 3)
+		v_shaped, J = self.shape(self.beta)
+		verts, J, R, v_posed = self.batch_forward(
+			torch.from_numpy(np.asarray(self.pose, dtype=np.float32)).reshape(1, -1, 3),
+			v_shaped,
+			torch.from_numpy(np.asarray(self.trans, dtype=np.float32)).reshape(1, 3),
+			J=J)
+		self.verts = verts[0].numpy()
+		self.J = J[0].numpy()
+		self.R = R[0].numpy()
+		self.v_posed = v_posed[0].numpy()
+
+	def shape(self, beta):
+		"""
+		Shaped template and joints of a single shape, cached on beta.
+		Recomputed only when beta differs from the cached one.
 
-		# shape blend
-		v_shaped = self.shapedirs.T.dot(self.beta) + self.v_template.reshape(-1)
+		Return:
+		------
+		v_shaped [1, 38726, 3], J [1, 24, 3]
 
-		# rotation matrix for each joint
-		# compared to smpl model, rabit needn't simulate the deform of muscle
-		pose_cube = np.zeros((24, 1, 3))
+		"""
+		beta = np.asarray(beta).reshape(self.beta_shape)
+		if self._shape_cache is None or not np.array_equal(self._shape_cache[0], beta):
+			v_shaped = self.shape_blend(beta)
+			self._shape_cache = (beta.copy(), v_shaped, self.batch_joints(v_shaped))
+		return self._shape_cache[1], self._shape_cache[2]
+
+	def invalidate_shape(self):
+		"""
+		Drop the cached shape, needed if the template, shapedirs or clusters are modified.
 
-		pose_cube[1:, :, :] += self.pose.reshape((-1, 1, 3))
-		self.R = self.rodrigues(pose_cube)
-		self.v_posed = v_shaped.reshape(-1, 3)
+		"""
+		self._shape_cache = None
 
-		# generate joints
-		self.J = self.joints_list()
-
-		# world transformation of each joint
-		G = np.empty((self.ktree_table.shape[0], 4, 4))
-
-		G[0] = self.with_zeros(np.hstack((self.R[0], self.J[0, :].reshape([3, 1]))))
-		for i in range(1, self.ktree_table.shape[0]):
-			dJ = (self.J[i, :] - self.J[int(self.parent[i]), :]).reshape([3, 1])
-			G[i] = G[int(self.parent[i])].dot(
-				self.with_zeros(
-					np.hstack(
-						[self.R[i], dJ]
-					)
-				)
-			)
-
-		# remove the transformation due to the rest pose
-		G = G - self.pack(
-			np.matmul(
-				G,
-				np.hstack([self.J, np.zeros([24, 1])]).reshape([24, 4, 1])
-			)
-		)
-
-		# transformation of each vertex
-		T = np.tensordot(self.weights, G, axes=[[1], [0]])
-		rest_shape_h = np.hstack((self.v_posed, np.ones([self.v_posed.shape[0], 1])))
-		v = np.matmul(T, rest_shape_h.reshape([-1, 4, 1])).reshape([-1, 4])[:, :3]
-		self.verts = v + self.trans.reshape([1, 3])
-
-	def rodrigues(self, r):
-		"""
-		Rodrigues' rotation formula that turns axis-angle vector into rotation
-		matrix in a batch-ed manner.
+	def shape_blend(self, beta):
+		"""
+		Shape blend for one or more shapes, only the non zero PCA components are used.
 
-		Parameter:
-		----------
-		r: Axis-angle rotation vector of shape [batch_size, 1, 3].
+		Parameters:
+		---------
+		beta: [num_betas] or [N, num_betas]
 
 		Return:
-		-------
-		Rotation matrix of shape [batch_size, 3, 3].
-
-		"""
-		theta = np.linalg.norm(r, axis=(1, 2), keepdims=True)
-
-		theta = np.maximum(theta, np.finfo(np.float64).tiny)  # avoid zero divide
-		r_hat = r / theta
-		cos = np.cos(theta)
-		z_stick = np.zeros(theta.shape[0])
-		m = np.dstack([
-			z_stick, -r_hat[:, 0, 2], r_hat[:, 0, 1],
-			r_hat[:, 0, 2], z_stick, -r_hat[:, 0, 0],
-			-r_hat[:, 0, 1], r_hat[:, 0, 0], z_stick]
-		).reshape([-1, 3, 3])
-		i_cube = np.broadcast_to(
-			np.expand_dims(np.eye(3), axis=0),
-			[theta.shape[0], 3, 3]
-		)
-		A = np.transpose(r_hat, axes=[0, 2, 1])
-		B = r_hat
-		dot = np.matmul(A, B)
-		R = cos * i_cube + (1 - cos) * dot + np.sin(theta) * m
-		return R
-
-	def with_zeros(self, x):
-		"""
-		Append a [0, 0, 0, 1] vector to a [3, 4] matrix.
+		------
+		v_shaped [N, 38726, 3] float32 tensor
 
-		Parameter:
+		"""
+		# INFO:
+		# shapedirs: (num_betas, 116178) float32 memory map
+		# v_template: (38726, 3)
+		beta = np.asarray(beta)
+		assert beta.shape[-1] == self.beta_shape[0], f"Expected {self.beta_shape[0]} shape components, got beta of shape:{beta.shape}"
+		beta = beta.reshape(-1, self.beta_shape[0])
+		active = np.flatnonzero(np.any(beta != 0, axis=0))
+		v_shaped = torch.addmm(self.th_v_template,
+			torch.from_numpy(beta[:, active].astype(np.float32)),
+			torch.from_numpy(np.array(self.shapedirs[active], dtype=np.float32)))
+		return v_shaped.view(beta.shape[0], -1, 3)
+
+	def batch_forward(self, pose, v_posed, trans, J=None, global_pose=None):
+		"""
+		Torch forward for a batch of frames. The kinematic chain and skinning
+		are shared with the SMPL layer (smplpytorch.pytorch.kinematics).
+
+		Parameters:
 		---------
-		x: Matrix to be appended.
+		pose: [batch_size, 23, 3] axis-angle rotation of the child joints, the root is not rotated.
+		v_posed: [batch_size or 1, 38726, 3] output of shape_blend
+		trans: [batch_size, 3]
+		J: [batch_size or 1, 24, 3] joints of v_posed if already known (see shape)
+		global_pose: [batch_size, 3] root rotation, not rotated by default
 
 		Return:
 		------
-		Matrix after appending of shape [4,4]
+		verts [batch_size, 38726, 3], J [batch_size, 24, 3], R [batch_size, 24, 3, 3], v_posed
 
 		"""
-		return np.vstack((x, np.array([[0.0, 0.0, 0.0, 1.0]])))
+		batch_size = pose.shape[0]
 
-	def pack(self, x):
+		# generate joints
+		# compared to smpl model, rabit needn't simulate the deform of muscle, v_posed is the shaped template
+		if J is None:
+			J = self.batch_joints(v_posed)
+		J = J.expand(batch_size, -1, -1)
+
+		# rotation matrix for each joint
+		root = pose.new_zeros(batch_size, 1, 3) if global_pose is None else global_pose.reshape(batch_size, 1, 3)
+		pose_cube = torch.cat([root, pose.reshape(batch_size, -1, 3)], 1)
+		R = batch_rodrigues(pose_cube.reshape(-1, 3)).view(batch_size, -1, 3, 3)
+
+		# world transformation of each joint, without the rest pose
+		_, G = th_global_transforms(R, J, self.kintree_parents, self.kintree_levels)
+
+		if v_posed.shape[0] == 1 and batch_size >= SPARSE_SKINNING_MIN_BATCH:
+			verts = th_skinning_topk(G, self.th_skin_index, self.th_skin_weights, v_posed)
+		else:
+			verts = th_skinning(G, self.th_weights, v_posed)
+		verts = verts + trans.reshape(batch_size, 1, 3)
+		return verts, J, R, v_posed
+
+	def batch_update(self, pose, beta=None, trans=None, global_pose=None, chunk_size=64):
 		"""
-		Append zero matrices of shape [4, 3] to vectors of [4, 1] shape in a batched
-		manner.
+		Vertices of all frames in one call, computed in chunks of frames.
 
-		Parameter:
-		----------
-		x: Matrices to be appended of shape [batch_size, 4, 1]
+		Parameters:
+		---------
+		pose: [T, 23, 3] axis-angle rotations, same as self.pose
+		beta: [num_betas] shared by all frames or [T, num_betas]. Defaults to self.beta
+		trans: [T, 3]. Defaults to zeros
+		global_pose: [T, 3] root rotation, not rotated by default
 
 		Return:
 		------
-		Matrix of shape [batch_size, 4, 4] after appending.
+		verts [T, 38726, 3], J [T, 24, 3] (float32)
 
 		"""
-		return np.dstack((np.zeros((x.shape[0], 4, 3)), x))
-
-	def joints_list(self):
+		pose = torch.from_numpy(np.asarray(pose, dtype=np.float32)).reshape(-1, 23, 3)
+		T = pose.shape[0]
+		beta = np.asarray(self.beta if beta is None else beta)
+		assert beta.shape[-1] == self.beta_shape[0], f"Expected {self.beta_shape[0]} shape components, got beta of shape:{beta.shape}"
+		beta = beta.reshape(-1, self.beta_shape[0])
+		trans = torch.zeros(T, 3) if trans is None else torch.from_numpy(np.asarray(trans, dtype=np.float32)).reshape(T, 3)
+		global_pose = None if global_pose is None else torch.from_numpy(np.asarray(global_pose, dtype=np.float32)).reshape(T, 3)
+
+		v_shaped, shape_J = self.shape(beta[0]) if beta.shape[0] == 1 else (None, None)
+		verts = torch.empty(T, self.v_template.shape[0], 3)
+		J = torch.empty(T, self.J_count, 3)
+		for start in range(0, T, chunk_size):
+			end = min(start + chunk_size, T)
+			chunk_v_shaped = v_shaped if v_shaped is not None else self.shape_blend(beta[start:end])
+			verts[start:end], J[start:end], _, _ = self.batch_forward(pose[start:end], chunk_v_shaped, trans[start:end], J=shape_J,
+				global_pose=None if global_pose is None else global_pose[start:end])
+		return verts.numpy(), J.numpy()
+
+	def batch_joints(self, v_posed):
 		"""
 		generate joints of rabit model based on the mid of maximum & minimun.
-		vertices was devided into 25 clusters.
+		vertices was devided into 25 clusters, all clusters are reduced at once.
 
-		"""
-		J = []
-		for i in range(len(self.index2cluster)):
-			key = self.index2cluster[i]
-			if key == 'RootNode':
-				J.append(np.zeros((1, 3)))
-				continue
-			index_val = self.v_posed[self.joint2index[key], :]
-			maxval = index_val.max(axis=0, keepdims=True)
-			minval = index_val.min(axis=0, keepdims=True)
-			J.append((maxval + minval) / 2)
-		J = np.concatenate(J)
-		return J
+		v_posed: [batch_size, 38726, 3]
 
-	def save_to_obj_with_texture(self, path):
+		"""
+		src = v_posed[:, self.th_cluster_verts]
+		index = self.th_cluster_joints.view(1, -1, 1).expand_as(src)
+		J = v_posed.new_zeros(v_posed.shape[0], self.J_count, 3) # RootNode stays at the origin
+		maxval = J.scatter_reduce(1, index, src, 'amax', include_self=False)
+		minval = J.scatter_reduce(1, index, src, 'amin', include_self=False)
+		return (maxval + minval) / 2
+
+	def save_to_obj_with_texture(self, path, verts=None):
 		"""
 		Save the RaBit model into .obj file.
+		The texture coordinates and faces of the UV template are rendered once per process (load_obj_template),
+		each export formats the vertices and writes the file in a single call.
 
 		Parameter:
 		---------
 		path: Path to save.
+		verts: Vertices to save (eg. a frame of batch_update), defaults to self.verts
 
 		"""
+		write_obj_frame(path, self.verts if verts is None else verts, os.path.join(RABIT_DIR,"./rabit_data/UV/tri.obj"))
 
-		vertex_texture_lines = []
-		face_lines = []
-		template_vertex_count = 0
-		usemtl = ""
-		mtllib = ""
-		with open(os.path.join(RABIT_DIR,"./rabit_data/UV/tri.obj")) as file_in_template:
-			for line in file_in_template.readlines():
-				line = line.replace('\n', '')
-				if line.startswith('#'):
-					continue
-				values = line.split()
-				if len(values) == 0:
-					continue
-				elif values[0] == "usemtl":
-					# file_out.write(line + "\n")
-					usemtl = line + "\n"
-				elif values[0] == "mtllib":
-					# file_out.write(line + "\n")
-					mtllib = line + "\n"
-				elif values[0] == "v":
-					template_vertex_count += 1
-				elif values[0] == "vt":
-					# file_out.write(line + "\n")
-					vertex_texture_lines.append(line + "\n")
-				elif values[0] == "vn":
-					# file_out.write(line + "\n")
-					# vertex_normal_lines.append(line + "\n")
-					pass
-				elif values[0] == "f" or values[0] == "g":
-					# file_out.write(line + "\n")
-					face_lines.append(line + "\n")
-				else:
-					pass
-		vertex_lines = []
-		for v in self.verts:
-			vertex_lines.append("v %s %s %s\n" % (str(v[0]), str(v[1]), str(v[2])))
-		with open(path, 'w') as file_out:
-			file_out.write(mtllib)
-			file_out.write(usemtl)
-			for v in vertex_lines:
-				file_out.write(v)
-			for vt in vertex_texture_lines:
-				file_out.write(vt)  # template
-			for f in face_lines:
-				items = f.replace("\n", "").split(" ")
-				new_line = ""
-				for item in items:
-					if item == "f":
-						new_line += item
-					elif 'g' in item or "G" in item:
-						continue
-					else:
-						splits = item.split("/")
-						new_line += " " + splits[0] + "/" + splits[1]
-				new_line += "\n"
-				file_out.write(new_line)
+	def save_to_obj_sequence(self, paths, verts, workers=RABIT_EXPORT_WORKERS):
+		"""
+		Save frames of a sequence as textured .obj files, formatting and writing is spread over worker processes.
 
-	def load_smpl_params(self,smpl_params,frame=0): 
-		
-		theta = smpl_params["pose_params"].reshape((-1,24,3))
-		beta = np.random.rand(*(500,)) * 10 - 5
-		beta[10:] = 0
+		Parameter:
+		---------
+		paths: Path of every frame.
+		verts: [len(paths), 38726, 3] vertices of every frame (eg. output of batch_update)
+		workers: Number of processes, 1 writes in this process
+
+		"""
+		template_path = os.path.join(RABIT_DIR,"./rabit_data/UV/tri.obj")
+		workers = max(1, min(workers or 1, len(paths)))
+		if workers == 1:
+			for path, frame_verts in zip(paths, verts):
+				write_obj_frame(path, frame_verts, template_path)
+			return
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			# list() raises the first failed write
+			list(executor.map(write_obj_frame, paths, verts, [template_path]*len(paths), chunksize=max(1, len(paths)//(4*workers))))
+
+	def save_to_mesh_store(self, path, verts, trans, joints, encoding=RABIT_VERTEX_ENCODING, smpl_key=None):
+		"""
+		Save a sequence (output of batch_update) as a single animated mesh store,
+		topology and UVs of the UV template are stored once. Read it with store.load_rabit_mesh.
+
+		Parameter:
+		---------
+		path: Path to save.
+		verts: [T, 38726, 3], trans: [T, 3], joints: [T, 24, 3]
+		encoding: 'float32', 'float16' or 'int16' vertices
+		smpl_key: cache key of the SMPL result the sequence was fit to (see store.result_cache_key)
+
+		"""
+		uvs, faces, face_uvs = load_obj_uvs(os.path.join(RABIT_DIR,"./rabit_data/UV/tri.obj"))
+		return save_rabit_mesh(path, verts, trans, joints, faces, uvs, face_uvs, encoding=encoding,
+			attrs={"texture":"m_t.png", "material":"m_t.mtl", "smpl_cache_key":smpl_key})
+
+	def load_smpl_params(self,pose_params,trans,frame=0): 
+		"""
+		pose_params: [T, 72] SMPL axis-angle poses (see SMPLRetarget.pose_axis_angle, for any ROTATION_REP), trans: [T, 3]
+		"""
+		theta = np.asarray(pose_params).reshape((-1,24,3))
+		beta = self.random_beta()
 		# beta[10:] = smpl_params["shape_params"]
 		# trans = np.zeros(self.trans_shape)
-		trans = smpl_params["trans"]
+		trans = np.asarray(trans)
+
+		self.set_params(beta=beta, pose=theta[frame], trans=trans[frame])
+
+	def random_beta(self):
+		"""
+		Random shape for SMPL parameters. Drawn once so every frame has the same body (and the cached shape is reused)
+		"""
+		if self.smpl_beta is None:
+			beta = np.random.rand(*self.beta_shape) * 10 - 5
+			beta[10:] = 0
+			self.smpl_beta = beta
+		return self.smpl_beta
 
-		self.set_params(beta=beta, pose=theta[frame].cpu().data.numpy(), trans=trans[frame].cpu().data.numpy())
+	def load_smpl_sequence(self,pose_params,trans):
+		"""
+		Batched load_smpl_params for a sequence.
+		pose_params: [T, 72] SMPL axis-angle poses, trans: [T, 3]
+		Returns vertices [T, 38726, 3] and joints [T, 24, 3]
+		"""
+		theta = np.asarray(pose_params).reshape((-1,24,3))
+		return self.batch_update(theta[:,1:], beta=self.random_beta(), trans=trans)
 
 
 
-def retarget_smpl2rabit(sample:OpenCapDataLoader):
+class RaBitRetarget(nn.Module):
+	"""
+	Fits RaBit pose, shape, scale and translation to the SMPL joints of a sequence (utils.smpl2rabit_mapping),
+	all frames in one batched optimization. Only joints are computed while fitting, the mesh is skinned once by export.
+	"""
+	def __init__(self, rabit, smpl_pose, smpl_joints, beta=None):
+		"""
+		rabit: RaBitModel
+		smpl_pose: Tensor [T, 72] SMPL axis-angle poses, the rotation of every mapped SMPL joint initializes the RaBit joint
+		smpl_joints: Tensor [T, 24, 3] SMPL joints, targets of the mapped RaBit joints
+		beta: initial shape, defaults to rabit.random_beta()
+		"""
+		super(RaBitRetarget, self).__init__()
+		self.rabit = rabit
+		self.cfg = SMPLRetarget.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json'))
+		self.batch_size = smpl_pose.shape[0]
+
+		mapping = torch.LongTensor(smpl2rabit_mapping)
+		self.register_buffer('target', smpl_joints.float()[:, mapping])
+		self.th_shapedirs = torch.from_numpy(np.array(rabit.shapedirs, dtype=np.float32))
+
+		# Warm start from the identity mapping: mapped SMPL rotations, root at the SMPL pelvis
+		smpl_pose = smpl_pose.float().reshape(self.batch_size, -1, 3)[:, mapping]
+		beta = torch.from_numpy(np.asarray(rabit.random_beta() if beta is None else beta, dtype=np.float32))
+		rabit_params = {}
+		rabit_params["global_pose"] = smpl_pose[:, 0].clone()
+		rabit_params["pose"] = smpl_pose[:, 1:].clone()
+		rabit_params["trans"] = self.target[:, 0].clone()
+		rabit_params["beta"] = beta.clone()
+
+		# Scale from the bone lengths of the target and the initial shape
+		with torch.no_grad():
+			J = rabit.batch_joints(self.shape_blend(beta))[0]
+			parents = torch.LongTensor(rabit.kintree_parents[1:])
+			target_bones = (self.target[:, 1:] - self.target[:, parents]).norm(dim=2).mean(0).sum()
+			rabit_bones = (J[1:] - J[parents]).norm(dim=1).sum()
+		rabit_params["scale"] = (target_bones / rabit_bones).reshape(1)
+
+		for k in rabit_params:
+			rabit_params[k] = nn.Parameter(rabit_params[k], requires_grad=(k != "beta" or bool(self.cfg.RABIT.OPTIMIZE_SHAPE)))
+			self.register_parameter(k, rabit_params[k])
+		self.rabit_params = rabit_params
+		self.register_buffer('beta_init', beta)
+
+		self.optimizer = optim.Adam([p for p in rabit_params.values() if p.requires_grad], lr=self.cfg.RABIT.LEARNING_RATE)
+
+	def shape_blend(self, beta):
+		# Differentiable shape blend of a single shape [1, 38726, 3]
+		return torch.addmm(self.rabit.th_v_template, beta.view(1, -1), self.th_shapedirs).view(1, -1, 3)
+
+	def forward(self):
+		"""
+		Posed RaBit joints [T, 24, 3] in the SMPL coordinates
+		"""
+		J = self.rabit.batch_joints(self.shape_blend(self.rabit_params["beta"]))
+		pose_cube = torch.cat([self.rabit_params["global_pose"].unsqueeze(1), self.rabit_params["pose"]], 1)
+		R = batch_rodrigues(pose_cube.reshape(-1, 3)).view(self.batch_size, -1, 3, 3)
+		G, _ = th_global_transforms(R, J.expand(self.batch_size, -1, -1), self.rabit.kintree_parents, self.rabit.kintree_levels)
+		return G[:, :, :3, 3]*self.rabit_params["scale"] + self.rabit_params["trans"].unsqueeze(1)
+
+	@torch.no_grad()
+	def export(self):
+		"""
+		Vertices [T, 38726, 3], posed joints [T, 24, 3] and translation [T, 3] of the fitted sequence (numpy)
+		"""
+		trans = self.rabit_params["trans"].numpy()
+		verts, _ = self.rabit.batch_update(self.rabit_params["pose"].numpy(), beta=self.rabit_params["beta"].numpy(),
+			global_pose=self.rabit_params["global_pose"].numpy())
+		verts = verts*float(self.rabit_params["scale"]) + trans[:, None, :]
+		return verts, self().numpy(), trans
+
+
+def fit_rabit(rabitRetargetter, logger, max_epoch=None):
+	"""
+	Optimize the parameters of rabitRetargetter to match the SMPL joints, stops early once the loss stops improving (Meters)
+	"""
+	cfg = rabitRetargetter.cfg.RABIT
+	meters = Meters()
+	if max_epoch is None:
+		max_epoch = cfg.MAX_EPOCH
+
+	for epoch in range(max_epoch):
+		joints = rabitRetargetter()
+		pose = rabitRetargetter.rabit_params["pose"]
+
+		loss_data = F.smooth_l1_loss(joints, rabitRetargetter.target)
+		loss_temporal = F.smooth_l1_loss(pose[1:], pose[:-1]) if pose.shape[0] > 1 else torch.zeros(())
+		loss_beta = (rabitRetargetter.rabit_params["beta"] - rabitRetargetter.beta_init).norm()
+		loss = loss_data + cfg.LAMBDA_TEMPORAL*loss_temporal + cfg.LAMBDA_BETA*loss_beta
+
+		rabitRetargetter.optimizer.zero_grad()
+		loss.backward()
+		rabitRetargetter.optimizer.step()
+
+		meters.update_early_stop(loss.item())
+		if meters.early_stop:
+			break
+
+	logger.info(f"RaBit fit: epoch {epoch} loss:{loss.item():.6f} data:{loss_data.item():.6f} scale:{rabitRetargetter.rabit_params['scale'].item():.4f}")
+	return meters
+
+
+def retarget_smpl2rabit(sample:OpenCapDataLoader,export=RABIT_EXPORT):
+	"""
+		export: 'mesh' single animated mesh store (store.rabit_mesh_path) or 'obj' textured .obj per frame
+	"""
 
 	# Log progress
 	logger, writer = get_logger(task_name='Retarget2Rabit')
 	logger.info(f"Retargetting file:{sample.openCapID}_{sample.label}")
 
-	# Metrics to measure
-	meters = Meters()
-
 	# Visualizer
 	vis = Visualizer()
 
-	# GPU mode
-	if cuda and torch.cuda.is_available():
-		device = torch.device('cuda')
-	else:
-		device = torch.device('cpu')
-		
 	# Define Rabit Module
 	rabit = RaBitModel()	
 
 
-	# Create random texture and save
-	if not os.path.isfile(os.path.join(RENDER_DIR,sample.name,"RaBit",f"m_t.png")):
-		os.makedirs(os.path.join(RENDER_DIR,sample.name,"RaBit"),exist_ok=True)
-		texture_util.generate_texture(os.path.join(RENDER_DIR,sample.name,"RaBit",f"m_t.png"),network_pkl=os.path.join(RABIT_DIR,'rabit_data/texture/texture.pkl'))
+	# Texture of the subject from the pool (generated once for all samples)
+	os.makedirs(os.path.join(RENDER_DIR,sample.name,"RaBit"),exist_ok=True)
+	link_texture(subject_texture(sample.openCapID),os.path.join(RENDER_DIR,sample.name,"RaBit",f"m_t.png"))
 	shutil.copyfile(os.path.join(RABIT_DIR,"rabit_data/UV/m_t.mtl"), os.path.join(RENDER_DIR,sample.name,"RaBit",f"m_t.mtl"))
 
 
-	# Run TODO inverse kinematic and other optimizations to affect pose to match contacts of the scene  
 
-	for frame in range(sample.num_frames):
-		if not os.path.isfile(os.path.join(RENDER_DIR,sample.name,"RaBit", f"{frame}.obj")):
-			rabit.load_smpl_params(sample.smpl.smpl_params,frame)
-			rabit.save_to_obj_with_texture(os.path.join(RENDER_DIR,sample.name,"RaBit", f"{frame}.obj"))
+	mesh_path = rabit_mesh_path(sample.name)
+	# The completion marker skips checking the frames of exported samples, it is only valid for the same SMPL result
+	smpl_key = result_cache_key(find_smpl_result(sample.name))
+	export_done = rabit_export_done(sample.name,sample.num_frames,export,smpl_key)
+	if not export_done and export == 'mesh' and smpl_key is not None and ArrayStore.exists(mesh_path):
+		# Marker lost, the mesh store records the SMPL result it was fit to
+		mesh_store = ArrayStore.open(mesh_path)
+		export_done = len(mesh_store) == sample.num_frames and mesh_store.attrs.get('smpl_cache_key') == smpl_key
+		if export_done:
+			mark_rabit_export(sample.name,sample.num_frames,export,smpl_key)
+
+	# Without a matching marker the existing frames can come from another SMPL result (or RaBit body), all frames are refit
+	if not export_done:
+		# Fit RaBit to the SMPL joints of the whole sequence
+		with torch.no_grad():
+			_,smpl_joints,_ = sample.smpl(joints_only=True)
+		rabitRetargetter = RaBitRetarget(rabit,sample.smpl.pose_axis_angle().detach().cpu(),smpl_joints.cpu())
+		fit_rabit(rabitRetargetter,logger)
+		verts,joints,trans = rabitRetargetter.export()
+
+		if export == 'mesh':
+			rabit.save_to_mesh_store(mesh_path,verts,trans,joints,smpl_key=smpl_key)
+		else:
+			rabit.save_to_obj_sequence([os.path.join(RENDER_DIR,sample.name,"RaBit", f"{frame}.obj") for frame in range(sample.num_frames)],verts)
+
+		mark_rabit_export(sample.name,sample.num_frames,export,smpl_key)
 
 	sample.rabit = rabit
 
-	vis.render_rabit(sample)
+	# Interactive view, there is no window with the headless backend
+	if vis.backend == 'numpy':
+		logger.info("Headless rendering backend, skipping the RaBit view (see renderer.render_rabit with video_dir)")
+	else:
+		vis.render_rabit(sample)
 
 	# smplRetargetter = SMPLRetarget(sample.joints_np.shape[0],device=device).to(device)
 	logger.info(f"SMPL to RaBit Retargetting Done")	
-	logger.info(smplRetargetter.cfg.TRAIN)
+	logger.info(sample.smpl.cfg.TRAIN)
 
 	return sample.rabit
 
@@ -425,15 +743,8 @@ def retarget_dataset():
 	for subject in os.listdir(DATASET_DIR):
 		for sample_path in os.listdir(os.path.join(DATASET_DIR,subject,'MarkerData')):
 			sample_path = os.path.join(DATASET_DIR,subject,'MarkerData',sample_path)
-			sample = OpenCapDataLoader(sample_path)
-			
-			if not os.path.isfile(os.path.join(SMPL_DIR,sample.name+'.pkl')): 
-				sample.smpl = retarget_opencap2smpl(sample)
-			else:	
-				torch_device = torch.device('cuda' if cuda else 'cpu')	
-				sample.smpl = SMPLRetarget(sample.joints_np.shape[0],device=torch_device).to(torch_device)	
-				sample.smpl.load(os.path.join(SMPL_DIR,sample.name+'.pkl'))
-
+			# SMPL result is refit if missing or stale (cache key mismatch, see retarget2smpl.retarget_sample)
+			sample = retarget_sample(sample_path)
 			sample.rabit = retarget_smpl2rabit(sample)
 
 
@@ -443,14 +754,5 @@ if __name__ == "__main__":
 	if len(sys.argv) == 1: 
 		retarget_dataset()
 	else:
-		sample_path = sys.argv[1]
-		sample = OpenCapDataLoader(sample_path)
-
-		if not os.path.isfile(os.path.join(SMPL_DIR,sample.name+'.pkl')): 
-			sample.smpl = retarget_opencap2smpl(sample)
-		else:	
-			torch_device = torch.device('cuda' if cuda else 'cpu')	
-			sample.smpl = SMPLRetarget(sample.joints_np.shape[0],device=torch_device).to(torch_device)	
-			sample.smpl.load(os.path.join(SMPL_DIR,sample.name+'.pkl'))
+		sample = retarget_sample(sys.argv[1])
 		sample.rabit = retarget_smpl2rabit(sample)
-	
\ No newline at end of file
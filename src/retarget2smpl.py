@@ -25,26 +25,54 @@ from utils import * # Config details
 from dataloader import OpenCapDataLoader,SMPLLoader # To load TRC file
 from smplpytorch.pytorch.smpl_layer import SMPL_Layer # SMPL Model
 from meters import Meters # Metrics to measure inverse kinematics
+from rotations import interpolate_axis_angle, interpolate_linear # Upsample coarse poses
+from rotations import axis_angle_to_quaternion, quaternion_to_axis_angle, axis_angle_to_rotation_6d, rotation_6d_to_axis_angle # Pose parameterizations
+from rotations import quaternion_to_matrix, rotation_6d_to_matrix
+from smplpytorch.pytorch.rodrigues_layer import batch_rodrigues
+from telemetry import Telemetry # Batched metrics logging
+from profiler import StageProfiler, report # Stage timers (--profile)
+from store import save_smpl, load_smpl, smpl_store_path, find_smpl_result, result_cache_key # Result storage
+from cache import cache_key # Content addressed cache keys
 from renderer import Visualizer
 
+# Disabled unless --profile is passed on the command line, see __main__
+PROFILER = StageProfiler()
+
 class SMPLRetarget(nn.Module):
-	def __init__(self,batch_size,device=torch.device('cpu')):
+	# Optimized pose variable for every rotation parameterization (ROTATION_REP) and its size per joint
+	POSE_REPS = {"axis_angle": ("pose_params",3), "6d": ("pose_6d",6), "quaternion": ("pose_quaternion",4)}
+
+	def __init__(self,batch_size,device=torch.device('cpu'),body_params=None,smpl_layer=None,rotation_rep=None):
+		"""
+			body_params: Optional dict with shape_params, scale and offset (see calibrate_subject). 
+						 If provided these are loaded and frozen, only pose and trans get optimized.  
+			smpl_layer: Optional SMPL_Layer to use instead of loading the model from SMPL_MODEL_DIR (eg. synthetic model in benchmark.py)
+			rotation_rep: Parameterization of the optimized joint rotations, 'axis_angle', '6d' or 'quaternion'. Defaults to cfg.TRAIN.ROTATION_REP. 
+						  Poses are always converted to axis-angle for the SMPL layer and for saving (see pose_axis_angle)
+		"""
 		super(SMPLRetarget, self).__init__()
 
 		# Create the SMPL layer
-		self.smpl_layer = SMPL_Layer(center_idx=0,gender='neutral',model_root=os.path.join(HOME_DIR,'smplpytorch/native/models')).to(device)
+		if smpl_layer is None: 
+			smpl_layer = SMPL_Layer(center_idx=0,gender='neutral',model_root=SMPL_MODEL_DIR)
+		self.smpl_layer = smpl_layer.to(device)
 		self.cfg = self.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json'))
 
 		# Set utils
 		self.device = device
 		self.batch_size = batch_size
+		self.rotation_rep = self.cfg.TRAIN.ROTATION_REP if rotation_rep is None else rotation_rep
+		assert self.rotation_rep in self.POSE_REPS, f"Unknown rotation representation:{self.rotation_rep}, use one of {list(self.POSE_REPS)}"
+		self.pose_key = self.POSE_REPS[self.rotation_rep][0]
 
 		# Declare/Set/ parameters
 		smpl_params = {}
 		smpl_params["pose_params"] = torch.zeros(batch_size, 72)
 
 		smpl_params["pose_params"][:,:3] = torch.from_numpy(np.tile(ROOT_INIT_ROTVEC[None,:],(batch_size,1))) # ROTATION VECTOR to initialize root joint orientation 
-		smpl_params["pose_params"].requires_grad = True
+		if self.pose_key != "pose_params": 
+			smpl_params[self.pose_key] = self.from_axis_angle(smpl_params.pop("pose_params"))
+		smpl_params[self.pose_key].requires_grad = True
 
 		smpl_params["trans"] = torch.zeros(batch_size, 3)
 		smpl_params["trans"].requires_grad = True
@@ -62,6 +90,12 @@ class SMPLRetarget(nn.Module):
 		smpl_params["offset"] = torch.zeros((24,3))
 		smpl_params["offset"].requires_grad = bool(self.cfg.TRAIN.OPTIMIZE_OFFSET)
 
+		# Subject calibrated body, keep it fixed for the sequence
+		if body_params is not None: 
+			for k in ["shape_params","scale","offset"]:
+				smpl_params[k] = torch.from_numpy(np.array(body_params[k])).float().reshape(smpl_params[k].shape)
+				smpl_params[k].requires_grad = False
+
 
 		for k in smpl_params: 
 			smpl_params[k] = nn.Parameter(smpl_params[k].to(device),requires_grad=smpl_params[k].requires_grad)
@@ -91,7 +125,7 @@ class SMPLRetarget(nn.Module):
 
 		self.optimizer = optim.Adam([{'params': self.smpl_params["scale"], 'lr': self.cfg.TRAIN.LEARNING_RATE},
 			{'params': self.smpl_params["shape_params"], 'lr': self.cfg.TRAIN.LEARNING_RATE},
-			{'params': self.smpl_params["pose_params"], 'lr': self.cfg.TRAIN.LEARNING_RATE},{'params': self.smpl_params["trans"], 'lr': self.cfg.TRAIN.LEARNING_RATE},
+			{'params': self.smpl_params[self.pose_key], 'lr': self.cfg.TRAIN.LEARNING_RATE},{'params': self.smpl_params["trans"], 'lr': self.cfg.TRAIN.LEARNING_RATE},
 			{'params': self.smpl_params["offset"], 'lr': self.cfg.TRAIN.LEARNING_RATE},
 			])
 		self.scheduler = optim.lr_scheduler.ExponentialLR(self.optimizer, gamma=0.9)
@@ -104,47 +138,127 @@ class SMPLRetarget(nn.Module):
 		cfg = edict(data.copy())
 		return cfg	
 
-	def forward(self):
+	def from_axis_angle(self,pose):
+		"""
+			Axis-angle poses (B x 72) to the optimized parameterization (B x 24*D)
+		"""
+		pose = pose.reshape(pose.shape[0],-1,3)
+		if self.rotation_rep == "6d":
+			pose = axis_angle_to_rotation_6d(pose)
+		elif self.rotation_rep == "quaternion":
+			pose = axis_angle_to_quaternion(pose)
+		return pose.reshape(pose.shape[0],-1)
+
+	def pose_axis_angle(self):
+		"""
+			Optimized poses as axis-angle (B x 72), differentiable
+		"""
+		pose = self.smpl_params[self.pose_key]
+		if self.rotation_rep == "axis_angle":
+			return pose
+		pose = pose.reshape(self.batch_size,-1,self.POSE_REPS[self.rotation_rep][1])
+		if self.rotation_rep == "6d":
+			pose = rotation_6d_to_axis_angle(pose)
+		else:
+			pose = quaternion_to_axis_angle(pose)
+		return pose.reshape(self.batch_size,-1)
+
+	def pose_matrices(self):
+		"""
+			Optimized poses as rotation matrices (B x 24 x 3 x 3), differentiable. 
+			Computed from the optimized parameterization, unlike axis-angle it has no jump when the angle crosses pi.
+		"""
+		pose = self.smpl_params[self.pose_key].reshape(self.batch_size,-1,self.POSE_REPS[self.rotation_rep][1])
+		if self.rotation_rep == "axis_angle":
+			return batch_rodrigues(pose.reshape(-1,3)).reshape(self.batch_size,-1,3,3)
+		elif self.rotation_rep == "6d":
+			return rotation_6d_to_matrix(pose)
+		return quaternion_to_matrix(pose)
+
+	@torch.no_grad()
+	def set_pose(self,pose):
+		"""
+			Set the optimized poses from axis-angle (B x 72)
+		"""
+		self.smpl_params[self.pose_key][:] = self.from_axis_angle(pose.reshape(self.batch_size,-1))
+
+	def forward(self,joints_only=False,frames=None):
+		"""
+			joints_only: Skip skinning the mesh, verts is None
+			frames: Optional frame indices, only these frames are posed (eg. strided preview)
+		"""
+		pose = self.pose_axis_angle()
+		trans = self.smpl_params['trans']
+		if frames is not None: 
+			pose,trans = pose[frames],trans[frames]
+
 		# print("Shape Params:",self.smpl_params['shape_params'])
-		shape_params = self.smpl_params['shape_params'].repeat(self.batch_size,1)
-		verts, Jtr, Jtr_offset = self.smpl_layer(self.smpl_params['pose_params'], th_betas=shape_params,th_offset=self.smpl_params['offset'])
+		shape_params = self.smpl_params['shape_params'].repeat(pose.shape[0],1)
+		verts, Jtr, Jtr_offset = self.smpl_layer(pose, th_betas=shape_params,th_offset=self.smpl_params['offset'],joints_only=joints_only)
 
-		verts = verts*self.smpl_params["scale"] + self.smpl_params['trans'].unsqueeze(1)
-		Jtr   = Jtr*self.smpl_params["scale"] + self.smpl_params['trans'].unsqueeze(1)
-		Jtr_offset   = Jtr_offset*self.smpl_params["scale"] + self.smpl_params['trans'].unsqueeze(1) 
+		if verts is not None: 
+			verts = verts*self.smpl_params["scale"] + trans.unsqueeze(1)
+		Jtr   = Jtr*self.smpl_params["scale"] + trans.unsqueeze(1)
+		Jtr_offset   = Jtr_offset*self.smpl_params["scale"] + trans.unsqueeze(1) 
 
 		return verts, Jtr, Jtr_offset
 
 
-	def save(self,save_path):
+	@torch.no_grad()
+	def save(self,save_path,save_verts=False,pose_encoding=None,attrs={}):
 		"""
-			Save SMPL parameters as a pickle file
+			Save SMPL parameters and joints as a store (see store.py)
+
+			save_verts: Also store the mesh vertices of every frame
+			pose_encoding: float32, float16 or int16, defaults to cfg.STORE.POSE_ENCODING
 		"""	
-		assert not os.path.isdir(save_path),f"Location to save file:{save_path} is a directory"
+		assert not os.path.isfile(save_path),f"Location to save store:{save_path} is a file"
 
-		res = self.smpl_params.copy()
-		verts, Jtr, Jtr_offset = self()
+		res = dict([(k,self.smpl_params[k].cpu().data.numpy()) for k in self.smpl_params if k != self.pose_key])
+		res['pose_params'] = self.pose_axis_angle().cpu().data.numpy()
+		verts, Jtr, Jtr_offset = self(joints_only=not save_verts)
 
-		res['joints'] = Jtr
+		save_smpl(save_path,res,joints=Jtr.cpu().data.numpy(),verts=verts.cpu().data.numpy() if save_verts else None,
+			pose_encoding=self.cfg.STORE.POSE_ENCODING if pose_encoding is None else pose_encoding,attrs=attrs)
 
+	def body_params(self):
+		"""
+			Subject specific parameters (shape_params, scale, offset) as numpy arrays
+		"""
+		return dict([ (k,self.smpl_params[k].cpu().data.numpy()) for k in ["shape_params","scale","offset"]])
 
-		for r in res: 
-			res[r] = res[r].cpu().data.numpy()
+	@torch.no_grad()
+	def upsample_from(self,coarse,key_frames):
+		"""
+			Initialize from a retargetter fit on a subset of frames.
+			Poses are slerp-ed between key frames, trans is linearly interpolated and the body parameters are copied.
 
-		with open(save_path, 'wb') as f:
-			pickle.dump(res, f)	
+			coarse: SMPLRetarget with batch_size = len(key_frames)
+			key_frames: sorted LongTensor of frame indices starting at 0 and ending at self.batch_size-1
+		"""
+		key_frames = key_frames.to(self.device)
+		pose = coarse.pose_axis_angle().reshape(coarse.batch_size,-1,3)
+		self.set_pose(interpolate_axis_angle(pose,key_frames,self.batch_size))
+		self.smpl_params['trans'][:] = interpolate_linear(coarse.smpl_params['trans'],key_frames,self.batch_size)
+		for k in ["shape_params","scale","offset"]:
+			self.smpl_params[k][:] = coarse.smpl_params[k]
 
 	def load(self,save_path):
 
+		"""
+			Load a store saved by save (or a legacy pickle file)
+		"""
 		try: 
-			with open(save_path, 'rb') as f:
-				smpl_params = pickle.load(f)
+			smpl_params = load_smpl(save_path)
 		except Exception as e: 
 			print(f"Unable to open smpl file:{save_path} Try deleting the file and rerun retargetting. Error:{e}")
 			raise
 
 		for k in smpl_params: 
-			smpl_params[k] = torch.from_numpy(smpl_params[k]).to(self.device)	
+			smpl_params[k] = torch.from_numpy(np.asarray(smpl_params[k],dtype=np.float32)).to(self.device)	
+
+		# Saved poses are axis-angle
+		smpl_params[self.pose_key] = self.from_axis_angle(smpl_params['pose_params'])
 
 		for k in self.smpl_params: 
 			self.smpl_params[k] = smpl_params[k]
@@ -154,210 +268,463 @@ class SMPLRetarget(nn.Module):
 		return f"Scale:{self.smpl_params['scale']} Trans:{self.smpl_params['trans'].mean(dim=0)} Betas:{self.smpl_params['shape_params']} Offset:{self.smpl_params['offset']}"        
 
 
-def retarget_opencap2smpl(sample:OpenCapDataLoader):
-
-	# Log progress
-	logger, writer = get_logger(task_name='Retarget')
-	logger.info(f"Retargetting file:{sample.openCapID}_{sample.label}")
-
-	# Metrics to measure
-	meters = Meters()
-
-	# Visualizer
-	vis = Visualizer()
-
+def get_device():
 	# GPU mode
 	if cuda and torch.cuda.is_available():
 		device = torch.device('cuda')
 	else:
 		device = torch.device('cpu')
+	return device
 
 
+def smpl_loss(smplRetargetter,target,Jtr,Jtr_offset,temporal_reg=True,lambda_temporal=10,prev_pose=None):
+	"""
+		Retargetting objective, see fit_smpl for the arguments
+		Returns total loss and a dict of the individual terms (tensors)
+	"""
 
-	target = torch.from_numpy(sample.joints_np).float()
-	target = target.to(device)
+	# print("Per joint loss:",torch.mean(torch.abs(scale*Jtr.index_select(1, index["smpl_index"])-target.index_select(1, index["dataset_index"])),dim=0))
 
-	smplRetargetter = SMPLRetarget(sample.joints_np.shape[0],device=device).to(device)
-	logger.info(f"OpenCap to SMPL Retargetting details:{smplRetargetter.index}")	
-	logger.info(smplRetargetter.cfg.TRAIN)
+	# DATA Loss Terms
+	loss_data = F.smooth_l1_loss(Jtr.index_select(1, smplRetargetter.index["smpl_index"]) ,
+							target.index_select(1, smplRetargetter.index["dataset_index"]))
 
-	# Intialize trans at root joint location
-	with torch.no_grad():
-		smplRetargetter.smpl_params['trans'][:] = target[:,smplRetargetter.index["dataset_index"][0]]
 
-	# Forward from the SMPL layer
-	# if DEBUG: 
-		# verts, Jtr, Jtr_offset = smplRetargetter()
 
+	loss_data_offset = F.smooth_l1_loss(Jtr_offset.index_select(1, smplRetargetter.index["smpl_index"]) ,
+							target.index_select(1, smplRetargetter.index["dataset_index"]))
+	
 
+	loss_trans = F.smooth_l1_loss(smplRetargetter.smpl_params['trans'],target[:,smplRetargetter.index["dataset_index"][0],:])
 
-	for epoch in tqdm(range(smplRetargetter.cfg.TRAIN.MAX_EPOCH)):
+	# Regularizers
+	# Smoothness in the optimized representation. Optimized axis-angle is continuous and is compared directly, 
+	# 6d and quaternion go through rotation matrices (||R_t - R_t-1||) since their axis-angle conversion flips direction at pi
+	if smplRetargetter.rotation_rep == "axis_angle":
+		pose_params = smplRetargetter.pose_axis_angle()
+		if prev_pose is not None: 
+			pose_params = torch.cat([prev_pose.reshape(1,-1),pose_params],dim=0)
+	else:
+		pose_params = smplRetargetter.pose_matrices()
+		if prev_pose is not None: 
+			pose_params = torch.cat([batch_rodrigues(prev_pose.reshape(-1,3)).reshape(1,-1,3,3),pose_params],dim=0)
 
-		
-		# logger.debug(smplRetargetter)
-		verts,Jtr,Jtr_offset = smplRetargetter()
+	if temporal_reg and pose_params.shape[0] > 1:
+		loss_temporal_smooth_reg = F.smooth_l1_loss(pose_params[1:],pose_params[:-1])
+	else: 
+		loss_temporal_smooth_reg = torch.zeros((),device=target.device)
 
+	loss_offset_min = smplRetargetter.smpl_params['offset'].norm()
 
-		# print("Per joint loss:",torch.mean(torch.abs(scale*Jtr.index_select(1, index["smpl_index"])-target.index_select(1, index["dataset_index"])),dim=0))
+	loss_beta = smplRetargetter.smpl_params['shape_params'].norm()
 
-		# verts *= scale
 
+	# logger.debug(f"LAMBDA OFFSET:{smplRetargetter.cfg.TRAIN.LAMBDA_NORM_OFFSET}")
+	loss = loss_data 
+	loss += loss_data_offset 
+	loss += lambda_temporal*loss_temporal_smooth_reg 
+	loss += 1e-6*loss_offset_min  # U
+	loss += 0.00001*loss_beta 
+	# loss += smplRetargetter.cfg.TRAIN.LAMBDA_TRANS*loss_trans
 
-		# DATA Loss Terms
-		loss_data = F.smooth_l1_loss(Jtr.index_select(1, smplRetargetter.index["smpl_index"]) ,
-								target.index_select(1, smplRetargetter.index["dataset_index"]))
+	# criterion = nn.L1Loss(reduction ='none')
+	# weights = torch.ones(Jtr.index_select(1, index["smpl_index"]).shape)
 
+	# loss = criterion(scale*Jtr.index_select(1, index["smpl_index"]),
+	#                         target.index_select(1, index["dataset_index"])) * weights
 
+	loss_terms = {"Data":loss_data, "Offset":loss_data_offset, "Trans":loss_trans,
+				"Reg Offset":loss_offset_min, "Reg Temporal":loss_temporal_smooth_reg, "Reg BETA Norm":loss_beta}
 
-		loss_data_offset = F.smooth_l1_loss(Jtr_offset.index_select(1, smplRetargetter.index["smpl_index"]) ,
-								target.index_select(1, smplRetargetter.index["dataset_index"]))
-		
+	return loss,loss_terms
 
-		loss_trans = F.smooth_l1_loss(smplRetargetter.smpl_params['trans'],target[:,smplRetargetter.index["dataset_index"][0],:])
 
-		# Regularizers
-		loss_temporal_smooth_reg = F.smooth_l1_loss(smplRetargetter.smpl_params['pose_params'][1:],smplRetargetter.smpl_params['pose_params'][:-1])
+def fit_smpl(smplRetargetter,target,logger,writer,max_epoch=None,temporal_reg=True,lambda_temporal=10,prev_pose=None,profiler=PROFILER):
+	"""
+		Optimize the parameters of smplRetargetter to match the target joints 
 
-		loss_offset_min = smplRetargetter.smpl_params['offset'].norm()
+		target: Tensor (T x 20 x 3) of OpenCap joints
+		max_epoch: Number of epochs, defaults to cfg.TRAIN.MAX_EPOCH
+		temporal_reg: Disable when frames are not consecutive (eg. during subject calibration)  
+		lambda_temporal: Weight of the temporal smoothness regularizer
+		prev_pose: Optional fixed pose (72) of the frame preceding target, smoothness is also enforced across this boundary (online retargetting)
+		profiler: StageProfiler timing the epoch stages, disabled by default
+	"""
 
-		loss_beta = smplRetargetter.smpl_params['shape_params'].norm()
+	# Metrics to measure
+	meters = Meters()
+	telemetry = Telemetry.from_config(writer,smplRetargetter.cfg)
+	losses = []
 
+	if max_epoch is None: 
+		max_epoch = smplRetargetter.cfg.TRAIN.MAX_EPOCH
 
-		# logger.debug(f"LAMBDA OFFSET:{smplRetargetter.cfg.TRAIN.LAMBDA_NORM_OFFSET}")
-		loss = loss_data 
-		loss += loss_data_offset 
-		loss += 10*loss_temporal_smooth_reg 
-		loss += 1e-6*loss_offset_min  # U
-		loss += 0.00001*loss_beta 
-		# loss += smplRetargetter.cfg.TRAIN.LAMBDA_TRANS*loss_trans
+	for epoch in tqdm(range(max_epoch)):
 
+		profiler.epoch(epoch)
+		
+		# logger.debug(smplRetargetter)
+		with profiler.stage('forward'):
+			verts,Jtr,Jtr_offset = smplRetargetter()
 
-		if epoch % smplRetargetter.cfg.TRAIN.WRITE == 0  or epoch == smplRetargetter.cfg.TRAIN.MAX_EPOCH-1:
-			logger.info("Epoch {}, LR:{:.6f} lossPerBatch={:.6f} Data={:.6f} Offset={:.6f} Trans:{:.6f} Offset Norm={:.6f}  Temporal Reg:{:.6f} Beta Norm:{:.6f}".format(epoch, float(smplRetargetter.scheduler._last_lr[-1]) , float(loss),float(loss_data),float(loss_data_offset),float(loss_trans),float(loss_offset_min),float(loss_temporal_smooth_reg),float(loss_beta)))
-			logger.debug(f"scale:{smplRetargetter.smpl_params['scale']}")
-			logger.debug(f"Beta:{smplRetargetter.smpl_params['shape_params']}")
-			
-			for x,y in zip(["LR", "lossPerBatch", "Data", "Offset", "Trans", "Reg Offset", "Reg Temporal", "Reg BETA Norm"],\
-						[smplRetargetter.scheduler._last_lr[-1] , loss,loss_data,loss_data_offset,loss_trans,loss_offset_min,loss_temporal_smooth_reg,loss_beta]):
-				writer.add_scalar(x, float(y), epoch)
-			
-			# writer.add_scalar('learning_rate', float(smplRetargetter.optimizer.state_dict()['param_groups'][0]['lr']), epoch)
+		with profiler.stage('loss'):
+			loss,loss_terms = smpl_loss(smplRetargetter,target,Jtr,Jtr_offset,temporal_reg=temporal_reg,lambda_temporal=lambda_temporal,prev_pose=prev_pose)
 
-			smplRetargetter.scheduler.step()
+		# Metrics stay on device until the end of the fit
+		telemetry.log(epoch, LR=smplRetargetter.scheduler._last_lr[-1], lossPerBatch=loss, **loss_terms)
 
-		# criterion = nn.L1Loss(reduction ='none')
-		# weights = torch.ones(Jtr.index_select(1, index["smpl_index"]).shape)
+		if epoch % smplRetargetter.cfg.TRAIN.WRITE == 0  or epoch == max_epoch-1:
+			# Progress log (TELEMETRY.PROGRESS), all terms copied to host in one sync
+			if smplRetargetter.cfg.TELEMETRY.PROGRESS:
+				values = torch.stack([loss.detach()] + [value.detach().reshape(()) for value in loss_terms.values()]).tolist()
+				logger.info(f"Epoch {epoch}, LR:{float(smplRetargetter.scheduler._last_lr[-1]):.6f} " + " ".join([f"{name}={value:.6f}" for name,value in zip(["lossPerBatch",*loss_terms.keys()],values)]))
+			# writer.add_scalar('learning_rate', float(smplRetargetter.optimizer.state_dict()['param_groups'][0]['lr']), epoch)
 
-		# loss = criterion(scale*Jtr.index_select(1, index["smpl_index"]),
-		#                         target.index_select(1, index["dataset_index"])) * weights
+		with profiler.stage('backward'):
+			smplRetargetter.optimizer.zero_grad()
 
-		smplRetargetter.optimizer.zero_grad()
+			# logger.info(f"Loss:{loss}")
 
-		# logger.info(f"Loss:{loss}")
+			loss.backward()
 
-		loss.backward()
+		with profiler.stage('optimizer_step'):
+			# Don't update all beta parameters
+			if smplRetargetter.smpl_params['shape_params'].grad is not None:
+				smplRetargetter.smpl_params['shape_params'].grad[smplRetargetter.cfg.TRAIN.MAX_BETA_UPDATE_DIM:] = 0
+			
+			smplRetargetter.optimizer.step()
 
-		# Don't update all beta parameters
-		if smplRetargetter.smpl_params['shape_params'].grad is not None:
-			smplRetargetter.smpl_params['shape_params'].grad[smplRetargetter.cfg.TRAIN.MAX_BETA_UPDATE_DIM:] = 0
-		
-		smplRetargetter.optimizer.step()
+			# Decay every WRITE epochs, after the optimizer step so the first LR of the schedule is used
+			if epoch % smplRetargetter.cfg.TRAIN.WRITE == 0  or epoch == max_epoch-1:
+				smplRetargetter.scheduler.step()
 
-		meters.update_early_stop(float(loss))
+		# Keep the losses on device, float(loss) every epoch forces a host sync
+		losses.append(loss.detach())
 		# if meters.update_res:
 
 		# if meters.early_stop or loss <= 0.00005:
 		#     logger.info("Early stop at epoch {} !".format(epoch))
 		#     break
 
+	# Loss per epoch (convergence comparisons in benchmark.py)
+	meters.loss_history = torch.stack(losses).cpu().numpy()
+	meters.update_early_stop(float(meters.loss_history.min()))
+
+	telemetry.flush()
+	logger.debug(f"scale:{smplRetargetter.smpl_params['scale']}")
+	logger.debug(f"Beta:{smplRetargetter.smpl_params['shape_params']}")
+
+	return meters
+
+
+def fit_coarse_to_fine(smplRetargetter,target,logger,writer,body_params=None,profiler=PROFILER):
+	"""
+		Multi-resolution schedule. Motion is smooth at capture rate, so first fit every STRIDE-th frame 
+		for COARSE_EPOCH epochs, upsample (slerp) to all frames and refine for FINE_EPOCH epochs.  
+	"""
+	cfg = smplRetargetter.cfg.COARSE_TO_FINE
+	T = smplRetargetter.batch_size
+
+	key_frames = torch.arange(0,T,cfg.STRIDE)
+	if key_frames[-1] != T-1: 
+		key_frames = torch.cat([key_frames,torch.LongTensor([T-1])])
+	logger.info(f"Coarse to fine: {len(key_frames)} key frames out of {T}")
+
+	with profiler.stage('smpl_layer'):
+		coarse = SMPLRetarget(len(key_frames),device=smplRetargetter.device,body_params=body_params).to(smplRetargetter.device)
+	coarse_target = target[key_frames.to(target.device)]
+	with torch.no_grad():
+		coarse.smpl_params['trans'][:] = coarse_target[:,coarse.index["dataset_index"][0]]
+	# Key frames are STRIDE apart, so pose differences are STRIDE times larger. Scale down the smoothness weight to match the full rate objective 
+	fit_smpl(coarse,coarse_target,logger,writer,max_epoch=cfg.COARSE_EPOCH,lambda_temporal=10/cfg.STRIDE**2,profiler=profiler)
+
+	smplRetargetter.upsample_from(coarse,key_frames)
+
+	# Start the refinement from a lower learning rate, poses are already close
+	for param_group in smplRetargetter.optimizer.param_groups: 
+		param_group['lr'] *= cfg.FINE_LR_SCALE
+
+	return fit_smpl(smplRetargetter,target,logger,writer,max_epoch=cfg.FINE_EPOCH,profiler=profiler)
+
+
+def retarget_opencap2smpl(sample:OpenCapDataLoader,body_params=None,result_key=None,preview=False,profiler=PROFILER):
+	"""
+		body_params: Calibrated subject body (see calibrate_subject). If None shape, scale and offset are optimized per sequence. 
+		result_key: Cache key saved with the result to detect stale results (see sample_cache_key)
+		preview: Render a short low resolution skeleton clip instead of the full video
+		profiler: StageProfiler timing the stages, disabled by default
+	"""
+
+	# Log progress
+	logger, writer = get_logger(task_name='Retarget')
+	logger.info(f"Retargetting file:{sample.openCapID}_{sample.label}")
+
+	# Visualizer
+	vis = Visualizer()
+
+	device = get_device()
+
+	target = torch.from_numpy(sample.joints_np).float()
+	target = target.to(device)
+
+	with profiler.stage('smpl_layer'):
+		smplRetargetter = SMPLRetarget(sample.joints_np.shape[0],device=device,body_params=body_params).to(device)
+	logger.info(f"OpenCap to SMPL Retargetting details:{smplRetargetter.index}")	
+	logger.info(smplRetargetter.cfg.TRAIN)
+	if body_params is not None: 
+		logger.info(f"Using calibrated body for subject:{sample.openCapID}")
+
+	# Intialize trans at root joint location
+	with torch.no_grad():
+		smplRetargetter.smpl_params['trans'][:] = target[:,smplRetargetter.index["dataset_index"][0]]
 
+	# Forward from the SMPL layer
+	# if DEBUG: 
+		# verts, Jtr, Jtr_offset = smplRetargetter()
+
+	cfg = smplRetargetter.cfg
+	# Opt-in (COARSE_TO_FINE.ENABLE), compare per-joint error against the full-rate fit before enabling
+	if cfg.COARSE_TO_FINE.ENABLE and sample.num_frames > 2*cfg.COARSE_TO_FINE.STRIDE:
+		meters = fit_coarse_to_fine(smplRetargetter,target,logger,writer,body_params=body_params,profiler=profiler)
+	else:
+		meters = fit_smpl(smplRetargetter,target,logger,writer,profiler=profiler)
 
 
 	# smplRetargetter.show(target,verts,Jtr,Jtr_offset)
 	if not os.path.isdir(SMPL_DIR):
 		os.makedirs(SMPL_DIR,exist_ok=True)
 
-	save_path = os.path.join(SMPL_DIR,sample.name+'.pkl')
+	save_path = smpl_store_path(sample.name)
 	logger.info(f'Saving results at:{save_path}')
-	smplRetargetter.save(save_path)	
+	with profiler.stage('save'):
+		smplRetargetter.save(save_path,attrs={"cache_key":result_key})	
 
 
 	# Plot HIP and angle joints to visualize 
-	for i in range(smplRetargetter.smpl_params['pose_params'].shape[0]):
-		# LHIP 
-		writer.add_scalar(f"LHip-Z", float(smplRetargetter.smpl_params['pose_params'][i,1*3 + 0]),i )
-		writer.add_scalar(f"LHip-Y", float(smplRetargetter.smpl_params['pose_params'][i,1*3 + 1]),i )
-		writer.add_scalar(f"LHip-X", float(smplRetargetter.smpl_params['pose_params'][i,1*3 + 2]),i )
-		# RHIP 
-		writer.add_scalar(f"RHip-Z", float(smplRetargetter.smpl_params['pose_params'][i,2*3 + 0]),i )
-		writer.add_scalar(f"RHip-Y", float(smplRetargetter.smpl_params['pose_params'][i,2*3 + 1]),i )
-		writer.add_scalar(f"RHip-X", float(smplRetargetter.smpl_params['pose_params'][i,2*3 + 2]),i )
-
-		# L-Ankle 
-		writer.add_scalar(f"LAnkle-Z", float(smplRetargetter.smpl_params['pose_params'][i,7*3 + 0]),i )
-		writer.add_scalar(f"LAnkle-Y", float(smplRetargetter.smpl_params['pose_params'][i,7*3 + 1]),i )
-		writer.add_scalar(f"LAnkle-X", float(smplRetargetter.smpl_params['pose_params'][i,7*3 + 2]),i )
-
-		writer.add_scalar(f"RAnkle-Z", float(smplRetargetter.smpl_params['pose_params'][i,8*3 + 0]),i )
-		writer.add_scalar(f"RAnkle-Y", float(smplRetargetter.smpl_params['pose_params'][i,8*3 + 1]),i )
-		writer.add_scalar(f"RAnkle-X", float(smplRetargetter.smpl_params['pose_params'][i,8*3 + 2]),i )
+	hip_ankle_channels = {"LHip":1, "RHip":2, "LAnkle":7, "RAnkle":8}
+	channel_names = [f"{joint}-{axis}" for joint in hip_ankle_channels for axis in "ZYX"]
+	channel_index = [3*ind + i for ind in hip_ankle_channels.values() for i in range(3)]
+	Telemetry.from_config(writer,smplRetargetter.cfg).log_curves(sample.name,smplRetargetter.pose_axis_angle()[:,channel_index],channel_names)
 
 	video_dir = os.path.join(RENDER_DIR,f"{sample.openCapID}_{sample.label}_{sample.mcs}")
 
 	if RENDER:
-		vis.render_smpl(sample,smplRetargetter,video_dir=video_dir)        
+		with profiler.stage('render'):
+			vis.render_smpl(sample,smplRetargetter,video_dir=video_dir,preview=preview)        
 
 
 	logger.info('Train ended, min_loss = {:.4f}'.format(
 		float(meters.min_loss)))
 
-	writer.flush()
-	writer.close()	
+	if writer is not None: 
+		writer.flush()
+		writer.close()	
 
 
 	return smplRetargetter
 
 
-def retarget_sample(sample_path):
-	sample = OpenCapDataLoader(sample_path)
+def calibrate_subject(subject_dir):
+	"""
+		Stage 1 of two-stage retargetting. 
+		Fit shape_params, scale and offset once per subject using a subset of frames from all its samples.
+		Results are cached at CALIBRATION_DIR/<openCapID>.pkl  
+	"""
+	logger, writer = get_logger(task_name='Calibrate')
 
-	if not os.path.isfile(os.path.join(SMPL_DIR,sample.name+'.pkl')) or cmd_line_args.force: 
-		sample.smpl = retarget_opencap2smpl(sample)
+	cfg = SMPLRetarget.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json'))
+	device = get_device()
+
+	# Sample frames uniformly from every trc file of the subject
+	targets = []
+	trc_paths = subject_trc_paths(subject_dir)
+	for sample_path in trc_paths:
+		sample = OpenCapDataLoader(sample_path)
+		frame_inds = np.linspace(0,sample.num_frames-1,min(sample.num_frames,cfg.CALIBRATION.FRAMES_PER_SAMPLE)).astype(int)
+		targets.append(sample.joints_np[frame_inds])
+
+	openCapID = sample.openCapID
+	logger.info(f"Calibrating subject:{openCapID} using {len(targets)} samples")
+
+	target = torch.from_numpy(np.concatenate(targets,axis=0)).float().to(device)
+
+	smplRetargetter = SMPLRetarget(target.shape[0],device=device).to(device)
+	with torch.no_grad():
+		smplRetargetter.smpl_params['trans'][:] = target[:,smplRetargetter.index["dataset_index"][0]]
+
+	# Frames come from different samples, no temporal smoothness
+	meters = fit_smpl(smplRetargetter,target,logger,writer,max_epoch=cfg.CALIBRATION.MAX_EPOCH,temporal_reg=False)
+	logger.info('Calibration ended, min_loss = {:.4f}'.format(float(meters.min_loss)))
+
+	body_params = smplRetargetter.body_params()
+	body_params['cache_key'] = cache_key(trc_paths,cfg,smplRetargetter.smpl_layer.model_path)
+
+	os.makedirs(CALIBRATION_DIR,exist_ok=True)
+	with open(os.path.join(CALIBRATION_DIR,openCapID+'.pkl'), 'wb') as f:
+		pickle.dump(body_params, f)	
+
+	if writer is not None: 
+		writer.close()
+
+	return body_params
+
+
+def subject_trc_paths(subject_dir):
+	return [os.path.join(subject_dir,'MarkerData',x) for x in sorted(os.listdir(os.path.join(subject_dir,'MarkerData')))]
+
+
+def load_subject_calibration(subject_dir,cfg):
+	"""
+		Cached subject body parameters, None if missing or computed from different trc files/config/model. 
+	"""
+	openCapID = os.path.basename(os.path.normpath(subject_dir)).split('_')[-1]
+	calibration_path = os.path.join(CALIBRATION_DIR,openCapID+'.pkl')
+	if not os.path.isfile(calibration_path):
+		return None
+
+	with open(calibration_path, 'rb') as f:
+		body_params = pickle.load(f)
+
+	if body_params.get('cache_key') != cache_key(subject_trc_paths(subject_dir),cfg,SMPL_Layer.get_model_path(SMPL_MODEL_DIR,'neutral')):
+		return None
+	return body_params
+
+
+def get_subject_calibration(subject_dir,force=False):
+	"""
+		Load cached subject body parameters, calibrate if missing or stale. 
+	"""
+	cfg = SMPLRetarget.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json'))
+	body_params = None if force else load_subject_calibration(subject_dir,cfg)
+	if body_params is None: 
+		body_params = calibrate_subject(subject_dir)
+	return body_params
+
+
+def sample_cache_key(sample_path,cfg,body_params=None):
+	"""
+		Key of the retargetting result: trc content + effective config + SMPL model file (+ calibrated body)
+	"""
+	if body_params is not None:
+		body_params = dict([(k,body_params[k]) for k in ["shape_params","scale","offset"]])
+	return cache_key(sample_path,cfg,SMPL_Layer.get_model_path(SMPL_MODEL_DIR,'neutral'),body_params=body_params)
+
+
+def retarget_sample(sample_path,force=False,calibrate=False,preview=False,profiler=PROFILER,profile_records=None):
+	"""
+		Retarget a trc file, the saved result is reused if its cache key matches.
+		force: Retarget even if the saved result is up to date
+		calibrate: Use the calibrated subject body (two-stage retargetting)
+		preview: Render a short low resolution skeleton clip instead of the full video
+		profiler: StageProfiler timing the stages, its record is appended to profile_records
+	"""
+	profiler.reset()
+	with profiler.stage('trc_load'):
+		sample = OpenCapDataLoader(sample_path)
+	profiler.name = sample.name
+
+	cfg = SMPLRetarget.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json'))
+	body_params = None
+	if calibrate: 
+		subject_dir = os.path.dirname(os.path.dirname(os.path.abspath(sample_path)))
+		body_params = get_subject_calibration(subject_dir)
+
+	# Recompute if the trc, config or model changed since the result was saved
+	key = sample_cache_key(sample_path,cfg,body_params)
+	result_path = find_smpl_result(sample.name)
+	if result_path is None or result_cache_key(result_path) != key or force: 
+		sample.smpl = retarget_opencap2smpl(sample,body_params=body_params,result_key=key,preview=preview,profiler=profiler)
 	else:	
 		torch_device = torch.device('cuda' if cuda else 'cpu')	
-		sample.smpl = SMPLRetarget(sample.joints_np.shape[0],device=torch_device).to(torch_device)	
-		sample.smpl.load(os.path.join(SMPL_DIR,sample.name+'.pkl'))
+		with profiler.stage('smpl_layer'):
+			sample.smpl = SMPLRetarget(sample.joints_np.shape[0],device=torch_device).to(torch_device)	
+		with profiler.stage('load'):
+			sample.smpl.load(result_path)
+
+	record = profiler.save(num_frames=sample.num_frames)
+	if record is not None and profile_records is not None: 
+		profile_records.append(record)
 
 	return sample
 
 
 # Load file and render skeleton for each video
-def retarget_dataset():
+def retarget_dataset(force=False,calibrate=False,preview=False,profiler=PROFILER):
+	profile_records = []
 	for subject in os.listdir(DATASET_DIR):
 		for sample_path in os.listdir(os.path.join(DATASET_DIR,subject,'MarkerData')):
 			sample_path = os.path.join(DATASET_DIR,subject,'MarkerData',sample_path)
-			sample = retarget_sample(sample_path)
-
+			sample = retarget_sample(sample_path,force=force,calibrate=calibrate,preview=preview,profiler=profiler,profile_records=profile_records)
+
+	if len(profile_records) > 0: 
+		report(profile_records)
+
+
+def retarget_status(calibrate=False):
+	"""
+		List the sequences whose results are missing or stale 
+	"""
+	cfg = SMPLRetarget.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json'))
+	status = {}
+	for subject in sorted(os.listdir(DATASET_DIR)):
+		subject_dir = os.path.join(DATASET_DIR,subject)
+
+		body_params = None
+		if calibrate: 
+			body_params = load_subject_calibration(subject_dir,cfg)
+
+		for sample_path in subject_trc_paths(subject_dir):
+			name = OpenCapDataLoader.get_name(sample_path)
+			result_path = find_smpl_result(name)
+			if calibrate and body_params is None: 
+				status[sample_path] = "calibration stale"
+			elif result_path is None: 
+				status[sample_path] = "missing"
+			elif result_cache_key(result_path) is None: 
+				status[sample_path] = "no cache key"
+			elif result_cache_key(result_path) != sample_cache_key(sample_path,cfg,body_params):
+				status[sample_path] = "stale"
+			else: 
+				status[sample_path] = "ok"
+
+	outdated = [x for x in status if status[x] != "ok"]
+	for sample_path in outdated: 
+		print(f"{status[sample_path]:<20}{sample_path}")
+	print(f"{len(outdated)}/{len(status)} sequences need recomputation")
+	return status
 
 
 ############################# Command line Argument Parser #######################################################
-parser = argparse.ArgumentParser(
-					prog='Retargetting',
-					description='Retargets from SMPL to RaBit',
-					epilog='')
-parser.add_argument('-f', '--force',
-					action='store_true')  # on/off flag
-
-
-cmd_line_args = parser.parse_args(sys.argv[2:])
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(
+						prog='Retargetting',
+						description='Retargets from SMPL to RaBit',
+						epilog='')
+	parser.add_argument('sample_path', nargs='?', default=None) # Retarget complete dataset if not provided, 'status' lists results needing recomputation
+	parser.add_argument('-f', '--force',
+						action='store_true')  # on/off flag
+	parser.add_argument('-c', '--calibrate',
+						action='store_true')  # Two-stage: calibrate subject body once, then fit pose/trans per sequence
+	parser.add_argument('--profile',
+						action='store_true')  # Time each stage, per sequence json saved in logs/profile
+	parser.add_argument('--profile-trace', default=None) # START:END epoch range to save a torch profiler trace (needs --profile)
+	parser.add_argument('--preview',
+						action='store_true')  # Render a short low resolution skeleton clip instead of the full video
+	return parser.parse_args(argv)
 
 
 
 if __name__ == "__main__": 
+	cmd_line_args = parse_args()
 
-	if len(sys.argv) == 1: 
-		retarget_dataset()
-	else:
-		sample_path = sys.argv[1]
-		sample = retarget_sample(sample_path)
+	profiler = StageProfiler(enabled=cmd_line_args.profile,
+							trace_epochs=tuple(int(x) for x in cmd_line_args.profile_trace.split(':')) if cmd_line_args.profile_trace else None,
+							device=get_device())
 
+	if cmd_line_args.sample_path is None: 
+		retarget_dataset(force=cmd_line_args.force,calibrate=cmd_line_args.calibrate,preview=cmd_line_args.preview,profiler=profiler)
+	elif cmd_line_args.sample_path == 'status': 
+		retarget_status(calibrate=cmd_line_args.calibrate)
+	else:
+		sample = retarget_sample(cmd_line_args.sample_path,force=cmd_line_args.force,calibrate=cmd_line_args.calibrate,
+								preview=cmd_line_args.preview,profiler=profiler)
@@ -0,0 +1,247 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import numpy as np
+
+import pickle
+
+# DL Modules
+import torch
+
+# Modules
+from utils import * # Config details
+from retarget2smpl import SMPLRetarget, fit_smpl, get_device
+from store import save_smpl
+
+
+# Online retargetting for live sessions.
+# Frames are consumed as they arrive (growing TRC file or a socket sending TRC lines)
+# and fit in overlapping windows, latency per frame is bounded by WINDOW frames + EPOCHS optimization steps.
+
+
+def read_trc_lines(f,follow=False,poll_interval=0.01,timeout=None):
+	"""
+		Parse a TRC stream line by line.
+
+		f: File like object supporting readline (opened file or socket.makefile)
+		follow: Keep waiting for new lines at EOF (growing file).
+		timeout: Stop following after these many seconds without new data
+		Yields (time, joints (20 x 3) ordered as JOINT_NAMES)
+	"""
+	line_idx = 0
+	joint_order = None
+	buffer = ""
+	last_data = time.time()
+	while True:
+		line = f.readline()
+		if len(line) == 0 or not line.endswith('\n'):
+			# Incomplete line, writer has not flushed the rest yet
+			buffer += line
+			if not follow:
+				if len(buffer) == 0:
+					break
+				line,buffer = buffer,""
+			else:
+				if timeout is not None and time.time() - last_data > timeout:
+					break
+				time.sleep(poll_interval)
+				continue
+		else:
+			line,buffer = buffer + line,""
+
+		last_data = time.time()
+		line = line.rstrip('\r\n')
+		if line_idx == 3:
+			headers = [t for t in line.strip().split("\t") if t != ""][:22]
+			joint_order = [headers[2:].index(joint) for joint in JOINT_NAMES]
+		line_idx += 1
+
+		if line_idx <= 6 or len(line.strip()) == 0:
+			continue
+
+		assert joint_order is not None, "TRC header missing"
+		data = line.split('\t')
+		joints = np.array([float(x) for x in data[2:2+3*len(joint_order)]]).reshape((-1,3))
+		yield float(data[1]), joints[joint_order]
+
+
+def follow_trc(trc_path,poll_interval=0.01,timeout=None):
+	"""
+		Frames from a TRC file that is still being written
+	"""
+	with open(trc_path,'r') as f:
+		yield from read_trc_lines(f,follow=True,poll_interval=poll_interval,timeout=timeout)
+
+
+def socket_trc(host='localhost',port=5005):
+	"""
+		Frames from a local socket streaming the lines of a TRC file. Stream ends when the sender closes the connection.
+	"""
+	with socket.create_connection((host,port)) as sock:
+		with sock.makefile('r') as f:
+			yield from read_trc_lines(f)
+
+
+class OnlineRetargeter:
+	"""
+		Sliding window SMPL retargetting.
+
+		Each window of WINDOW frames is optimized for EPOCHS epochs. Only the first WINDOW-OVERLAP frames are emitted,
+		the last OVERLAP frames are kept (warm-started from their current fit) and refit with the next window, so every
+		emitted frame has seen OVERLAP frames of future context. The final flush emits all buffered frames.
+		Frames already emitted are fixed, smoothness with them is only enforced across the window boundary.
+		If body_params (see calibrate_subject) are not given, the body is fit on the first window and frozen afterwards.
+	"""
+	def __init__(self,body_params=None,device=None,smpl_layer=None):
+		"""
+			smpl_layer: Optional SMPL_Layer to use instead of loading the model (see SMPLRetarget)
+		"""
+
+		self.device = get_device() if device is None else device
+		self.logger, self.writer = get_logger(task_name='RetargetOnline')
+
+		self.cfg = SMPLRetarget.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json'))
+		self.window_size = self.cfg.ONLINE.WINDOW
+		self.overlap = self.cfg.ONLINE.OVERLAP
+		assert 0 <= self.overlap < self.window_size, f"ONLINE.OVERLAP:{self.overlap} must be smaller than ONLINE.WINDOW:{self.window_size}"
+
+		self.body_params = body_params
+		self.smplRetargetter = SMPLRetarget(self.window_size,device=self.device,body_params=body_params,smpl_layer=smpl_layer).to(self.device)
+
+		self.frames = []
+		self.targets = []
+		self.overlap_pose = None # Current fit of the buffered frames carried over from the previous window
+		self.prev_pose = None
+		self.body = body_params
+		self.results = {"frames":[], "pose_params":[], "trans":[]}
+
+	def _retargetter(self,batch_size):
+		if batch_size == self.window_size:
+			return self.smplRetargetter
+		# Last partial window, reuse the body fit so far and the loaded SMPL model
+		body_params = self.body_params if self.prev_pose is None else self.body
+		return SMPLRetarget(batch_size,device=self.device,body_params=body_params,smpl_layer=self.smplRetargetter.smpl_layer).to(self.device)
+
+	def push(self,frame_time,joints):
+		"""
+			Add a frame. Returns the SMPL parameters of the emitted frames when a window is complete else None.
+		"""
+		self.frames.append(frame_time)
+		self.targets.append(joints)
+		if len(self.targets) < self.window_size:
+			return None
+		return self.flush(final=False)
+
+	def flush(self,final=True):
+		"""
+			Fit the buffered frames and return the parameters of the emitted ones.
+			final: Emit all buffered frames (end of stream), else the last OVERLAP frames are kept for the next window
+		"""
+		if len(self.targets) == 0:
+			return None
+
+		target = torch.from_numpy(np.array(self.targets)).float().to(self.device)
+		smplRetargetter = self._retargetter(target.shape[0])
+
+		with torch.no_grad():
+			# Warm start carried frames from their previous fit, new frames from the last fitted pose
+			if self.prev_pose is not None:
+				pose = self.prev_pose.expand(smplRetargetter.batch_size,-1).clone()
+				if self.overlap_pose is not None:
+					pose[:len(self.overlap_pose)] = self.overlap_pose
+					pose[len(self.overlap_pose):] = self.overlap_pose[-1]
+				smplRetargetter.set_pose(pose)
+			smplRetargetter.smpl_params['trans'][:] = target[:,smplRetargetter.index["dataset_index"][0]]
+
+		# Fresh optimizer state and learning rate for every window
+		smplRetargetter.optimizer.state.clear()
+		for param_group in smplRetargetter.optimizer.param_groups:
+			param_group['lr'] = self.cfg.TRAIN.LEARNING_RATE
+
+		max_epoch = self.cfg.ONLINE.EPOCHS if self.prev_pose is not None else self.cfg.ONLINE.FIRST_WINDOW_EPOCH
+		fit_smpl(smplRetargetter,target,self.logger,self.writer,max_epoch=max_epoch,prev_pose=self.prev_pose)
+
+		# Body is only fit once
+		if self.prev_pose is None:
+			for k in ["shape_params","scale","offset"]:
+				smplRetargetter.smpl_params[k].requires_grad_(False)
+
+		num_emit = len(self.targets) if final else len(self.targets) - self.overlap
+		pose = smplRetargetter.pose_axis_angle().detach().clone()
+		res = {"frames": np.array(self.frames[:num_emit]),
+				"pose_params": pose[:num_emit].cpu().numpy(),
+				"trans": smplRetargetter.smpl_params['trans'][:num_emit].cpu().data.numpy().copy()}
+		for k in res:
+			self.results[k].append(res[k])
+
+		self.body = smplRetargetter.body_params()
+		self.prev_pose = pose[num_emit-1]
+		self.overlap_pose = pose[num_emit:] if num_emit < len(self.targets) else None
+		self.frames = self.frames[num_emit:]
+		self.targets = self.targets[num_emit:]
+
+		return res
+
+	def save(self,save_path):
+		"""
+			Save all emitted frames as a store (see store.py), same arrays as SMPLRetarget.save without joints.
+			Pending frames are flushed first.
+		"""
+		self.flush()
+		if len(self.results["frames"]) == 0:
+			raise ValueError(f"No frames were retargetted, nothing to save at:{save_path}")
+		res = dict([(k,np.concatenate(self.results[k],axis=0)) for k in self.results])
+		res.update(self.body)
+		save_smpl(save_path,res,pose_encoding=self.cfg.STORE.POSE_ENCODING)
+
+
+def retarget_online(frames,save_path=None,body_params=None):
+	"""
+		frames: iterator of (time, joints) eg. follow_trc or socket_trc
+	"""
+	retargeter = OnlineRetargeter(body_params=body_params)
+	for frame_time,joints in frames:
+		start = time.time()
+		res = retargeter.push(frame_time,joints)
+		if res is not None:
+			retargeter.logger.info(f"Frames:{res['frames'][0]:.3f}-{res['frames'][-1]:.3f}s fit in {time.time()-start:.3f}s")
+
+	retargeter.flush()
+
+	if save_path is not None:
+		retargeter.logger.info(f'Saving results at:{save_path}')
+		retargeter.save(save_path)
+
+	if retargeter.writer is not None:
+		retargeter.writer.close()
+
+	return retargeter
+
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+					prog='OnlineRetargetting',
+					description='Retargets a live OpenCap marker stream to SMPL',
+					epilog='')
+	parser.add_argument('sample_path', nargs='?', default=None) # Growing trc file
+	parser.add_argument('--port', type=int, default=None) # Read trc lines from localhost:<port> instead
+	parser.add_argument('--timeout', type=float, default=5.0) # Stop following the file after these many seconds without new frames
+	parser.add_argument('--calibration', default=None) # Subject body parameters from retarget2smpl.py --calibrate
+	parser.add_argument('-o', '--output', default=None)
+	args = parser.parse_args()
+
+	body_params = None
+	if args.calibration is not None:
+		with open(args.calibration, 'rb') as f:
+			body_params = pickle.load(f)
+
+	if args.port is not None:
+		frames = socket_trc(port=args.port)
+	else:
+		assert args.sample_path is not None, "Provide a trc file or --port"
+		frames = follow_trc(args.sample_path,poll_interval=SMPLRetarget.get_config(os.path.join(HOME_DIR,'Rajagopal_2016.json')).ONLINE.POLL_INTERVAL,timeout=args.timeout)
+
+	retarget_online(frames,save_path=args.output,body_params=body_params)
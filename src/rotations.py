@@ -0,0 +1,154 @@
+import torch
+
+# Rotation conversions used by the retargetting code.
+# Quaternions are stored as (w, x, y, z), same as smplpytorch.pytorch.rodrigues_layer.quat2mat
+
+
+def axis_angle_to_quaternion(axisang):
+	"""
+		axisang: Tensor (... x 3)
+		Returns unit quaternions (... x 4)
+	"""
+	angle = axisang.norm(dim=-1,keepdim=True)
+	half = 0.5*angle
+	# sin(x/2)/x, use taylor expansion near 0 to avoid divide by zero
+	small = angle < 1e-6
+	safe_angle = torch.where(small,torch.ones_like(angle),angle)
+	sin_half_over_angle = torch.where(small, 0.5 - angle**2/48, torch.sin(half)/safe_angle)
+	return torch.cat([torch.cos(half), axisang*sin_half_over_angle],dim=-1)
+
+
+def quaternion_to_axis_angle(quat):
+	"""
+		quat: Tensor (... x 4)
+		Returns axis-angle (... x 3) with angle in [0,pi]
+	"""
+	quat = quat / quat.norm(dim=-1,keepdim=True)
+	# q and -q are the same rotation, choose w >= 0
+	quat = torch.where(quat[...,:1] < 0, -quat, quat)
+	xyz_norm = quat[...,1:].norm(dim=-1,keepdim=True)
+	half = torch.atan2(xyz_norm,quat[...,:1])
+	small = xyz_norm < 1e-6
+	safe_norm = torch.where(small,torch.ones_like(xyz_norm),xyz_norm)
+	scale = torch.where(small, 2/quat[...,:1].clamp(min=1e-6), 2*half/safe_norm)
+	return quat[...,1:]*scale
+
+
+def quaternion_to_matrix(quat):
+	"""
+		quat: Tensor (... x 4), normalized here
+		Returns rotation matrices (... x 3 x 3)
+	"""
+	w,x,y,z = (quat / quat.norm(dim=-1,keepdim=True)).unbind(-1)
+	return torch.stack([1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y),
+						2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x),
+						2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)],dim=-1).reshape(*quat.shape[:-1],3,3)
+
+
+def matrix_to_quaternion(mat):
+	"""
+		mat: Tensor (... x 3 x 3) rotation matrices
+		Returns unit quaternions (... x 4). Uses the best conditioned of the 4 solutions (largest |component|)
+	"""
+	m = mat.reshape(*mat.shape[:-2],9).unbind(-1)
+	m00,m01,m02,m10,m11,m12,m20,m21,m22 = m
+	# 4*component^2 for w,x,y,z
+	q_abs = torch.sqrt(torch.stack([1+m00+m11+m22, 1+m00-m11-m22, 1-m00+m11-m22, 1-m00-m11+m22],dim=-1).clamp(min=1e-12))
+	candidates = torch.stack([
+		torch.stack([q_abs[...,0]**2, m21-m12, m02-m20, m10-m01],dim=-1),
+		torch.stack([m21-m12, q_abs[...,1]**2, m10+m01, m02+m20],dim=-1),
+		torch.stack([m02-m20, m10+m01, q_abs[...,2]**2, m12+m21],dim=-1),
+		torch.stack([m10-m01, m20+m02, m21+m12, q_abs[...,3]**2],dim=-1),
+	],dim=-2) / (2*q_abs.clamp(min=0.1)).unsqueeze(-1)
+	best = q_abs.argmax(dim=-1)
+	quat = torch.gather(candidates,-2,best[...,None,None].expand(*best.shape,1,4)).squeeze(-2)
+	return quat / quat.norm(dim=-1,keepdim=True)
+
+
+def rotation_6d_to_matrix(rot6d):
+	"""
+		Continuous 6D representation (Zhou et al. 2019): first two columns of the rotation matrix, orthonormalized with Gram-Schmidt
+		rot6d: Tensor (... x 6)
+	"""
+	a1,a2 = rot6d[...,:3],rot6d[...,3:]
+	b1 = a1 / a1.norm(dim=-1,keepdim=True)
+	b2 = a2 - (b1*a2).sum(dim=-1,keepdim=True)*b1
+	b2 = b2 / b2.norm(dim=-1,keepdim=True)
+	b3 = torch.cross(b1,b2,dim=-1)
+	return torch.stack([b1,b2,b3],dim=-1)
+
+
+def matrix_to_rotation_6d(mat):
+	return torch.cat([mat[...,:,0],mat[...,:,1]],dim=-1)
+
+
+def axis_angle_to_rotation_6d(axisang):
+	return matrix_to_rotation_6d(quaternion_to_matrix(axis_angle_to_quaternion(axisang)))
+
+
+def rotation_6d_to_axis_angle(rot6d):
+	return quaternion_to_axis_angle(matrix_to_quaternion(rotation_6d_to_matrix(rot6d)))
+
+
+def rotation_angle_error(axisang0,axisang1):
+	"""
+		Geodesic distance (radians, in [0,pi]) between axis-angle rotations (... x 3)
+	"""
+	q0 = axis_angle_to_quaternion(axisang0)
+	q1 = axis_angle_to_quaternion(axisang1)
+	# Relative rotation conj(q0)*q1, atan2 is accurate for small angles unlike acos of the dot product
+	w = (q0*q1).sum(dim=-1)
+	xyz = q0[...,:1]*q1[...,1:] - q1[...,:1]*q0[...,1:] - torch.cross(q0[...,1:],q1[...,1:],dim=-1)
+	return 2*torch.atan2(xyz.norm(dim=-1),w.abs())
+
+
+def quaternion_slerp(q0,q1,t):
+	"""
+		Spherical linear interpolation between unit quaternions along the shortest arc
+		q0,q1: Tensor (... x 4)
+		t: Tensor broadcastable to (... x 1) in [0,1]
+	"""
+	dot = (q0*q1).sum(dim=-1,keepdim=True)
+	q1 = torch.where(dot < 0, -q1, q1)
+	dot = dot.abs().clamp(max=1.0)
+
+	omega = torch.acos(dot)
+	sin_omega = torch.sin(omega)
+	# Nearly parallel quaternions, fall back to linear interpolation
+	linear = sin_omega < 1e-6
+	safe_sin = torch.where(linear,torch.ones_like(sin_omega),sin_omega)
+	w0 = torch.where(linear, 1-t, torch.sin((1-t)*omega)/safe_sin)
+	w1 = torch.where(linear, t, torch.sin(t*omega)/safe_sin)
+	q = w0*q0 + w1*q1
+	return q / q.norm(dim=-1,keepdim=True)
+
+
+def interpolate_axis_angle(axisang,key_frames,num_frames):
+	"""
+		Upsample per-frame axis-angle rotations defined at key_frames to num_frames using slerp
+
+		axisang: Tensor (K x J x 3) rotations at the key frames
+		key_frames: sorted LongTensor (K) of frame indices, first must be 0 and last num_frames-1
+		Returns Tensor (num_frames x J x 3)
+	"""
+	frames = torch.arange(num_frames,device=axisang.device)
+	# Index of the key frame interval containing each frame
+	right = torch.searchsorted(key_frames,frames,right=False).clamp(1,len(key_frames)-1)
+	left = right - 1
+	t = (frames - key_frames[left]).float() / (key_frames[right] - key_frames[left]).float()
+
+	quat = axis_angle_to_quaternion(axisang)
+	q = quaternion_slerp(quat[left],quat[right],t.view(-1,1,1).to(quat.dtype))
+	return quaternion_to_axis_angle(q)
+
+
+def interpolate_linear(x,key_frames,num_frames):
+	"""
+		Linear upsampling of x (K x ...) defined at key_frames to num_frames
+	"""
+	frames = torch.arange(num_frames,device=x.device)
+	right = torch.searchsorted(key_frames,frames,right=False).clamp(1,len(key_frames)-1)
+	left = right - 1
+	t = (frames - key_frames[left]).float() / (key_frames[right] - key_frames[left]).float()
+	t = t.view(-1,*([1]*(x.dim()-1))).to(x.dtype)
+	return (1-t)*x[left] + t*x[right]
@@ -0,0 +1,366 @@
+import os
+import sys
+import json
+import pickle
+import numpy as np
+
+from utils import * # Paths
+
+
+# Chunked array store for retargetting results.
+#
+# A store is a directory:
+#	meta.json               version, number of frames, chunk size and the description of every array
+#	<name>.npy              static arrays (eg. betas, scale, offset)
+#	<name>.<chunk>.bin      per frame arrays, raw little endian, CHUNK_SIZE frames per file
+#
+# Per frame arrays are memory mapped so single frames can be read without loading the sequence,
+# and new frames can be appended without rewriting the existing chunks.
+
+STORE_VERSION = 1
+SMPL_EXT = '.smpl'
+DEFAULT_CHUNK_SIZE = 1024
+
+# Encodings for per frame arrays
+ENCODINGS = {
+	"float32": np.dtype('<f4'),
+	"float16": np.dtype('<f2'),
+	"int16":   np.dtype('<i2'),   # Linear quantization in [-quant_range,quant_range]
+}
+
+
+class ArrayStore:
+	def __init__(self,path,meta):
+		self.path = path
+		self.meta = meta
+		self._chunks = {}
+
+	@staticmethod
+	def create(path,per_frame,static={},attrs={},chunk_size=DEFAULT_CHUNK_SIZE):
+		"""
+			Create an empty store.
+
+			per_frame: dict name -> dict(shape=frame shape, encoding='float32'|'float16'|'int16', quant_range=float (int16 only))
+			static: dict name -> numpy array stored once
+			attrs: json serializable information (eg. cache keys, source file)
+		"""
+		assert not os.path.isfile(path), f"Location to save store:{path} is a file"
+		os.makedirs(path,exist_ok=True)
+		# Remove stale chunks if the store is overwritten
+		for file in os.listdir(path):
+			if file.endswith('.bin') or file.endswith('.npy'):
+				os.remove(os.path.join(path,file))
+
+		arrays = {}
+		for name,desc in per_frame.items():
+			encoding = desc.get('encoding','float32')
+			assert encoding in ENCODINGS, f"Unknown encoding:{encoding} for array:{name}"
+			arrays[name] = {"shape":list(desc['shape']),"encoding":encoding}
+			if encoding == 'int16':
+				arrays[name]["scale"] = float(desc.get('quant_range',2*np.pi))/np.iinfo(np.int16).max
+
+		for name,array in static.items():
+			np.save(os.path.join(path,name+'.npy'),np.asarray(array),allow_pickle=False)
+
+		meta = {"version":STORE_VERSION,"num_frames":0,"chunk_size":int(chunk_size),
+				"arrays":arrays,"static":list(static.keys()),"attrs":attrs}
+		store = ArrayStore(path,meta)
+		store._write_meta()
+		return store
+
+	@staticmethod
+	def open(path):
+		with open(os.path.join(path,'meta.json'),'r') as f:
+			meta = json.load(f)
+		assert meta['version'] <= STORE_VERSION, f"Store:{path} version:{meta['version']} is newer than supported:{STORE_VERSION}"
+		return ArrayStore(path,meta)
+
+	@staticmethod
+	def exists(path):
+		return os.path.isfile(os.path.join(path,'meta.json'))
+
+	def _write_meta(self):
+		# Write then rename so readers never see a partial meta file
+		tmp_path = os.path.join(self.path,'meta.json.tmp')
+		with open(tmp_path,'w') as f:
+			json.dump(self.meta,f,indent=4)
+		os.replace(tmp_path,os.path.join(self.path,'meta.json'))
+
+	def __len__(self):
+		return self.meta['num_frames']
+
+	@property
+	def attrs(self):
+		return self.meta['attrs']
+
+	def names(self):
+		return list(self.meta['arrays'].keys()) + list(self.meta['static'])
+
+	def _chunk_path(self,name,chunk):
+		return os.path.join(self.path,f"{name}.{chunk}.bin")
+
+	def _encode(self,name,x):
+		desc = self.meta['arrays'][name]
+		x = np.asarray(x,dtype=np.float32).reshape((-1,*desc['shape']))
+		if desc['encoding'] == 'int16':
+			x = np.clip(np.round(x/desc['scale']),-np.iinfo(np.int16).max,np.iinfo(np.int16).max)
+		return np.ascontiguousarray(x.astype(ENCODINGS[desc['encoding']]))
+
+	def _decode(self,name,x):
+		desc = self.meta['arrays'][name]
+		if desc['encoding'] == 'int16':
+			return x.astype(np.float32)*np.float32(desc['scale'])
+		return x.astype(np.float32)
+
+	def append(self,**arrays):
+		"""
+			Append frames, every per frame array has to be given with the same number of frames
+		"""
+		assert set(arrays.keys()) == set(self.meta['arrays'].keys()), f"Expected arrays:{list(self.meta['arrays'].keys())} got:{list(arrays.keys())}"
+		encoded = dict([(name,self._encode(name,x)) for name,x in arrays.items()])
+		num_new = set([x.shape[0] for x in encoded.values()])
+		assert len(num_new) == 1, f"Arrays have different number of frames:{num_new}"
+		num_new = num_new.pop()
+
+		chunk_size = self.meta['chunk_size']
+		start = self.meta['num_frames']
+		written = 0
+		while written < num_new:
+			frame = start + written
+			chunk,offset = divmod(frame,chunk_size)
+			n = min(chunk_size - offset,num_new - written)
+			for name,x in encoded.items():
+				with open(self._chunk_path(name,chunk),'ab') as f:
+					# Drop bytes of an append that crashed before meta.json was updated, else later frames are misaligned
+					f.truncate(offset*x[0].nbytes)
+					f.write(x[written:written+n].tobytes())
+			written += n
+
+		self._chunks = {}
+		self.meta['num_frames'] = start + num_new
+		self._write_meta()
+
+	def _chunk(self,name,chunk):
+		key = (name,chunk)
+		if key not in self._chunks:
+			desc = self.meta['arrays'][name]
+			num_frames = min(self.meta['chunk_size'],self.meta['num_frames'] - chunk*self.meta['chunk_size'])
+			self._chunks[key] = np.memmap(self._chunk_path(name,chunk),dtype=ENCODINGS[desc['encoding']],mode='r',
+										shape=(num_frames,*desc['shape']))
+		return self._chunks[key]
+
+	def read(self,name,frames=None):
+		"""
+			Decoded float32 array.
+			frames: None (all), int or slice (any step, including negative). Only the chunks containing the frames are touched.
+		"""
+		if name in self.meta['static']:
+			return np.load(os.path.join(self.path,name+'.npy'),mmap_mode='r')
+
+		if frames is None:
+			frames = slice(0,len(self))
+		if isinstance(frames,(int,np.integer)):
+			frame = int(frames) + (len(self) if frames < 0 else 0)
+			assert 0 <= frame < len(self), f"Frame:{frames} out of range for store with {len(self)} frames"
+			chunk,offset = divmod(frame,self.meta['chunk_size'])
+			return self._decode(name,self._chunk(name,chunk)[offset])
+
+		frames = range(*frames.indices(len(self)))
+		desc = self.meta['arrays'][name]
+		if len(frames) == 0:
+			return np.zeros((0,*desc['shape']),dtype=np.float32)
+
+		# Read the contiguous span covering the frames, then apply the step (negative steps read the same span)
+		start,stop = min(frames[0],frames[-1]),max(frames[0],frames[-1]) + 1
+		chunk_size = self.meta['chunk_size']
+		parts = []
+		for chunk in range(start//chunk_size,(stop-1)//chunk_size + 1):
+			lo = max(start,chunk*chunk_size) - chunk*chunk_size
+			hi = min(stop,(chunk+1)*chunk_size) - chunk*chunk_size
+			parts.append(self._chunk(name,chunk)[lo:hi])
+		return self._decode(name,np.concatenate(parts,axis=0)[frames[0]-start::frames.step])
+
+	def __getitem__(self,frame):
+		"""
+			All per frame arrays of a frame
+		"""
+		return dict([(name,self.read(name,frame)) for name in self.meta['arrays']])
+
+
+############################# SMPL results #######################################################
+
+def smpl_store_path(name):
+	return os.path.join(SMPL_DIR,name+SMPL_EXT)
+
+
+def find_smpl_result(name):
+	"""
+		Path to the retargetting result of a sample, prefers the store over a legacy pickle. None if not retargetted yet.
+	"""
+	if ArrayStore.exists(smpl_store_path(name)):
+		return smpl_store_path(name)
+	if os.path.isfile(os.path.join(SMPL_DIR,name+'.pkl')):
+		return os.path.join(SMPL_DIR,name+'.pkl')
+	return None
+
+
+def result_cache_key(path):
+	"""
+		Cache key saved with a result, None for legacy pickles or results saved without a key
+	"""
+	if path is None or path.endswith('.pkl') or not ArrayStore.exists(path):
+		return None
+	return ArrayStore.open(path).attrs.get('cache_key')
+
+
+def save_smpl(path,smpl_params,joints=None,verts=None,pose_encoding='float32',attrs={},chunk_size=DEFAULT_CHUNK_SIZE):
+	"""
+		smpl_params: dict of numpy arrays pose_params (T x 72), trans (T x 3), shape_params, scale, offset
+		joints: Optional (T x 24 x 3) SMPL joints
+		verts: Optional (T x 6890 x 3) vertices
+		pose_encoding: 'float32', 'float16' or 'int16' (quantized axis-angle)
+	"""
+	per_frame = {"pose_params": {"shape":smpl_params['pose_params'].shape[1:],"encoding":pose_encoding},
+				 "trans": {"shape":smpl_params['trans'].shape[1:]}}
+	data = {"pose_params":smpl_params['pose_params'],"trans":smpl_params['trans']}
+	if joints is not None:
+		per_frame['joints'] = {"shape":joints.shape[1:]}
+		data['joints'] = joints
+	if verts is not None:
+		per_frame['verts'] = {"shape":verts.shape[1:]}
+		data['verts'] = verts
+
+	# Other per frame information (eg. frame times of the online retargetter)
+	num_frames = smpl_params['pose_params'].shape[0]
+	for k in smpl_params:
+		if k not in data and k not in ["shape_params","scale","offset"] and np.ndim(smpl_params[k]) > 0 and len(smpl_params[k]) == num_frames:
+			per_frame[k] = {"shape":np.shape(smpl_params[k])[1:]}
+			data[k] = smpl_params[k]
+
+	static = dict([(k,np.asarray(smpl_params[k],dtype=np.float32)) for k in ["shape_params","scale","offset"]])
+
+	store = ArrayStore.create(path,per_frame,static=static,attrs=attrs,chunk_size=chunk_size)
+	store.append(**data)
+	return store
+
+
+def load_smpl(path):
+	"""
+		Load all arrays of a SMPL result (store or legacy pickle) as a dict of numpy arrays
+	"""
+	if path.endswith('.pkl'):
+		with open(path, 'rb') as f:
+			return pickle.load(f)
+
+	store = ArrayStore.open(path)
+	return dict([(name,np.array(store.read(name))) for name in store.names()])
+
+
+def migrate(smpl_dir=SMPL_DIR,pose_encoding='float32',remove=False):
+	"""
+		Convert legacy SMPL_DIR/*.pkl results to stores
+	"""
+	for file in sorted(os.listdir(smpl_dir)):
+		if not file.endswith('.pkl'):
+			continue
+		pkl_path = os.path.join(smpl_dir,file)
+		store_path = os.path.join(smpl_dir,file[:-4]+SMPL_EXT)
+		if ArrayStore.exists(store_path):
+			print(f"Skipping:{pkl_path}, {store_path} exists")
+			continue
+
+		data = load_smpl(pkl_path)
+		joints = data.pop('joints',None)
+		save_smpl(store_path,data,joints=joints,pose_encoding=pose_encoding,attrs={"migrated_from":file})
+		print(f"Converted:{pkl_path} -> {store_path}")
+		if remove:
+			os.remove(pkl_path)
+
+
+############################# RaBit meshes #######################################################
+#
+# Animated RaBit mesh of a sample, replaces one textured .obj per frame.
+# Topology and UVs are static arrays, vertices are stored per frame relative to the translation
+# so they can be quantized to int16 with a small range.
+
+RABIT_MESH_EXT = '.mesh'
+
+def rabit_mesh_path(name):
+	return os.path.join(RENDER_DIR,name,"RaBit","sequence"+RABIT_MESH_EXT)
+
+
+def save_rabit_mesh(path,verts,trans,joints,faces,uvs,face_uvs,encoding='int16',attrs={},chunk_size=DEFAULT_CHUNK_SIZE):
+	"""
+		verts: (T x V x 3) vertices including the translation
+		trans: (T x 3) translation
+		joints: (T x 24 x 3) RaBit joints
+		faces, face_uvs: (F x 3) zero based vertex and texture coordinate index of every face
+		uvs: (N x 2) texture coordinates
+		encoding: 'float32', 'float16' or 'int16' for the vertices
+	"""
+	trans = np.asarray(trans,dtype=np.float32).reshape(-1,3)
+	verts = np.asarray(verts,dtype=np.float32) - trans[:,None,:]
+
+	# Quantization range from the data, slightly larger so no vertex is clipped
+	quant_range = float(np.abs(verts).max())*1.01 if verts.size > 0 else 1.0
+	per_frame = {"verts": {"shape":verts.shape[1:],"encoding":encoding,"quant_range":quant_range},
+				 "trans": {"shape":[3]},
+				 "joints": {"shape":joints.shape[1:]}}
+	static = {"faces":np.asarray(faces,dtype=np.int32),"uvs":np.asarray(uvs,dtype=np.float32),"face_uvs":np.asarray(face_uvs,dtype=np.int32)}
+
+	store = ArrayStore.create(path,per_frame,static=static,attrs=attrs,chunk_size=chunk_size)
+	store.append(verts=verts,trans=trans,joints=joints)
+	return store
+
+
+def load_rabit_mesh(path,frames=None,static=True):
+	"""
+		Reader for the renderer.
+		frames: None (all), int or slice, only the needed chunks are read
+		static: Also load the topology, skip it when reading frame by frame
+		Returns dict with verts (including the translation), trans, joints and the static topology (faces, uvs, face_uvs)
+	"""
+	store = ArrayStore.open(path)
+	trans = store.read('trans',frames)
+	mesh = {"verts":store.read('verts',frames) + trans[...,None,:],"trans":trans,"joints":store.read('joints',frames)}
+	if static:
+		for name in ["faces","uvs","face_uvs"]:
+			mesh[name] = np.array(store.read(name))
+	return mesh
+
+
+
+# Completion marker of the RaBit export of a sample, written once all frames are exported.
+# Resumed runs check the marker instead of the frames in the directory.
+RABIT_EXPORT_MARKER = 'export.json'
+
+def rabit_export_marker(name):
+	return os.path.join(RENDER_DIR,name,"RaBit",RABIT_EXPORT_MARKER)
+
+
+def rabit_export_done(name,num_frames,export,smpl_key):
+	"""
+		True if the RaBit export of the sample is complete for this number of frames, export mode and SMPL result.
+		smpl_key: cache key of the SMPL result the export was fit to (see result_cache_key), None never matches
+	"""
+	path = rabit_export_marker(name)
+	if smpl_key is None or not os.path.isfile(path):
+		return False
+	with open(path,'r') as f:
+		marker = json.load(f)
+	return marker.get("frames") == num_frames and marker.get("export") == export and marker.get("cache_key") == smpl_key
+
+
+def mark_rabit_export(name,num_frames,export,smpl_key):
+	path = rabit_export_marker(name)
+	tmp_path = path + f'.{os.getpid()}.tmp'
+	with open(tmp_path,'w') as f:
+		json.dump({"frames":num_frames,"export":export,"cache_key":smpl_key},f)
+	os.replace(tmp_path,path)
+
+
+
+if __name__ == "__main__":
+	# python store.py migrate [smpl_dir] [float32|float16|int16]
+	assert len(sys.argv) > 1 and sys.argv[1] == 'migrate', "Usage: python store.py migrate [smpl_dir] [pose_encoding]"
+	migrate(sys.argv[2] if len(sys.argv) > 2 else SMPL_DIR, pose_encoding=sys.argv[3] if len(sys.argv) > 3 else 'float32')
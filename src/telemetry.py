@@ -0,0 +1,79 @@
+import os
+import numpy as np
+
+import torch
+
+
+# Batched metrics logging for the retargetting loop.
+# Metrics are stacked on the device they were computed on and only copied to the host once per flush,
+# instead of a float() (host sync) + writer.add_scalar per value per epoch.
+
+
+class Telemetry:
+	def __init__(self,writer,sample_every=1,enabled=True):
+		"""
+			writer: tensorboardX SummaryWriter, telemetry is disabled if None
+			sample_every: Record metrics every n-th call to log
+		"""
+		self.writer = writer
+		self.enabled = bool(enabled) and writer is not None
+		self.sample_every = max(1,int(sample_every))
+
+		self.names = None
+		self.steps = []
+		self.rows = []
+
+	@staticmethod
+	def from_config(writer,cfg):
+		"""
+			cfg: Retargetting config, uses the TELEMETRY section
+		"""
+		return Telemetry(writer,sample_every=cfg.TELEMETRY.SAMPLE_EVERY,enabled=cfg.TELEMETRY.ENABLE)
+
+	def log(self,step,**metrics):
+		"""
+			Record scalar tensors (or floats) for this step. No host sync happens here.
+		"""
+		if not self.enabled or step % self.sample_every != 0:
+			return
+
+		if self.names is None:
+			self.names = list(metrics.keys())
+		values = [metrics[k].detach().reshape(()) if torch.is_tensor(metrics[k]) else torch.tensor(float(metrics[k])) for k in self.names]
+		device = next((v.device for v in values if v.device.type != 'cpu'),values[0].device)
+		self.rows.append(torch.stack([v.to(device).float() for v in values]))
+		self.steps.append(step)
+
+	def flush(self):
+		"""
+			Copy all recorded metrics to host in one transfer and write them.
+			Returns (steps, names, values (N x len(names))) or None if nothing was recorded
+		"""
+		if not self.enabled or len(self.rows) == 0:
+			return None
+
+		values = torch.stack(self.rows).cpu().numpy()
+		for step,row in zip(self.steps,values):
+			for name,value in zip(self.names,row):
+				self.writer.add_scalar(name,float(value),step)
+
+		res = (self.steps,self.names,values)
+		self.steps = []
+		self.rows = []
+		return res
+
+	def log_curves(self,tag,curves,channel_names):
+		"""
+			Dump per frame curves (eg. joint angles) as a single array and one histogram per channel
+			instead of a scalar per frame.
+
+			curves: Tensor (T x C)
+			channel_names: list of C names
+		"""
+		if not self.enabled:
+			return
+
+		curves = curves.detach().cpu().numpy()
+		np.savez(os.path.join(self.writer.logdir,f"{tag}_curves.npz"),curves=curves,names=np.array(channel_names))
+		for i,name in enumerate(channel_names):
+			self.writer.add_histogram(f"{tag}/{name}",curves[:,i],0)
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from utils import * # Paths
+
+
+# Pool of RaBit textures generated once with the StyleGAN texture network (RaBit/stylegan3).
+# Samples reference a texture of the pool chosen by a hash of the subject, instead of running the
+# network for every sample directory. The pool is a directory:
+#	pool.json               size, seed and source network
+#	texture_<i>.png         textures
+
+TEXTURE_NETWORK = os.path.join(RABIT_DIR,'rabit_data/texture/texture.pkl')
+
+
+def texture_path(pool_dir,index):
+	return os.path.join(pool_dir,f"texture_{index:03d}.png")
+
+
+def load_pool(pool_dir=TEXTURE_POOL_DIR):
+	"""
+		pool.json of a complete pool, None if the pool was not generated
+	"""
+	if not os.path.isfile(os.path.join(pool_dir,'pool.json')):
+		return None
+	with open(os.path.join(pool_dir,'pool.json'),'r') as f:
+		return json.load(f)
+
+
+def generate_pool(pool_dir=TEXTURE_POOL_DIR,size=TEXTURE_POOL_SIZE,network_pkl=TEXTURE_NETWORK,seed=0,batch_size=8,truncation_psi=1,noise_mode='const'):
+	"""
+		Generate all textures of the pool in batched passes of the network, loaded once.
+		A complete pool is never replaced, delete pool_dir to regenerate it.
+	"""
+	pool = load_pool(pool_dir)
+	if pool is not None:
+		return pool
+
+	# StyleGAN dependencies are only needed to create the pool
+	import torch
+	import PIL.Image
+	import dnnlib
+	import legacy
+
+	device = torch.device('cuda' if cuda and torch.cuda.is_available() else 'cpu')
+	with dnnlib.util.open_url(network_pkl) as f:
+		G = legacy.load_network_pkl(f)['G_ema'].to(device)
+
+	# Write into a temporary directory, renamed once complete
+	tmp_dir = pool_dir + f'.{os.getpid()}.tmp'
+	os.makedirs(tmp_dir,exist_ok=True)
+
+	z = torch.from_numpy(np.random.RandomState(seed).randn(size,G.z_dim)).float().to(device)
+	with torch.no_grad():
+		for start in range(0,size,batch_size):
+			batch_z = z[start:start+batch_size]
+			label = torch.zeros([batch_z.shape[0],G.c_dim],device=device)
+			img = G(batch_z,label,truncation_psi=truncation_psi,noise_mode=noise_mode)
+			img = (img.permute(0,2,3,1)*127.5 + 128).clamp(0,255).to(torch.uint8).cpu().numpy()
+			for i in range(img.shape[0]):
+				PIL.Image.fromarray(img[i],'RGB').save(texture_path(tmp_dir,start+i))
+
+	with open(os.path.join(tmp_dir,'pool.json'),'w') as f:
+		json.dump({"size":size,"seed":seed,"network":os.path.basename(network_pkl),"truncation_psi":truncation_psi},f,indent=4)
+
+	# Leftover directory without pool.json
+	if os.path.isdir(pool_dir) and load_pool(pool_dir) is None:
+		shutil.rmtree(pool_dir,ignore_errors=True)
+	try:
+		os.replace(tmp_dir,pool_dir)
+	except OSError:
+		# Another process renamed its pool first (the target is not empty), use that one
+		shutil.rmtree(tmp_dir,ignore_errors=True)
+		pool = load_pool(pool_dir)
+		if pool is None:
+			raise
+		return pool
+	return load_pool(pool_dir)
+
+
+def subject_texture(subject,pool_dir=TEXTURE_POOL_DIR):
+	"""
+		Texture of the pool assigned to a subject (eg. OpenCap ID), the same on every run and machine.
+		Generates the pool on first use.
+	"""
+	pool = load_pool(pool_dir)
+	if pool is None:
+		pool = generate_pool(pool_dir)
+	index = int(hashlib.sha256(str(subject).encode()).hexdigest(),16) % pool['size']
+	return texture_path(pool_dir,index)
+
+
+def link_texture(texture,path):
+	"""
+		Reference a pooled texture from a sample directory, relative symlink or a copy if links are not supported
+	"""
+	if os.path.lexists(path):
+		os.remove(path)
+	try:
+		os.symlink(os.path.relpath(texture,os.path.dirname(path)),path)
+	except OSError:
+		shutil.copyfile(texture,path)
+
+
+
+if __name__ == "__main__":
+	# python texture_pool.py [size]
+	pool = generate_pool(size=int(sys.argv[1]) if len(sys.argv) > 1 else TEXTURE_POOL_SIZE)
+	print(f"Texture pool of {pool['size']} textures in {TEXTURE_POOL_DIR}")
@@ -21,8 +21,10 @@ sys.path.extend([HOME_DIR,RABIT_DIR,STYLEGAN_DIR])
 # Files
 DATASET_DIR = os.path.join(HOME_DIR,'OpenSim') # Path containing all the training data (currently using xyz)
 SMPL_DIR = os.path.join(HOME_DIR,'SMPL')
+CALIBRATION_DIR = os.path.join(SMPL_DIR,'calibration') # Per subject body parameters (shape, scale, offset)
 RENDER_DIR = os.path.join(HOME_DIR,'rendered_videos')
 LOG_DIR = os.path.join(HOME_DIR,'logs')
+SMPL_MODEL_DIR = os.path.join(HOME_DIR,'smplpytorch/native/models')
 
 
 # ############################ DATASET CONSTANTS #######################################################
@@ -66,10 +68,31 @@ smpl2rabit_mapping = [ 0, # Center hip
 					   10,# lfoor
 					 ]
 
+# Number of RaBit PCA shape components (500 available), random shapes only use the first 10
+RABIT_NUM_BETAS = 10
+
+# Textures shared by the RaBit samples, assigned by subject (see texture_pool.py)
+TEXTURE_POOL_DIR = os.path.join(RENDER_DIR,'texture_pool')
+TEXTURE_POOL_SIZE = 16
+
+# RaBit export: 'mesh' (single animated mesh store, see store.py) or 'obj' (textured .obj per frame)
+RABIT_EXPORT = 'mesh'
+RABIT_VERTEX_ENCODING = 'int16' # 'float32', 'float16' or 'int16'
+RABIT_EXPORT_WORKERS = os.cpu_count() # Processes writing the .obj frames
+
 
 ############################# RETARGETTING HYPERPARAMETERS #######################################################
 cuda=True
 RENDER=True
+RENDER_BACKEND = 'auto' # 'polyscope', 'numpy' (headless software renderer) or 'auto' (polyscope if a display is available)
+RENDER_RESOLUTION = (1280,720) # Size of the rendered frames
+VIDEO_CODEC = 'h264' # 'h264' or 'palette' (palettegen + paletteuse)
+SAVE_PNG = False # Also save every rendered frame as png
+RENDER_WORKERS = os.cpu_count() # Processes of renderer.render_dataset
+# Preview renders for QA (renderer.py --preview): every PREVIEW_STRIDE-th frame, skeletons only
+PREVIEW_STRIDE = 4
+PREVIEW_RESOLUTION = (480,270)
+PREVIEW_MAX_FRAMES = 120 # Frames of the clip after the stride
 
 
 
@@ -0,0 +1,98 @@
+import os
+import subprocess
+import numpy as np
+
+from utils import * # Video settings
+from rasterizer import write_png
+
+
+# Encoder streaming raw RGB frames to a single ffmpeg process over stdin,
+# replaces writing a png per frame and running ffmpeg twice (palettegen + paletteuse) on the pngs.
+#	codec 'h264'     libx264, yuv420p
+#	codec 'palette'  palettegen + paletteuse in one filter graph (previous look, eg. for .gif)
+
+CODEC_ARGS = {
+	'h264': ['-vf','pad=ceil(iw/2)*2:ceil(ih/2)*2','-c:v','libx264','-preset','veryfast','-crf','18','-pix_fmt','yuv420p'],
+	'palette': ['-filter_complex','split[a][b];[a]palettegen[p];[b][p]paletteuse'],
+}
+
+
+class VideoEncoder:
+	"""
+		with VideoEncoder(video_path,frame_rate) as encoder:
+			for frame in frames: encoder.write(frame)
+	"""
+	def __init__(self,video_path,frame_rate,codec=VIDEO_CODEC,png_pattern=None):
+		"""
+			video_path: output video
+			frame_rate: frames per second
+			codec: 'h264' or 'palette'
+			png_pattern: optional path with {} for the frame index, frames are also saved as png (eg. images/{}.png)
+		"""
+		assert codec in CODEC_ARGS, f"Unknown codec:{codec}, use one of {list(CODEC_ARGS)}"
+		self.video_path = video_path
+		self.frame_rate = frame_rate
+		self.codec = codec
+		self.png_pattern = png_pattern
+		self.process = None
+		self.shape = None
+		self.num_frames = 0
+
+	def command(self):
+		height,width = self.shape[:2]
+		return ['ffmpeg','-y','-loglevel','error',
+			'-f','rawvideo','-pix_fmt','rgb24','-s',f'{width}x{height}','-framerate',str(self.frame_rate),'-i','-'] \
+			+ CODEC_ARGS[self.codec] + [self.video_path]
+
+	def write(self,frame):
+		"""
+			frame: RGB uint8 (height x width x 3), all frames must have the same size
+		"""
+		frame = np.ascontiguousarray(frame[...,:3],dtype=np.uint8)
+		if self.process is None:
+			# Started with the first frame, the size is part of the command
+			self.shape = frame.shape
+			os.makedirs(os.path.dirname(os.path.abspath(self.video_path)),exist_ok=True)
+			try:
+				self.process = subprocess.Popen(self.command(),stdin=subprocess.PIPE,stderr=subprocess.PIPE)
+			except FileNotFoundError:
+				raise RuntimeError("ffmpeg was not found, install it to encode videos")
+		assert frame.shape == self.shape, f"Frame {self.num_frames} has shape {frame.shape}, expected {self.shape}"
+
+		if self.png_pattern is not None:
+			write_png(self.png_pattern.format(self.num_frames),frame)
+		try:
+			self.process.stdin.write(frame.tobytes())
+		except BrokenPipeError:
+			# ffmpeg exited early, close reports its error
+			self.close()
+		self.num_frames += 1
+
+	def close(self):
+		"""
+			Wait for ffmpeg and raise if it failed
+		"""
+		if self.process is None:
+			return
+		process,self.process = self.process,None
+		try:
+			process.stdin.close()
+		except BrokenPipeError:
+			pass
+		stderr = process.stderr.read().decode(errors='replace')
+		process.wait()
+		if process.returncode != 0:
+			raise RuntimeError(f"ffmpeg failed with exit code {process.returncode} writing {self.video_path}:\n{stderr[-2000:]}")
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		if exc_type is None:
+			self.close()
+		elif self.process is not None:
+			# Do not hide the original error behind the ffmpeg one
+			self.process.kill()
+			self.process.wait()
+			self.process = None
+		return False
@@ -0,0 +1,52 @@
+import os
+import json
+import copy
+
+import pytest
+from easydict import EasyDict as edict
+
+from utils import HOME_DIR
+from cache import cache_key
+
+
+@pytest.fixture
+def cfg():
+	with open(os.path.join(HOME_DIR,'Rajagopal_2016.json')) as f:
+		return edict(json.load(f))
+
+
+@pytest.fixture
+def trc_path(tmp_path):
+	path = tmp_path / 'sample.trc'
+	path.write_text("PathFileType\t4\t(X/Y/Z)\tsample.trc\n1\t0.0\t0.1\t0.2\n")
+	return str(path)
+
+
+def test_cache_key_trc_content(tmp_path,cfg,trc_path):
+	model_path = str(tmp_path / 'missing.pkl')
+	key = cache_key(trc_path,cfg,model_path)
+	assert cache_key([trc_path],cfg,model_path) == key
+
+	# Different length so the memoized hash (path, size, mtime) can not be reused
+	with open(trc_path,'a') as f:
+		f.write("2\t0.0\t0.1\t0.3\n")
+	assert cache_key(trc_path,cfg,model_path) != key
+
+
+def test_cache_key_config(tmp_path,cfg,trc_path):
+	model_path = str(tmp_path / 'missing.pkl')
+	key = cache_key(trc_path,cfg,model_path)
+
+	changed = copy.deepcopy(cfg)
+	changed.TRAIN.LEARNING_RATE = changed.TRAIN.LEARNING_RATE*2
+	assert cache_key(trc_path,changed,model_path) != key
+
+
+@pytest.mark.parametrize("section",["TELEMETRY","ONLINE","RABIT"])
+def test_cache_key_ignored_config(tmp_path,cfg,trc_path,section):
+	model_path = str(tmp_path / 'missing.pkl')
+	key = cache_key(trc_path,cfg,model_path)
+
+	changed = copy.deepcopy(cfg)
+	changed[section] = {"CHANGED":1}
+	assert cache_key(trc_path,changed,model_path) == key
@@ -0,0 +1,57 @@
+import numpy as np
+
+from retarget2raBit import write_obj_frame, load_obj_uvs
+
+
+TEMPLATE = """# UV template
+mtllib tri.mtl
+usemtl material_0
+v 0 0 0
+v 1 0 0
+v 0 1 0
+v 0 0 1
+vt 0.0 0.0
+vt 1.0 0.0
+vt 0.0 1.0
+vt 0.5 0.5
+f 1/1/1 2/2/2 3/3/3
+f 1/1/1 3/3/3 4/4/4
+"""
+
+
+def read_obj(path):
+	verts,uvs,faces = [],[],[]
+	with open(path) as f:
+		for line in f:
+			values = line.split()
+			if len(values) == 0:
+				continue
+			elif values[0] == 'v':
+				verts.append([float(x) for x in values[1:]])
+			elif values[0] == 'vt':
+				uvs.append([float(x) for x in values[1:]])
+			elif values[0] == 'f':
+				faces.append([[int(i) for i in item.split('/')] for item in values[1:]])
+	return np.array(verts),np.array(uvs),np.array(faces)
+
+
+def test_obj_round_trip(tmp_path):
+	template_path = str(tmp_path / 'tri.obj')
+	with open(template_path,'w') as f:
+		f.write(TEMPLATE)
+
+	verts = np.random.RandomState(0).randn(4,3).astype(np.float32)
+	path = str(tmp_path / 'frame.obj')
+	write_obj_frame(path,verts,template_path)
+
+	read_verts,read_uvs,read_faces = read_obj(path)
+	np.testing.assert_allclose(read_verts,verts,rtol=0,atol=1e-6)
+
+	# Texture coordinates and faces (v/vt only) of the template
+	uvs,faces,face_uvs = load_obj_uvs(template_path)
+	np.testing.assert_array_equal(read_uvs,uvs)
+	np.testing.assert_array_equal(read_faces[...,0]-1,faces)
+	np.testing.assert_array_equal(read_faces[...,1]-1,face_uvs)
+	with open(path) as f:
+		header = f.readlines()[:2]
+	assert header == ["mtllib tri.mtl\n","usemtl material_0\n"]
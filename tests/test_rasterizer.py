@@ -0,0 +1,42 @@
+import numpy as np
+
+from rasterizer import HeadlessScene, write_png
+
+
+def scene(resolution=(64,48)):
+	scene = HeadlessScene(resolution=resolution,background=(1.0,1.0,1.0))
+	scene.look_at(np.array([0.0,0.0,3.0]),np.zeros(3))
+	return scene
+
+
+def test_empty_frame():
+	frame = scene().render()
+	assert frame.shape == (48,64,3) and frame.dtype == np.uint8
+	assert (frame == 255).all()
+
+
+def test_mesh_frame():
+	s = scene()
+	s.register_surface_mesh('triangle',np.array([[-1.0,-1.0,0.0],[1.0,-1.0,0.0],[0.0,1.0,0.0]]),np.array([[0,1,2]]),color=(1.0,0.0,0.0))
+	frame = s.render()
+	assert frame.shape == (48,64,3) and frame.dtype == np.uint8
+
+	drawn = (frame != 255).any(axis=2)
+	# The triangle covers the center but not the corners
+	assert drawn[24,32] and not drawn[0,0] and not drawn[-1,-1]
+	assert frame[24,32,0] > frame[24,32,1]
+
+
+def test_curves_and_window_size(tmp_path):
+	s = scene()
+	s.register_point_cloud('points',np.zeros((1,3)),radius=0.05)
+	s.register_curve_network('bones',np.array([[-0.5,0.0,0.0],[0.5,0.0,0.0]]),np.array([[0,1]]))
+	s.set_window_size(32,24)
+	frame = s.render()
+	assert frame.shape == (24,32,3)
+	assert (frame != 255).any()
+
+	path = str(tmp_path / 'frame.png')
+	write_png(path,frame)
+	with open(path,'rb') as f:
+		assert f.read(8) == b'\x89PNG\r\n\x1a\n'
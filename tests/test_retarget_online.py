@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+
+import retarget2smpl
+from retarget_online import OnlineRetargeter
+from benchmark import synthetic_layer, synthetic_motion, synthetic_target
+from store import load_smpl
+
+
+def make_retargeter(epochs=5):
+	retargeter = OnlineRetargeter(device=torch.device('cpu'),smpl_layer=synthetic_layer())
+	retargeter.cfg.ONLINE.EPOCHS = epochs
+	retargeter.cfg.ONLINE.FIRST_WINDOW_EPOCH = epochs
+	return retargeter
+
+
+def test_save_without_frames(tmp_path):
+	retargeter = make_retargeter()
+	with pytest.raises(ValueError):
+		retargeter.save(str(tmp_path / 'empty.smpl'))
+
+
+def test_partial_last_window(tmp_path,monkeypatch):
+	retargeter = make_retargeter()
+	window,overlap = retargeter.window_size,retargeter.overlap
+	num_frames = window + (window - overlap)//2
+
+	pose,trans = synthetic_motion(num_frames)
+	with torch.no_grad():
+		target = synthetic_target(retargeter.smplRetargetter.smpl_layer,pose,trans,retargeter.cfg).numpy()
+
+	# The partial last window must reuse the loaded model
+	def no_reload(*args,**kwargs):
+		raise AssertionError("SMPL model reloaded for the partial window")
+	monkeypatch.setattr(retarget2smpl,'SMPL_Layer',no_reload)
+
+	frame_times = np.arange(num_frames)/60
+	emitted = []
+	for t in range(num_frames):
+		res = retargeter.push(frame_times[t],target[t])
+		if res is not None:
+			emitted.append(res)
+
+	# One full window, its last OVERLAP frames are held back for the next one
+	assert len(emitted) == 1
+	assert len(emitted[0]['frames']) == window - overlap
+	assert len(retargeter.targets) == num_frames - (window - overlap)
+
+	save_path = str(tmp_path / 'live.smpl')
+	retargeter.save(save_path)
+	assert len(retargeter.targets) == 0
+
+	res = load_smpl(save_path)
+	assert res['pose_params'].shape == (num_frames,72)
+	assert res['trans'].shape == (num_frames,3)
+	np.testing.assert_allclose(res['frames'],frame_times)
+	for k in ['shape_params','scale','offset']:
+		assert k in res
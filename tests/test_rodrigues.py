@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from smplpytorch.pytorch.rodrigues_layer import batch_rodrigues, batch_rodrigues_quat, SMALL_ANGLE
+
+
+@pytest.fixture
+def axisang():
+	torch.manual_seed(0)
+	# Random rotations, small angles (taylor expansion), around the small angle switch, close to pi and the identity
+	return torch.cat([
+		torch.rand(16,3,dtype=torch.double)*2 - 1,
+		(torch.rand(16,3,dtype=torch.double)*2 - 1)*1e-3,
+		torch.nn.functional.normalize(torch.rand(16,3,dtype=torch.double),dim=1)*SMALL_ANGLE*torch.linspace(0.9,1.1,16,dtype=torch.double)[:,None],
+		torch.nn.functional.normalize(torch.rand(16,3,dtype=torch.double),dim=1)*(3.14 - 1e-3),
+		torch.zeros(1,3,dtype=torch.double)])
+
+
+def test_matches_quaternion(axisang):
+	# Tolerance of the 1e-8 offset in batch_rodrigues_quat
+	torch.testing.assert_close(batch_rodrigues(axisang),batch_rodrigues_quat(axisang),rtol=0,atol=1e-6)
+
+
+def test_matches_quaternion_float(axisang):
+	torch.testing.assert_close(batch_rodrigues(axisang.float()),batch_rodrigues_quat(axisang.float()),rtol=0,atol=1e-5)
+
+
+def test_gradcheck(axisang):
+	assert torch.autograd.gradcheck(batch_rodrigues,(axisang.requires_grad_(),))
+
+
+def test_gradient_matches_quaternion(axisang):
+	weights = torch.rand(axisang.shape[0],9,dtype=torch.double)
+	grads = []
+	for function in [batch_rodrigues,batch_rodrigues_quat]:
+		x = axisang.clone().requires_grad_()
+		(function(x)*weights).sum().backward()
+		grads.append(x.grad)
+	# The quaternion version adds 1e-8 to the axis before the norm and divides by it, skip the identity
+	torch.testing.assert_close(grads[0][:-1],grads[1][:-1],rtol=0,atol=1e-6)
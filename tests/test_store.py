@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from store import ArrayStore
+
+
+@pytest.fixture
+def frames():
+	return np.arange(20,dtype=np.float32).reshape(10,2)
+
+
+def test_append_after_crash(tmp_path,frames):
+	path = str(tmp_path / 'crash.smpl')
+	store = ArrayStore.create(path,{"a":{"shape":[2]}},chunk_size=4)
+	store.append(a=frames[:5])
+
+	# Chunk bytes written by an append that crashed before meta.json was updated
+	with open(store._chunk_path('a',1),'ab') as f:
+		f.write(b'\x00'*12)
+	with open(store._chunk_path('a',2),'ab') as f:
+		f.write(b'\x01'*8)
+
+	store = ArrayStore.open(path)
+	store.append(a=frames[5:])
+	np.testing.assert_array_equal(ArrayStore.open(path).read('a'),frames)
+
+
+@pytest.mark.parametrize("frame_slice",[slice(None,None,-1),slice(8,1,-3),slice(-1,-11,-2),slice(9,None,-4),slice(None,None,3),slice(3,1)])
+def test_read_slices(tmp_path,frames,frame_slice):
+	store = ArrayStore.create(str(tmp_path / 'slices.smpl'),{"a":{"shape":[2]}},chunk_size=4)
+	store.append(a=frames)
+	np.testing.assert_array_equal(store.read('a',frame_slice),frames[frame_slice])
+
+
+def test_rabit_export_marker(tmp_path,monkeypatch):
+	import store
+	monkeypatch.setattr(store,'RENDER_DIR',str(tmp_path))
+	(tmp_path / 'sample' / 'RaBit').mkdir(parents=True)
+
+	assert not store.rabit_export_done('sample',10,'mesh','key')
+	store.mark_rabit_export('sample',10,'mesh','key')
+	assert store.rabit_export_done('sample',10,'mesh','key')
+	# Refit SMPL result, other frame count or export mode
+	assert not store.rabit_export_done('sample',10,'mesh','other_key')
+	assert not store.rabit_export_done('sample',10,'mesh',None)
+	assert not store.rabit_export_done('sample',11,'mesh','key')
+	assert not store.rabit_export_done('sample',10,'obj','key')
+
+
+@pytest.mark.parametrize("encoding,atol",[("float32",1e-6),("float16",1e-2),("int16",1e-3)])
+def test_rabit_mesh_round_trip(tmp_path,encoding,atol):
+	import store
+	rng = np.random.RandomState(0)
+	trans = rng.randn(7,3).astype(np.float32)
+	verts = rng.randn(7,50,3).astype(np.float32)*0.5 + trans[:,None,:]
+	joints = rng.randn(7,24,3).astype(np.float32)
+	faces = rng.randint(0,50,size=(30,3))
+	uvs = rng.rand(60,2).astype(np.float32)
+	face_uvs = rng.randint(0,60,size=(30,3))
+
+	path = str(tmp_path / 'mesh.rabit')
+	store.save_rabit_mesh(path,verts,trans,joints,faces,uvs,face_uvs,encoding=encoding,attrs={"smpl_cache_key":"key"},chunk_size=3)
+
+	mesh = store.load_rabit_mesh(path)
+	np.testing.assert_allclose(mesh['verts'],verts,rtol=0,atol=atol)
+	np.testing.assert_array_equal(mesh['trans'],trans)
+	np.testing.assert_array_equal(mesh['joints'],joints)
+	np.testing.assert_array_equal(mesh['faces'],faces)
+	np.testing.assert_array_equal(mesh['uvs'],uvs)
+	np.testing.assert_array_equal(mesh['face_uvs'],face_uvs)
+	assert store.ArrayStore.open(path).attrs['smpl_cache_key'] == "key"
+
+	# Frame by frame reads of the renderer
+	frame = store.load_rabit_mesh(path,frames=4,static=False)
+	np.testing.assert_allclose(frame['verts'],mesh['verts'][4],rtol=0,atol=1e-6)
+	assert 'faces' not in frame
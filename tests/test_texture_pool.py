@@ -0,0 +1,56 @@
+import os
+import sys
+import json
+import hashlib
+import subprocess
+
+import pytest
+
+from texture_pool import subject_texture, texture_path, generate_pool, link_texture
+
+
+@pytest.fixture
+def pool_dir(tmp_path):
+	pool_dir = tmp_path / 'texture_pool'
+	pool_dir.mkdir()
+	with open(pool_dir / 'pool.json','w') as f:
+		json.dump({"size":16,"seed":0},f)
+	for i in range(16):
+		(pool_dir / os.path.basename(texture_path(str(pool_dir),i))).write_bytes(bytes([i]))
+	return str(pool_dir)
+
+
+def test_subject_texture_deterministic(pool_dir):
+	subjects = [f"subject{i}" for i in range(32)]
+	textures = [subject_texture(s,pool_dir) for s in subjects]
+	assert textures == [subject_texture(s,pool_dir) for s in subjects]
+	assert all(os.path.dirname(t) == pool_dir and os.path.isfile(t) for t in textures)
+	# Subjects are spread over the pool
+	assert len(set(textures)) > 1
+
+	# Independent of the process (no salted hash())
+	src_dir = os.path.dirname(sys.modules['texture_pool'].__file__)
+	code = f"import sys; sys.path.insert(0,{src_dir!r}); from texture_pool import subject_texture; print(subject_texture('subject7',{pool_dir!r}))"
+	for seed in ['1','2']:
+		out = subprocess.run([sys.executable,'-c',code],env=dict(os.environ,PYTHONHASHSEED=seed),capture_output=True,text=True,check=True).stdout
+		assert out.strip().splitlines()[-1] == textures[7]
+
+
+def test_subject_texture_index(pool_dir):
+	index = int(hashlib.sha256(b"subject7").hexdigest(),16) % 16
+	assert subject_texture("subject7",pool_dir) == texture_path(pool_dir,index)
+
+
+def test_complete_pool_is_kept(pool_dir):
+	# Returned without loading the texture network
+	assert generate_pool(pool_dir,size=4,network_pkl='missing.pkl')['size'] == 16
+
+
+def test_link_texture(tmp_path,pool_dir):
+	texture = subject_texture("subject7",pool_dir)
+	path = str(tmp_path / 'sample' / 'texture.png')
+	os.makedirs(os.path.dirname(path))
+	link_texture(texture,path)
+	link_texture(texture,path)
+	with open(path,'rb') as f, open(texture,'rb') as g:
+		assert f.read() == g.read()
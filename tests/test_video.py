@@ -0,0 +1,57 @@
+import os
+import stat
+
+import numpy as np
+import pytest
+
+from video import VideoEncoder
+
+
+def fake_ffmpeg(tmp_path,monkeypatch,script):
+	bin_dir = tmp_path / 'bin'
+	bin_dir.mkdir()
+	path = bin_dir / 'ffmpeg'
+	path.write_text("#!/bin/sh\n" + script)
+	path.chmod(path.stat().st_mode | stat.S_IEXEC)
+	monkeypatch.setenv('PATH',str(bin_dir) + os.pathsep + os.environ.get('PATH',''))
+
+
+@pytest.fixture
+def frames():
+	return np.zeros((3,16,16,3),dtype=np.uint8)
+
+
+def test_ffmpeg_success(tmp_path,monkeypatch,frames):
+	# Consume the frames and write the last argument (the video path)
+	fake_ffmpeg(tmp_path,monkeypatch,'cat > /dev/null\nfor last; do :; done\ntouch "$last"\n')
+	video_path = str(tmp_path / 'out' / 'video.mp4')
+	with VideoEncoder(video_path,30) as encoder:
+		for frame in frames:
+			encoder.write(frame)
+	assert encoder.num_frames == 3
+	assert os.path.isfile(video_path)
+
+
+def test_ffmpeg_failure(tmp_path,monkeypatch,frames):
+	fake_ffmpeg(tmp_path,monkeypatch,'cat > /dev/null\necho "Unknown encoder libx264" >&2\nexit 1\n')
+	with pytest.raises(RuntimeError,match="exit code 1.*\n.*Unknown encoder"):
+		with VideoEncoder(str(tmp_path / 'video.mp4'),30) as encoder:
+			for frame in frames:
+				encoder.write(frame)
+
+
+def test_ffmpeg_exits_early(tmp_path,monkeypatch):
+	# ffmpeg exits without reading the frames, the broken pipe is reported as the ffmpeg error
+	fake_ffmpeg(tmp_path,monkeypatch,'echo "Invalid argument" >&2\nexit 2\n')
+	frame = np.zeros((512,512,3),dtype=np.uint8)
+	with pytest.raises(RuntimeError,match="exit code 2"):
+		with VideoEncoder(str(tmp_path / 'video.mp4'),30) as encoder:
+			for i in range(10):
+				encoder.write(frame)
+
+
+def test_ffmpeg_missing(tmp_path,monkeypatch,frames):
+	# No ffmpeg on the PATH
+	monkeypatch.setenv('PATH',str(tmp_path))
+	with pytest.raises(RuntimeError,match="ffmpeg was not found"):
+		VideoEncoder(str(tmp_path / 'video.mp4'),30).write(frames[0])